@@ -5,9 +5,8 @@ Configurable Pipeline for the Analysis of Connectomes
 CPAC is a configurable, open-source, Nipype-based, automated processing pipeline for resting state functional MRI (R-fMRI) data, for use by both novice and expert users.
 """
 
-import numpy as np
-import pyximport
-pyximport.install(setup_args={'include_dirs': [np.get_include()]})
+import sys
+import types
 
 from numpy.testing import nosetester
 test = nosetester.NoseTester.test
@@ -18,32 +17,31 @@ class _NoseTester(nosetester.NoseTester):
 
 test = _NoseTester().test
 
-import anat_preproc, \
-       EPI_DistCorr, \
-       func_preproc, \
-       reho, \
-       seg_preproc, \
-       registration, \
-       sca, \
-       basc, \
-       nuisance, \
-       generate_motion_statistics, \
-       alff, \
-       qc, \
-       seg_preproc, \
-       vmhc, \
-       median_angle, \
-       timeseries, \
-       network_centrality, \
-       scrubbing, \
-       group_analysis, \
-       easy_thresh,\
-       utils, \
-       pipeline, \
-       cwas, \
-       GUI
+# Subpackages are only imported when first accessed (e.g. CPAC.reho), so
+# that importing a single function doesn't pull in every pipeline, wx and
+# matplotlib along with it
+_subpackages = ['anat_preproc', 'EPI_DistCorr', 'func_preproc', 'reho', 
+                'seg_preproc', 'registration', 'sca', 'basc', 'nuisance', 
+                'generate_motion_statistics', 'alff', 'qc', 'vmhc', 
+                'median_angle', 'timeseries', 'network_centrality', 
+                'scrubbing', 'group_analysis', 'easy_thresh', 'utils', 
+                'pipeline', 'cwas', 'GUI']
 
-__all__ = ['GUI', 'pipeline', 'anat_preproc', 'func_preproc', 'epi_distcorr', 'registration', 'seg_preproc', 'reho', 'sca', 'basc', 'nuisance', 'alff', 'vmhc', 'median_angle', 'generate_motion_statistics', 'timeseries', 'network_centrality', 'scrubbing', 'utils', 'group_analysis', 'easy_thresh', 'qc', 'cwas']
+class _LazyPackage(types.ModuleType):
+    """
+    Package module that imports its subpackages on first attribute access
+    """
+    
+    def __getattr__(self, name):
+        if name not in _subpackages:
+            raise AttributeError("'module' object has no attribute '%s'" % name)
+        __import__('%s.%s' % (self.__name__, name))
+        return sys.modules['%s.%s' % (self.__name__, name)]
+    
+    def __dir__(self):
+        return sorted(set(self.__dict__.keys() + _subpackages))
+
+__all__ = ['GUI', 'pipeline', 'anat_preproc', 'func_preproc', 'EPI_DistCorr', 'registration', 'seg_preproc', 'reho', 'sca', 'basc', 'nuisance', 'alff', 'vmhc', 'median_angle', 'generate_motion_statistics', 'timeseries', 'network_centrality', 'scrubbing', 'utils', 'group_analysis', 'easy_thresh', 'qc', 'cwas']
 
 from subprocess import Popen, PIPE
 import re
@@ -65,3 +63,10 @@ except OSError:
     version = 'unknown_version'
 
 __version__ =  str(version)
+
+# Swap in the lazy package, keeping a reference to this module so that its
+# globals are not cleared when it is no longer in sys.modules
+_package = _LazyPackage(__name__, __doc__)
+_package.__dict__.update(sys.modules[__name__].__dict__)
+_package._module = sys.modules[__name__]
+sys.modules[__name__] = _package
@@ -1,9 +1,20 @@
 from utils import timeseries_bootstrap, \
                   standard_bootstrap, \
                   cluster_timeseries, \
+                  correlation_affinity, \
                   adjacency_matrix, \
+                  cluster_coassignment, \
                   cluster_matrix_average, \
-                  individual_stability_matrix
+                  individual_stability_matrix, \
+                  individual_bootstrap_clusters, \
+                  group_bootstrap_clusters, \
+                  bootstrap_stability, \
+                  bootstrap_weights, \
+                  stream_bootstrap_clusters, \
+                  matrix_to_triu, \
+                  triu_to_matrix, \
+                  load_stability_matrix, \
+                  stack_stability_matrices
 
 from basc import create_basc, \
                  nifti_individual_stability, \
@@ -17,6 +28,17 @@ __all__ = ['create_basc', \
            'timeseries_bootstrap', \
            'standard_bootstrap', \
            'cluster_timeseries', \
+           'correlation_affinity', \
            'adjacency_matrix', \
+           'cluster_coassignment', \
            'cluster_matrix_average', \
-           'individual_stability_matrix']
\ No newline at end of file
+           'individual_stability_matrix', \
+           'individual_bootstrap_clusters', \
+           'group_bootstrap_clusters', \
+           'bootstrap_stability', \
+           'bootstrap_weights', \
+           'stream_bootstrap_clusters', \
+           'matrix_to_triu', \
+           'triu_to_matrix', \
+           'load_stability_matrix', \
+           'stack_stability_matrices']
\ No newline at end of file
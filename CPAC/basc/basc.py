@@ -1,7 +1,7 @@
 import nipype.pipeline.engine as pe
 import nipype.interfaces.utility as util
 
-def group_stability_matrix(indiv_stability_list, n_bootstraps, k_clusters, stratification=None):
+def group_stability_matrix(indiv_stability_list, n_bootstraps, k_clusters, stratification=None, n_jobs=1, random_state=None, tol=None, stream=False, stream_dtype='float32', warm_start=False):
     """
     Calculate the group stability matrix of the entire dataset by bootstrapping the dataset
     
@@ -15,6 +15,19 @@ def group_stability_matrix(indiv_stability_list, n_bootstraps, k_clusters, strat
         Number of clusters
     stratification : array_like, optional
         List of integer entries denoting stratums for indiv_stability_list
+    n_jobs : integer, optional
+        Number of processes running the bootstraps
+    random_state : integer, optional
+        Seed of the bootstraps
+    tol : float, optional
+        Stop bootstrapping once the group stability matrix changes by less than tol (see `bootstrap_stability`)
+    stream : boolean, optional
+        Keep the individual stability matrices in a memory-mapped stack of their upper triangles instead of
+        loading them all, and accumulate each bootstrap's average one subject at a time
+    stream_dtype : dtype, optional
+        Data type of the memory-mapped stack, float16 or float32
+    warm_start : boolean, optional
+        Start the clustering of each bootstrap from the eigenvectors of the previous one (see `bootstrap_stability`)
     
     
     Returns
@@ -31,27 +44,33 @@ def group_stability_matrix(indiv_stability_list, n_bootstraps, k_clusters, strat
     if stratification is not None:
         print 'Applying stratification to group dataset'
                 
-    from CPAC.basc import standard_bootstrap, adjacency_matrix, cluster_timeseries, cluster_matrix_average
+    from CPAC.basc import bootstrap_stability, group_bootstrap_clusters, stream_bootstrap_clusters, \
+                          stack_stability_matrices, load_stability_matrix, cluster_timeseries, cluster_matrix_average
     import numpy as np
+    import os
+
+    if stratification is not None:
+        stratification = np.asarray(stratification)
 
-    indiv_stability_set = np.asarray([np.load(ism_file) for ism_file in indiv_stability_list])
-#    indiv_stability_set = indiv_stability_list
-    print 'Individual stability list dimensions:', indiv_stability_set.shape
-    
-    V = indiv_stability_set.shape[2]
-    
-    G = np.zeros((V,V))
-    for bootstrap_i in range(n_bootstraps):
-        if stratification is not None:
-            strata = np.unique(stratification)
-            J = np.zeros((V,V))
-            for stratum in strata:
-                J += standard_bootstrap(indiv_stability_set[np.where(stratification == stratum)]).sum(0)
-            J /= indiv_stability_set.shape[0]
-        else:
-            J = standard_bootstrap(indiv_stability_set).mean(0)
-        G += adjacency_matrix(cluster_timeseries(J, k_clusters, similarity_metric = 'data')[:,np.newaxis])
-    G /= n_bootstraps
+    if stream:
+        stack_file = stack_stability_matrices(indiv_stability_list, 
+                                              os.path.join(os.getcwd(), 'individual_stability_stack.npy'), 
+                                              dtype=stream_dtype)
+        stack = np.load(stack_file, mmap_mode='r')
+        print 'Individual stability stack dimensions:', stack.shape
+        
+        V = int(round((np.sqrt(8 * stack.shape[1] + 1) - 1) / 2))
+        bootstrap_func, bootstrap_args = stream_bootstrap_clusters, (stack_file, k_clusters, stratification)
+    else:
+        indiv_stability_set = np.asarray([load_stability_matrix(ism_file) for ism_file in indiv_stability_list])
+        print 'Individual stability list dimensions:', indiv_stability_set.shape
+        
+        V = indiv_stability_set.shape[2]
+        bootstrap_func, bootstrap_args = group_bootstrap_clusters, (indiv_stability_set, k_clusters, stratification)
+    
+    G = bootstrap_stability(bootstrap_func, bootstrap_args, V, n_bootstraps, 
+                            n_jobs=n_jobs, random_state=random_state, tol=tol,
+                            warm_start=warm_start)
 
 
     clusters_G = cluster_timeseries(G, k_clusters, similarity_metric = 'data')
@@ -63,7 +82,7 @@ def group_stability_matrix(indiv_stability_list, n_bootstraps, k_clusters, strat
 
     return G, clusters_G, cluster_voxel_scores
 
-def individual_group_clustered_maps(indiv_stability_list, clusters_G, roi_mask_file):
+def individual_group_clustered_maps(indiv_stability_list, clusters_G, roi_mask_file, stream=False):
     """
     Calculate the individual stability maps of each subject based on the group stability clustering solution.
     
@@ -73,6 +92,8 @@ def individual_group_clustered_maps(indiv_stability_list, clusters_G, roi_mask_f
         A length `N` list of file paths to numpy matrices of shape (`V`, `V`), `N` subjects, `V` voxels
     clusters_G : array_like
         Length `V` array of cluster assignments for each voxel
+    stream : boolean, optional
+        Load one subject's individual stability matrix at a time instead of all of them
         
     Returns
     -------
@@ -83,19 +104,20 @@ def individual_group_clustered_maps(indiv_stability_list, clusters_G, roi_mask_f
     """
     import os
     import numpy as np
-    from CPAC.basc import cluster_matrix_average, ndarray_to_vol
+    from CPAC.basc import cluster_matrix_average, load_stability_matrix, ndarray_to_vol
     
-    indiv_stability_set = np.asarray([np.load(ism_file) for ism_file in indiv_stability_list])
-
-    nSubjects = indiv_stability_set.shape[0]
-    nVoxels = indiv_stability_set.shape[1]
-
     cluster_ids = np.unique(clusters_G)
-    nClusters = cluster_ids.shape[0]
     
-    cluster_voxel_scores = np.zeros((nClusters, nSubjects, nVoxels))
-    for i in range(nSubjects):
-        cluster_voxel_scores[:,i] = cluster_matrix_average(indiv_stability_set[i], clusters_G)
+    if stream:
+        cluster_voxel_scores = None
+        for i, ism_file in enumerate(indiv_stability_list):
+            scores = cluster_matrix_average(load_stability_matrix(ism_file, mmap_mode='r'), clusters_G)
+            if cluster_voxel_scores is None:
+                cluster_voxel_scores = np.zeros((scores.shape[0], len(indiv_stability_list), scores.shape[1]))
+            cluster_voxel_scores[:,i] = scores
+    else:
+        indiv_stability_set = np.asarray([load_stability_matrix(ism_file) for ism_file in indiv_stability_list])
+        cluster_voxel_scores = cluster_matrix_average(indiv_stability_set, clusters_G)
     
     icvs = []
     icvs_idx = 0
@@ -105,7 +127,7 @@ def individual_group_clustered_maps(indiv_stability_list, clusters_G, roi_mask_f
  
     return icvs
 
-def nifti_individual_stability(subject_file, roi_mask_file, n_bootstraps, k_clusters, cbb_block_size = None, affinity_threshold = 0.5):
+def nifti_individual_stability(subject_file, roi_mask_file, n_bootstraps, k_clusters, cbb_block_size = None, affinity_threshold = 0.5, triu_dtype = None, n_jobs = 1, random_state = None, tol = None, warm_start = False):
     """
     Calculate the individual stability matrix for a single subject by using Circular Block Bootstrapping method
     for time-series data.
@@ -124,6 +146,16 @@ def nifti_individual_stability(subject_file, roi_mask_file, n_bootstraps, k_clus
         Size of the time-series block when performing circular block bootstrap
     affinity_threshold : float, optional
         Minimum threshold for similarity matrix based on correlation to create an edge
+    triu_dtype : dtype, optional
+        Save only the upper triangle of the matrix, as this data type (float16 or float32)
+    n_jobs : integer, optional
+        Number of processes running the bootstraps
+    random_state : integer, optional
+        Seed of the bootstraps
+    tol : float, optional
+        Stop bootstrapping once the individual stability matrix changes by less than tol (see `bootstrap_stability`)
+    warm_start : boolean, optional
+        Start the clustering of each bootstrap from the eigenvectors of the previous one (see `bootstrap_stability`)
         
     Returns
     -------
@@ -132,7 +164,7 @@ def nifti_individual_stability(subject_file, roi_mask_file, n_bootstraps, k_clus
     """
     print 'Calculating individual stability matrix of:', subject_file
 
-    from CPAC.basc import individual_stability_matrix
+    from CPAC.basc import individual_stability_matrix, matrix_to_triu
     from CPAC.utils import safe_shape
     import nibabel as nb
     import numpy as np
@@ -149,7 +181,10 @@ def nifti_individual_stability(subject_file, roi_mask_file, n_bootstraps, k_clus
     Y = data[roi_mask_file].T
     print '(%i timepoints, %i voxels) and %i bootstraps' % (Y.shape[0], Y.shape[1], n_bootstraps)
     
-    ism = individual_stability_matrix(Y, n_bootstraps, k_clusters, cbb_block_size=cbb_block_size, affinity_threshold=affinity_threshold)
+    ism = individual_stability_matrix(Y, n_bootstraps, k_clusters, cbb_block_size=cbb_block_size, affinity_threshold=affinity_threshold,
+                                      n_jobs=n_jobs, random_state=random_state, tol=tol, warm_start=warm_start)
+    if triu_dtype is not None:
+        ism = matrix_to_triu(ism, triu_dtype)
     ism_file = os.path.join(os.getcwd(), 'individual_stability_matrix.npy')
     np.save(ism_file, ism)
     
@@ -182,14 +217,13 @@ def ndarray_to_vol(data_array, roi_mask_file, sample_file, filename):
     import nibabel as nb
     import numpy as np
     import os
+    from CPAC.utils import volumize
     
     roi_mask_file = nb.load(roi_mask_file).get_data().astype('float64').astype('bool')
     if(len(data_array.shape) == 1):
-        out_vol = np.zeros_like(roi_mask_file, dtype=data_array.dtype)
-        out_vol[roi_mask_file] = data_array
+        out_vol = volumize(data_array, roi_mask_file)
     elif(len(data_array.shape) == 2):
-        out_vol = np.zeros((roi_mask_file.shape[0], roi_mask_file.shape[1], roi_mask_file.shape[2], data_array.shape[0]), dtype=data_array.dtype)
-        out_vol[roi_mask_file] = data_array.T
+        out_vol = volumize(data_array.T, roi_mask_file)
     else:
         raise ValueError('data_array is %i dimensional, must be either 1 or 2 dimensional' % len(data_array.shape) )
 
@@ -205,7 +239,7 @@ def ndarray_to_vol(data_array, roi_mask_file, sample_file, filename):
     
     return img_file
 
-def create_basc(name='basc'):
+def create_basc(name='basc', stream=False, stream_dtype='float32', warm_start=False, n_jobs=1, random_state=None, tol=None):
     """
     Bootstrap Analysis of Stable Clusters (BASC)
     
@@ -215,6 +249,21 @@ def create_basc(name='basc'):
     ----------
     name : string, optional
         Name of the workflow.
+    stream : boolean, optional
+        Save individual stability matrices as upper triangles and aggregate them at the group level from a
+        memory-mapped stack, one subject at a time, instead of loading every subject's matrix at once.
+    stream_dtype : string, optional
+        Data type of the saved upper triangles, 'float16' or 'float32'.
+    warm_start : boolean, optional
+        Start the clustering of each bootstrap from the eigenvectors of the previous bootstrap, at both the
+        individual and group level.
+    n_jobs : integer, optional
+        Number of processes running the bootstraps of each subject and of the group.
+    random_state : integer, optional
+        Seed of the bootstraps, by default drawn from the global numpy random state.
+    tol : float, optional
+        Stop bootstrapping once the individual or group stability matrix changes by less than tol, by default
+        all bootstraps are run.
     
     Returns
     -------
@@ -305,7 +354,12 @@ def create_basc(name='basc'):
                                                 'n_bootstraps',
                                                 'k_clusters',
                                                 'cbb_block_size',
-                                                'affinity_threshold'],
+                                                'affinity_threshold',
+                                                'triu_dtype',
+                                                'n_jobs',
+                                                'random_state',
+                                                'tol',
+                                                'warm_start'],
                                    output_names=['individual_stability_matrices'],
                                    function=nifti_individual_stability),
                      name='individual_stability_matrices',
@@ -315,7 +369,13 @@ def create_basc(name='basc'):
     gsm = pe.Node(util.Function(input_names=['indiv_stability_list',
                                              'n_bootstraps',
                                              'k_clusters',
-                                             'stratification'],
+                                             'stratification',
+                                             'n_jobs',
+                                             'random_state',
+                                             'tol',
+                                             'stream',
+                                             'stream_dtype',
+                                             'warm_start'],
                                 output_names=['group_stability_matrix',
                                               'group_stability_clusters',
                                               'group_stability_scores'],
@@ -324,11 +384,34 @@ def create_basc(name='basc'):
 
     igcm = pe.Node(util.Function(input_names=['indiv_stability_list',
                                               'clusters_G',
-                                              'roi_mask_file'],
+                                              'roi_mask_file',
+                                              'stream'],
                                  output_names=['individual_cluster_voxel_scores'],
                                  function=individual_group_clustered_maps),
                    name='individual_group_clustered_maps')
 
+    if stream:
+        nis.inputs.triu_dtype = stream_dtype
+        gsm.inputs.stream = True
+        gsm.inputs.stream_dtype = stream_dtype
+        igcm.inputs.stream = True
+
+    if warm_start:
+        nis.inputs.warm_start = True
+        gsm.inputs.warm_start = True
+
+    if n_jobs > 1:
+        nis.inputs.n_jobs = n_jobs
+        gsm.inputs.n_jobs = n_jobs
+
+    if random_state is not None:
+        nis.inputs.random_state = random_state
+        gsm.inputs.random_state = random_state
+
+    if tol is not None:
+        nis.inputs.tol = tol
+        gsm.inputs.tol = tol
+
     gs_cluster_vol = pe.Node(util.Function(input_names=['data_array',
                                                         'roi_mask_file',
                                                         'sample_file',
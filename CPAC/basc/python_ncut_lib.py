@@ -42,8 +42,10 @@ from numpy import array,reshape,shape,matrix,ones,zeros,sqrt,sort,arange
 from numpy import nonzero,fromfile,tile,append,prod,double,argsort,sign
 from numpy import kron,multiply,divide,abs,reshape,asarray
 from scipy import rand
-from scipy.sparse import csc_matrix, spdiags
+from scipy.sparse import csc_matrix, spdiags, issparse
+from scipy.sparse.linalg import LinearOperator
 from scipy.sparse.linalg.eigen.arpack import eigsh
+import numpy as np
 from scipy.linalg import norm, svd, LinAlgError
 
 # exception hander for singular value decomposition
@@ -212,3 +214,121 @@ def discretisation( eigen_vec ):
 	else:
 		return(eigenvec_discrete)
 
+
+# (eigen_val, eigen_vec) = ncut_sparse( W, nbEigenValues, eigen_vec0 ):
+#
+# Same normalized cut eigen decomposition as ncut, for a symmetric scipy.sparse (preferably CSR) or dense
+# similarity matrix W. The regularized, normalized LaPlacian is never formed: the eigen solver multiplies
+# by it through W and the degree vectors, and the results are returned as plain arrays. The eigen solver
+# starts from a vector drawn from numpy's random generator, so that results follow numpy's seed. Given the
+# eigenvectors of a similar W, e.g. the previous bootstrap, their sum is added to the starting vector to
+# warm start the solver; the random part is kept so no eigenvector is missing from the starting vector.
+#
+#    W:             symmetric #feature x #feature similarity matrix
+#    nvEigenValues: number of eigenvectors that should be calculated
+#    eigen_vec0:    (optional) #feature x K array of eigenvectors to warm start from
+#    eigen_val:     (output) eigenvalues from the eigen decomposition of the LaPlacian of W
+#    eigen_vec:     (output) #feature x nbEigenValues array of eigenvectors
+#
+def ncut_sparse( W, nbEigenValues, eigen_vec0=None ):
+	# parameters
+	offset=.5
+	maxiterations=100
+	eigsErrorTolerence=1e-6
+	eps=2.2204e-16
+
+	m=W.shape[1]
+
+	# degrees and regularization, as in ncut
+	if issparse(W):
+		d=np.asarray(abs(W).sum(0)).ravel()
+		d_signed=np.asarray(W.sum(0)).ravel()
+	else:
+		d=np.abs(W).sum(0)
+		d_signed=W.sum(0)
+	dr=0.5*(d-d_signed)+offset
+	d=d+offset*2
+	dinvsqrt=1.0/np.sqrt(d+eps)
+
+	# P*x = Dinvsqrt*(W+Dr)*Dinvsqrt*x
+	def matvec(x):
+		x=np.ravel(x)*dinvsqrt
+		return dinvsqrt*(W.dot(x)+dr*x)
+	P=LinearOperator((m,m),matvec=matvec,dtype='float64')
+
+	v0=np.random.rand(m)
+	if eigen_vec0 is not None:
+		v_warm=np.asarray(eigen_vec0).sum(1)
+		v0=v0/norm(v0)+v_warm/norm(v_warm)
+
+	# perform the eigen decomposition
+	eigen_val,eigen_vec=eigsh(P,nbEigenValues,v0=v0,maxiter=maxiterations,tol=eigsErrorTolerence,which='LA')
+
+	# sort the eigen_vals so that the first is the largest
+	i=np.argsort(-eigen_val)
+	eigen_val=eigen_val[i]
+	eigen_vec=eigen_vec[:,i]
+
+	# normalize the returned eigenvectors to a norm of sqrt(#feature) and a negative first element
+	eigen_vec=dinvsqrt[:,np.newaxis]*eigen_vec
+	eigen_vec*=np.sqrt(m)/np.sqrt((eigen_vec**2).sum(0))
+	first_sign=np.sign(eigen_vec[0])
+	eigen_vec*=np.where(first_sign != 0, -first_sign, 1)
+
+	return(eigen_val, eigen_vec)
+
+# eigenvec_discrete=discretisation_vectorized( eigen_vec ):
+#
+# Same discretisation as discretisation, written with array operations instead of numpy matrices. The
+# random initial ordering of the eigenvectors is drawn from numpy's random generator.
+#
+#    eigen_vec:          #feature x K array of eigenvectors, e.g. from ncut_sparse
+#    eigen_vec_discrete: (output) #feature x K sparse matrix of 0 and 1 assigning features to clusters
+#
+def discretisation_vectorized( eigen_vec ):
+	eps=2.2204e-16
+	nbIterationsDiscretisationMax=20
+
+	# normalize the eigenvectors
+	eigen_vec=np.asarray(eigen_vec)
+	n,k=eigen_vec.shape
+	eigen_vec=eigen_vec/np.sqrt((eigen_vec**2).sum(1))[:,np.newaxis]
+
+	# if there is an exception we try to randomize and rerun SVD again, do this 30 times
+	for svd_restarts in range(30):
+
+		# initialize algorithm with a random ordering of eigenvectors
+		c=np.zeros(n)
+		R=np.zeros((k,k))
+		R[:,0]=eigen_vec[int(np.random.rand()*n)]
+		for j in range(1,k):
+			c+=np.abs(eigen_vec.dot(R[:,j-1]))
+			R[:,j]=eigen_vec[c.argmin()]
+
+		lastObjectiveValue=0
+		nbIterationsDiscretisation=0
+		while True:
+			nbIterationsDiscretisation+=1
+
+			# rotate the eigenvectors and discretise by setting the max of each row to 1
+			j=eigen_vec.dot(R).argmax(1)
+			discrete=np.zeros((n,k))
+			discrete[np.arange(n),j]=1
+
+			# rotation bringing the discrete eigenvectors to the original eigenvectors
+			try:
+				U, S, Vh = svd(discrete.T.dot(eigen_vec))
+			except LinAlgError:
+				print >> sys.stderr, "SVD did not converge, randomizing and trying again"
+				break
+
+			# test for convergence
+			NcutValue=2*(n-S.sum())
+			if((abs(NcutValue-lastObjectiveValue) < eps ) or
+			   ( nbIterationsDiscretisation > nbIterationsDiscretisationMax )):
+				return(csc_matrix((np.ones(n),(np.arange(n),j)),shape=(n,k)))
+
+			lastObjectiveValue=NcutValue
+			R=Vh.T.dot(U.T)
+
+	raise SVDError("SVD did not converge after 30 retries")
@@ -4,6 +4,14 @@ from ..utils import timeseries_bootstrap, \
                     standard_bootstrap, \
                     cluster_timeseries, \
                     adjacency_matrix, \
+                    cluster_coassignment, \
+                    bootstrap_stability, \
+                    bootstrap_weights, \
+                    cluster_matrix_average, \
+                    matrix_to_triu, \
+                    triu_to_matrix, \
+                    stack_stability_matrices, \
+                    correlation_affinity, \
                     individual_stability_matrix
 
 def test_timeseries_bootstrap():
@@ -58,6 +66,101 @@ def test_adjacency_matrix():
                        [0, 0, 0, 1, 0],
                        [1, 0, 0, 0, 1]])
     np.testing.assert_equal(actual, desired)
+
+def test_cluster_coassignment():
+    """
+    Tests cluster_coassignment against the adjacency of the cluster labels
+    """
+    x = np.random.randint(0, 5, 50)
+    actual = cluster_coassignment(x)
+    desired = (x[:,np.newaxis] == x[np.newaxis,:]).astype(int)
+    np.testing.assert_equal(actual, desired)
+
+def random_labels(V, k, eigen_vec0 = None):
+    return np.random.randint(0, k, V), None
+
+def test_bootstrap_stability():
+    """
+    Tests bootstrap_stability gives the same stability matrix run serially and
+    across processes, and that it stops early once converged
+    """
+    seeds = np.random.RandomState(2).randint(0, 2**31 - 1, size=50)
+    desired = np.zeros((40,40))
+    for seed in seeds:
+        np.random.seed(seed)
+        desired += cluster_coassignment(random_labels(40, 3)[0])
+    desired /= 50
+    
+    S = bootstrap_stability(random_labels, (40, 3), 40, 50, random_state=2)
+    np.testing.assert_almost_equal(S, desired)
+    S = bootstrap_stability(random_labels, (40, 3), 40, 50, n_jobs=2, random_state=2)
+    np.testing.assert_almost_equal(S, desired)
+    # More processes than bootstraps between convergence checks
+    S = bootstrap_stability(random_labels, (40, 3), 40, 50, n_jobs=12, random_state=2)
+    np.testing.assert_almost_equal(S, desired)
+    
+    # Seeded from, and leaving, the global random state
+    np.random.seed(3)
+    S = bootstrap_stability(random_labels, (40, 3), 40, 50)
+    after = np.random.rand()
+    np.random.seed(3)
+    np.testing.assert_equal(bootstrap_stability(random_labels, (40, 3), 40, 50), S)
+    np.testing.assert_equal(np.random.rand(), after)
+    np.random.seed(3)
+    np.random.randint(0, 2**31 - 1, size=50)
+    np.testing.assert_equal(np.random.rand(), after)
+    
+    # Converged well before 1000 bootstraps
+    S = bootstrap_stability(random_labels, (40, 3), 40, 1000, random_state=2, tol=0.05)
+    assert np.abs(S - 1./3).mean() < 0.1
+    np.testing.assert_equal(bootstrap_stability(random_labels, (40, 3), 40, 1000, n_jobs=3, random_state=2, tol=0.05), S)
+    
+def test_warm_start():
+    """
+    Tests warm started bootstraps give the same stability matrix on every call,
+    and the same clusters as cold started ones on well separated data
+    """
+    np.random.seed(27)
+    signals = np.random.randn(60, 3)
+    Y = np.repeat(signals, 10, axis=1) + 0.5*np.random.randn(60, 30)
+    
+    S = individual_stability_matrix(Y, 20, 3, random_state=5, warm_start=True)
+    np.testing.assert_equal(individual_stability_matrix(Y, 20, 3, random_state=5, warm_start=True), S)
+    np.testing.assert_almost_equal(individual_stability_matrix(Y, 20, 3, random_state=5), S)
+    
+    labels = np.repeat(np.arange(3), 10)
+    np.testing.assert_almost_equal(S, labels[:,np.newaxis] == labels[np.newaxis,:])
+    
+def test_stability_stack():
+    """
+    Tests the memory-mapped upper triangle stack of individual stability matrices
+    against the full matrices
+    """
+    import os, tempfile
+    
+    ism = np.random.rand(4, 20, 20)
+    ism = (ism + ism.transpose(0,2,1))/2
+    np.testing.assert_equal(triu_to_matrix(matrix_to_triu(ism[0], 'float64')), ism[0])
+    
+    tmp_dir = tempfile.mkdtemp()
+    ism_list = []
+    for i in range(ism.shape[0]):
+        ism_list.append(os.path.join(tmp_dir, 'ism_%i.npy' % i))
+        np.save(ism_list[-1], ism[i] if i % 2 else matrix_to_triu(ism[i]))
+    stack = np.load(stack_stability_matrices(ism_list, os.path.join(tmp_dir, 'stack.npy')), mmap_mode='r')
+    np.testing.assert_raises(ValueError, stack_stability_matrices, [], os.path.join(tmp_dir, 'empty.npy'))
+    
+    w = bootstrap_weights(4, np.array([0,0,1,1]))
+    assert w.sum() == 4 and w[:2].sum() == 2
+    J = np.zeros(stack.shape[1])
+    for i in range(4):
+        J += w[i] * stack[i]
+    np.testing.assert_almost_equal(triu_to_matrix(J/4), np.tensordot(w/4., ism, 1), decimal=6)
+    
+    clusters = np.array([0]*10 + [1]*10)
+    scores = cluster_matrix_average(ism, clusters)
+    for i in range(4):
+        np.testing.assert_almost_equal(scores[:,i], cluster_matrix_average(ism[i], clusters))
     
 def generate_blobs():
     np.random.seed(27)
@@ -84,6 +187,38 @@ def test_cluster_timeseries():
     blobs = generate_blobs_3d()
     y_predict = cluster_timeseries(blobs, 3, similarity_metric = 'correlation')
 
+def test_correlation_affinity():
+    """
+    Tests the sparse thresholded correlation graph against the dense correlation matrix
+    """
+    X = generate_blobs()
+    desired = np.corrcoef(X)
+    desired[desired < 0.3] = 0
+    actual = correlation_affinity(X, 0.3, chunk_size=64)
+    np.testing.assert_almost_equal(actual.toarray(), desired)
+
+def test_ncut_sparse():
+    """
+    Tests the sparse normalized cut and vectorized discretisation against the original ones
+    """
+    from scipy.sparse import lil_matrix
+    from ..python_ncut_lib import ncut, ncut_sparse, discretisation, discretisation_vectorized
+    
+    C = correlation_affinity(generate_blobs_3d(), 0.5)
+    eigen_val, eigen_vec = ncut(lil_matrix(C), 3)
+    actual_val, actual_vec = ncut_sparse(C, 3)
+    np.testing.assert_almost_equal(actual_val, eigen_val)
+    np.testing.assert_almost_equal(actual_vec, np.asarray(eigen_vec), decimal=4)
+    
+    # Warm started from the solution itself
+    actual_val, actual_vec = ncut_sparse(C, 3, eigen_vec0=actual_vec)
+    np.testing.assert_almost_equal(actual_val, eigen_val)
+    
+    np.random.seed(27)
+    desired = discretisation(np.matrix(actual_vec)).toarray()
+    np.random.seed(27)
+    np.testing.assert_equal(discretisation_vectorized(actual_vec).toarray(), desired)
+
 def test_individual_stability_matrix():
     """
     Tests individual_stability_matrix method on three gaussian blobs.
@@ -79,7 +79,40 @@ def standard_bootstrap(dataset):
     return dataset[b]
 
 
-def cluster_timeseries(X, n_clusters, similarity_metric = 'k_neighbors', affinity_threshold = 0.0, neighbors = 10):
+def correlation_affinity(X, affinity_threshold = 0.0, chunk_size = 1000):
+    """
+    Build the thresholded correlation similarity graph of the samples of X
+    directly as a sparse CSR matrix, a block of rows at a time
+    
+    Parameters
+    ----------
+    X : array_like
+        A matrix of shape (`N`, `M`) with `N` samples and `M` dimensions
+    affinity_threshold : float, optional
+        Correlations below the threshold are not edges of the graph
+    chunk_size : integer, optional
+        Number of rows of the correlation matrix computed at once
+        
+    Returns
+    -------
+    C_X : scipy.sparse.csr_matrix
+        Matrix of shape (`N`, `N`) of the correlations at or above the threshold
+    """
+    from scipy import sparse
+    
+    Xn = X - X.mean(1)[:,np.newaxis]
+    Xn = Xn/np.sqrt( (Xn**2.).sum(1)[:,np.newaxis] )
+    
+    blocks = []
+    for start in range(0, Xn.shape[0], chunk_size):
+        C_block = np.dot(Xn[start:start + chunk_size], Xn.T)
+        C_block[C_block < affinity_threshold] = 0
+        blocks.append(sparse.csr_matrix(C_block))
+    
+    return sparse.vstack(blocks, format='csr')
+
+
+def cluster_timeseries(X, n_clusters, similarity_metric = 'k_neighbors', affinity_threshold = 0.0, neighbors = 10, eigen_vec0 = None, return_eigen_vec = False):
     """
     Cluster a given timeseries
         
@@ -96,11 +129,18 @@ def cluster_timeseries(X, n_clusters, similarity_metric = 'k_neighbors', affinit
         symmetric)
     affinity_threshold : float
         Threshold of similarity metric when 'correlation' similarity metric is used.
+    eigen_vec0 : array_like, optional
+        Matrix of shape (`N`, `n_clusters`) to start the eigen decomposition from, e.g. the eigenvectors
+        of the clustering of the previous bootstrap
+    return_eigen_vec : boolean, optional
+        Also return the eigenvectors of the normalized cut
         
     Returns
     -------
     y_pred : array_like
         Predicted cluster labels
+    eigen_vec : array_like
+        Eigenvectors of the normalized cut, only if return_eigen_vec
 
     Examples
     --------
@@ -113,13 +153,8 @@ def cluster_timeseries(X, n_clusters, similarity_metric = 'k_neighbors', affinit
     """
 
     if similarity_metric == 'correlation':
-        # Calculate empirical correlation matrix between samples
-        Xn = X - X.mean(1)[:,np.newaxis]
-        Xn = Xn/np.sqrt( (Xn**2.).sum(1)[:,np.newaxis] )
-        C_X = np.dot(Xn, Xn.T)
-        C_X[C_X < affinity_threshold] = 0
-        from scipy.sparse import lil_matrix
-        C_X = lil_matrix(C_X)
+        # Empirical correlation matrix between samples, thresholded
+        C_X = correlation_affinity(X, affinity_threshold)
     elif similarity_metric == 'data':
         C_X = X
     elif similarity_metric == 'k_neighbors':
@@ -137,14 +172,17 @@ def cluster_timeseries(X, n_clusters, similarity_metric = 'k_neighbors', affinit
 #    algorithm.fit(C_X)
 #    y_pred = algorithm.labels_.astype(np.int)
 
-    from python_ncut_lib import ncut, discretisation
-    eigen_val, eigen_vec = ncut(C_X, n_clusters)
-    eigen_discrete = discretisation(eigen_vec)
+    from python_ncut_lib import ncut_sparse, discretisation_vectorized
+    
+    eigen_val, eigen_vec = ncut_sparse(C_X, n_clusters, eigen_vec0=eigen_vec0)
+    eigen_discrete = discretisation_vectorized(eigen_vec)
 
     #np.arange(n_clusters)+1 isn't really necessary since the first cluster can be determined
     #by the fact that the each cluster is a disjoint set
     y_pred = np.dot(eigen_discrete.toarray(), np.diag(np.arange(n_clusters))).sum(1)
     
+    if return_eigen_vec:
+        return y_pred, eigen_vec
     return y_pred
 
 
@@ -175,18 +213,35 @@ def adjacency_matrix(cluster_pred):
            [1, 0, 0, 0, 1]])
 
     """
-    x = cluster_pred.copy()
+    return cluster_coassignment(cluster_pred) > 0
+
+
+def cluster_coassignment(cluster_pred, dtype='int32'):
+    """
+    Calculate the co-assignment matrix of cluster predictions from their
+    one-hot label matrix `L` as `L L^T`
     
-    if(len(x.shape) == 1):
-        x = x[:, np.newaxis]
-        
-    # Force the cluster indexing to be positive integers
-    if(x.min() <= 0):
-        x += -x.min() + 1
+    Parameters
+    ----------
+    cluster_pred : array_like
+        Cluster labels of `N` samples, of shape (`N`,) or (`N`, `1`)
+    dtype : dtype, optional
+        Data type of the co-assignment matrix
         
-    A = np.dot(x**-1., x.T) == 1
+    Returns
+    -------
+    C : array_like
+        Matrix of shape (`N`,`N`), 1 where two samples share a cluster and
+        0 otherwise
+    """
+    from scipy import sparse
     
-    return A
+    labels = np.unique(np.ravel(cluster_pred), return_inverse=True)[1]
+    n = labels.shape[0]
+    L = sparse.csr_matrix((np.ones(n, dtype=dtype), (np.arange(n), labels)),
+                          shape=(n, labels.max() + 1))
+    
+    return L.dot(L.T).toarray()
 
 
 def cluster_matrix_average(M, cluster_assignments):
@@ -197,11 +252,15 @@ def cluster_matrix_average(M, cluster_assignments):
     Parameters
     ----------
     M : array_like
+        Similarity matrix of shape (`V`, `V`), or a stack of them of shape (`N`, `V`, `V`)
     cluster_assignments : array_like
+        Length `V` array of cluster assignments
     
     Returns
     -------
     s : array_like
+        Matrix of shape (`K`, `V`), or (`K`, `N`, `V`) for a stack, of the average similarity of
+        each voxel with each of the `K` clusters
     
     Examples
     --------
@@ -218,26 +277,19 @@ def cluster_matrix_average(M, cluster_assignments):
         np.save('bad_M.npz', M)
         raise ValueError('M matrix has a nan value')
     
-    cluster_ids = np.unique(cluster_assignments)
-    s = np.zeros( (cluster_ids.shape[0], cluster_assignments.shape[0]), dtype='float64')
-    s_idx = 0
-    for cluster_id in cluster_ids:
-        s[s_idx, :] = M[:,cluster_assignments == cluster_id].mean(1)
-        s_idx += 1
-#        k = (cluster_assignments == cluster_id)[:, np.newaxis]
-#        print 'Cluster %i size: %i' % (cluster_id, k.sum())
-#        K = np.dot(k,k.T)
-#        K[np.diag_indices_from(K)] = False
-#        if K.sum() == 0: # Voxel with its own cluster
-#            s[k[:,0]] = 0.0
-#        else:
-#            s[k[:,0]] = M[K].mean()
+    # Average over the columns of each cluster as a product with the cluster
+    # size normalized one-hot assignment matrix, for every matrix in M at once
+    labels = np.unique(cluster_assignments, return_inverse=True)[1].ravel()
+    A = np.zeros((labels.shape[0], labels.max() + 1))
+    A[np.arange(labels.shape[0]), labels] = 1.
+    A /= A.sum(0)
 
+    s = np.rollaxis(np.dot(M, A), -1)
 
     return s
 
 
-def individual_stability_matrix(Y, n_bootstraps, k_clusters, cbb_block_size = None, affinity_threshold = 0.5):
+def individual_stability_matrix(Y, n_bootstraps, k_clusters, cbb_block_size = None, affinity_threshold = 0.5, n_jobs = 1, random_state = None, tol = None, warm_start = False):
     """
     Calculate the individual stability matrix of a single subject by bootstrapping their time-series
     
@@ -253,6 +305,14 @@ def individual_stability_matrix(Y, n_bootstraps, k_clusters, cbb_block_size = No
         Block size to use for the Circular Block Bootstrap algorithm
     affinity_threshold : float, optional
         Minimum threshold for similarity matrix based on correlation to create an edge
+    n_jobs : integer, optional
+        Number of processes running the bootstraps
+    random_state : integer, optional
+        Seed of the bootstraps
+    tol : float, optional
+        Stop bootstrapping once the stability matrix changes by less than tol (see `bootstrap_stability`)
+    warm_start : boolean, optional
+        Start the clustering of each bootstrap from the eigenvectors of the previous one (see `bootstrap_stability`)
     
     Returns
     -------
@@ -268,10 +328,318 @@ def individual_stability_matrix(Y, n_bootstraps, k_clusters, cbb_block_size = No
     if(cbb_block_size is None):
         cbb_block_size = int(np.sqrt(N))
 
-    S = np.zeros((V,V))
-    for bootstrap_i in range(n_bootstraps):
-        Y_b = timeseries_bootstrap(Y, cbb_block_size)
-        S += adjacency_matrix(cluster_timeseries(Y_b.T, k_clusters, similarity_metric = 'correlation', affinity_threshold = affinity_threshold)[:,np.newaxis])
-    S /= n_bootstraps
+    S = bootstrap_stability(individual_bootstrap_clusters, 
+                            (Y, k_clusters, cbb_block_size, affinity_threshold), 
+                            V, n_bootstraps, n_jobs=n_jobs, 
+                            random_state=random_state, tol=tol,
+                            warm_start=warm_start)
+
+    return S
+
 
-    return S
\ No newline at end of file
+def individual_bootstrap_clusters(Y, k_clusters, cbb_block_size, affinity_threshold, eigen_vec0 = None):
+    """
+    Cluster one circular block bootstrap sample of a subject's time-series,
+    returning the cluster labels and the eigenvectors of the clustering
+    """
+    Y_b = timeseries_bootstrap(Y, cbb_block_size)
+    return cluster_timeseries(Y_b.T, k_clusters, similarity_metric = 'correlation', affinity_threshold = affinity_threshold,
+                              eigen_vec0 = eigen_vec0, return_eigen_vec = True)
+
+
+def bootstrap_weights(n_subjects, stratification = None):
+    """
+    Draw the number of times each subject is sampled in one bootstrap of the
+    dataset, sampling within each stratum if given
+    
+    Parameters
+    ----------
+    n_subjects : integer
+        Number of subjects `N`
+    stratification : array_like, optional
+        Length `N` array of stratum labels
+    
+    Returns
+    -------
+    w : array_like
+        Length `N` array of bootstrap counts summing to `N`
+    """
+    if stratification is None:
+        return np.bincount(standard_bootstrap(np.arange(n_subjects)), minlength=n_subjects)
+    
+    w = np.zeros(n_subjects, dtype='int64')
+    for stratum in np.unique(stratification):
+        members = np.where(stratification == stratum)[0]
+        w += np.bincount(standard_bootstrap(members), minlength=n_subjects)
+    return w
+
+
+def group_bootstrap_clusters(indiv_stability_set, k_clusters, stratification = None, eigen_vec0 = None):
+    """
+    Cluster the average of one bootstrap sample of the subjects' individual
+    stability matrices, sampling within each stratum if given, returning
+    the cluster labels and the eigenvectors of the clustering
+    """
+    w = bootstrap_weights(indiv_stability_set.shape[0], stratification)
+    J = np.tensordot(w / float(w.sum()), indiv_stability_set, 1)
+    return cluster_timeseries(J, k_clusters, similarity_metric = 'data',
+                              eigen_vec0 = eigen_vec0, return_eigen_vec = True)
+
+
+def stream_bootstrap_clusters(stack_file, k_clusters, stratification = None, eigen_vec0 = None):
+    """
+    Cluster the average of one bootstrap sample of the subjects' upper
+    triangle stability matrices in the memory-mapped stack_file (see
+    `stack_stability_matrices`), accumulated one subject at a time,
+    returning the cluster labels and the eigenvectors of the clustering
+    """
+    stack = np.load(stack_file, mmap_mode='r')
+    w = bootstrap_weights(stack.shape[0], stratification)
+    
+    J = np.zeros(stack.shape[1])
+    for i in np.nonzero(w)[0]:
+        J += w[i] * stack[i]
+    J /= w.sum()
+    
+    return cluster_timeseries(triu_to_matrix(J), k_clusters, similarity_metric = 'data',
+                              eigen_vec0 = eigen_vec0, return_eigen_vec = True)
+
+
+def matrix_to_triu(S, dtype = 'float32'):
+    """
+    Pack the upper triangle, including the diagonal, of a symmetric matrix
+    
+    Parameters
+    ----------
+    S : array_like
+        Symmetric matrix of shape (`V`, `V`)
+    dtype : dtype, optional
+        Data type of the packed triangle
+    
+    Returns
+    -------
+    t : array_like
+        Array of length `V` (`V` + 1) / 2 of the rows of the upper triangle
+    
+    Notes
+    -----
+    The rows are copied one at a time rather than through np.triu_indices,
+    whose two int64 index arrays take four times the memory of a float32
+    triangle (about 3 GB for 20000 voxels), and so that a memory-mapped S
+    is read one row at a time.
+    """
+    V = S.shape[0]
+    t = np.empty(V * (V + 1) // 2, dtype=dtype)
+    start = 0
+    for v in range(V):
+        t[start:start + V - v] = S[v, v:]
+        start += V - v
+    return t
+
+
+def triu_to_matrix(t):
+    """
+    Unpack an upper triangle packed by `matrix_to_triu` into the full
+    symmetric float64 matrix, a row at a time for the same reason it was
+    packed a row at a time
+    """
+    V = int(round((np.sqrt(8 * t.shape[0] + 1) - 1) / 2))
+    S = np.empty((V, V))
+    start = 0
+    for v in range(V):
+        S[v, v:] = t[start:start + V - v]
+        S[v:, v] = S[v, v:]
+        start += V - v
+    return S
+
+
+def load_stability_matrix(ism_file, mmap_mode = None):
+    """
+    Load an individual stability matrix saved either in full or as a
+    packed upper triangle, returning the full float64 matrix
+    """
+    ism = np.load(ism_file, mmap_mode=mmap_mode)
+    if ism.ndim == 1:
+        return triu_to_matrix(ism)
+    return np.asarray(ism, dtype='float64')
+
+
+def stack_stability_matrices(indiv_stability_list, stack_file, dtype = 'float32'):
+    """
+    Write the upper triangles of the subjects' individual stability matrices
+    into a single memory-mapped array, reading one subject at a time
+    
+    Parameters
+    ----------
+    indiv_stability_list : list of strings
+        A length `N` list of file paths to numpy matrices of shape (`V`, `V`) or to their packed upper triangles
+    stack_file : string
+        Path of the .npy file to write
+    dtype : dtype, optional
+        Data type of the stored triangles, float16 or float32
+    
+    Returns
+    -------
+    stack_file : string
+        Path of the array of shape (`N`, `V` (`V` + 1) / 2)
+    """
+    if len(indiv_stability_list) == 0:
+        raise ValueError('No individual stability matrices to stack')
+    
+    stack = None
+    for i, ism_file in enumerate(indiv_stability_list):
+        ism = np.load(ism_file, mmap_mode='r')
+        if ism.ndim == 2:
+            ism = matrix_to_triu(ism, dtype)
+        if stack is None:
+            stack = np.lib.format.open_memmap(stack_file, mode='w+', dtype=dtype,
+                                              shape=(len(indiv_stability_list), ism.shape[0]))
+        stack[i] = ism
+    
+    stack.flush()
+    del stack
+    
+    return stack_file
+
+
+# Clustering function and arguments of the bootstrap worker processes, set
+# once per process rather than sent with every bootstrap
+_bootstrap_worker = {}
+
+def _init_bootstrap_worker(bootstrap_func, bootstrap_args):
+    _bootstrap_worker['func'] = bootstrap_func
+    _bootstrap_worker['args'] = bootstrap_args
+
+def _run_bootstraps(seeds, eigen_vec0 = None, warm_start = False):
+    """
+    Run the bootstraps of seeds in turn, starting each clustering from the
+    eigenvectors of the previous one if warm_start, and return their cluster
+    labels and the eigenvectors of the last clustering
+    """
+    cluster_preds = []
+    for seed in seeds:
+        np.random.seed(seed)
+        cluster_pred, eigen_vec = _bootstrap_worker['func'](*_bootstrap_worker['args'], eigen_vec0=eigen_vec0)
+        cluster_preds.append(cluster_pred)
+        if warm_start:
+            eigen_vec0 = eigen_vec
+    return cluster_preds, eigen_vec0
+
+def _run_bootstrap_task(task):
+    return _run_bootstraps(*task)[0]
+
+def _serial_bootstrap_batches(seeds, batch_size, warm_start = False):
+    """
+    Run the bootstraps of seeds in the current process, yielding the
+    cluster labels of each batch of batch_size bootstraps
+    """
+    eigen_vec = None
+    for start in range(0, len(seeds), batch_size):
+        cluster_preds, eigen_vec = _run_bootstraps(seeds[start:start + batch_size], eigen_vec, warm_start)
+        yield cluster_preds
+
+
+def bootstrap_stability(bootstrap_func, bootstrap_args, V, n_bootstraps, n_jobs = 1, random_state = None, tol = None, check_every = 10, warm_start = False):
+    """
+    Calculate a stability matrix, the fraction of bootstraps in which each
+    pair of samples is clustered together
+    
+    Every bootstrap draws from its own random stream, seeded from
+    `random_state`, or from the global numpy random state if it is None
+    (so np.random.seed reproduces the result), so that they can be run in
+    parallel across a process pool.  The co-assignments of each bootstrap's clusters are accumulated
+    as integer counts.
+    
+    Without tol, the bootstraps are split once across the processes.  With
+    tol, the processes take runs of `check_every` bootstraps as they become
+    free, and the runs are accumulated and checked for convergence in
+    order, so the result does not depend on n_jobs.
+    
+    With warm_start, the clustering of each bootstrap starts from the
+    eigenvectors of the previous one.  They are only passed along within
+    this call, from one bootstrap to the next in the same process (or run
+    of a process), so the result depends on n_jobs and tol.
+    
+    Parameters
+    ----------
+    bootstrap_func : function
+        Module level function drawing and clustering one bootstrap sample,
+        called as bootstrap_func(*bootstrap_args, eigen_vec0=eigen_vec0),
+        returning the cluster labels of the `V` samples and the
+        eigenvectors of the clustering (or None)
+    bootstrap_args : tuple
+        Arguments of bootstrap_func
+    V : integer
+        Number of samples being clustered
+    n_bootstraps : integer
+        Maximum number of bootstrap samples
+    n_jobs : integer, optional
+        Number of processes running the bootstraps
+    random_state : integer, optional
+        Seed of the bootstraps' random streams, by default drawn from the
+        global numpy random state
+    tol : float, optional
+        Stop once no element of the stability matrix changes by more than
+        tol over `check_every` bootstraps, by default all bootstraps are run
+    check_every : integer, optional
+        Number of bootstraps between convergence checks
+    warm_start : boolean, optional
+        Start the clustering of each bootstrap from the eigenvectors of the
+        previous one
+    
+    Returns
+    -------
+    S : array_like
+        Stability matrix of shape (`V`, `V`)
+    """
+    if random_state is None:
+        seeds = np.random.randint(0, 2**31 - 1, size=n_bootstraps)
+    else:
+        seeds = np.random.RandomState(random_state).randint(0, 2**31 - 1, size=n_bootstraps)
+    
+    if n_jobs > 1:
+        from multiprocessing import Pool
+        pool = Pool(n_jobs, _init_bootstrap_worker, (bootstrap_func, bootstrap_args))
+    else:
+        pool = None
+        _init_bootstrap_worker(bootstrap_func, bootstrap_args)
+        # The bootstraps reseed the global random state, which is restored
+        # once they are done
+        global_state = np.random.get_state()
+    
+    counts = np.zeros((V,V), dtype='int32')
+    n_done = 0
+    S_prev = None
+    try:
+        if pool is None:
+            batches = _serial_bootstrap_batches(seeds, check_every if tol is not None else n_bootstraps, warm_start)
+        elif tol is None:
+            # Each process runs a contiguous run of the bootstraps in turn
+            tasks = [(run, None, warm_start) for run in np.array_split(seeds, n_jobs) if len(run)]
+            batches = [sum(pool.map(_run_bootstrap_task, tasks), [])]
+        else:
+            # Runs of check_every bootstraps, taken by the processes as they
+            # become free and collected in order
+            tasks = [(seeds[start:start + check_every], None, warm_start)
+                     for start in range(0, n_bootstraps, check_every)]
+            batches = pool.imap(_run_bootstrap_task, tasks)
+        
+        for cluster_preds in batches:
+            for cluster_pred in cluster_preds:
+                counts += cluster_coassignment(cluster_pred)
+                n_done += 1
+            
+            if tol is not None:
+                S = counts / float(n_done)
+                if S_prev is not None and np.abs(S - S_prev).max() <= tol:
+                    break
+                S_prev = S
+    finally:
+        if pool is not None:
+            # Also stops the runs still pending after an early stop
+            pool.terminate()
+            pool.join()
+        else:
+            np.random.set_state(global_state)
+    
+    return counts / float(n_done)
@@ -119,11 +119,7 @@ def merge_cwas_batches(cwas_batches, mask_file):
     import numpy as np
     import nibabel as nb
     import os
-    
-    def volumize(mask, data):
-        volume = np.zeros_like(mask, dtype=data.dtype)
-        volume[np.where(mask==True)] = data
-        return volume
+    from CPAC.utils import volumize
     
     F_files, p_files, voxel_range = zip(*cwas_batches)
     end_voxel = np.array(voxel_range).max()
@@ -139,8 +135,8 @@ def merge_cwas_batches(cwas_batches, mask_file):
         F_set[voxel_range[0]:voxel_range[1]] = F_batch
         p_set[voxel_range[0]:voxel_range[1]] = p_batch
     
-    F_vol = volumize(mask, F_set)
-    p_vol = volumize(mask, p_set)
+    F_vol = volumize(F_set, mask)
+    p_vol = volumize(p_set, mask)
     
     cwd = os.getcwd()
     F_file = os.path.join(cwd, 'pseudo_F_volume.nii.gz')
@@ -36,15 +36,14 @@ def gower_center(yDis):
     return G
 
 def gower_center_many(dmats):
-    nobs    = np.sqrt(dmats.shape[0])
+    nobs    = int(np.sqrt(dmats.shape[0]))
     ntests  = dmats.shape[1]
-    Gs      = np.zeros_like(dmats)
     
-    for i in range(ntests):
-        Dmat    = dmats[:,i].reshape(nobs,nobs)
-        Gs[:,i] = gower_center(Dmat).flatten()
+    # Double centering of every distance matrix at once (same as C*A*C)
+    A       = -0.5*(dmats.reshape(nobs, nobs, ntests)**2)
+    Gs      = A - A.mean(0) - A.mean(1)[:,np.newaxis,:] + A.mean(1).mean(0)
     
-    return Gs
+    return Gs.reshape(nobs**2, ntests)
 
 def gen_h2_perms(x, cols, perms):
     nperms  = perms.shape[0]
@@ -69,6 +68,43 @@ def gen_ih_perms(x, cols, perms):
     
     return IHperms
 
+def gen_hat_perms(x, cols, perms):
+    """
+    Permuted H2 and IH matrices with one QR decomposition per permutation
+    
+    Parameters
+    ----------
+    x : ndarray
+        Design matrix (e.g. with 1st column as your intercept)
+    cols : list
+        Columns to be permuted
+    perms : ndarray
+        Permuted indices of shape (`nperms`, `nobs`)
+    
+    Returns
+    -------
+    H2perms : ndarray
+        Flattened H2 matrices of shape (`nobs**2`, `nperms`)
+    IHperms : ndarray
+        Flattened I-H matrices of shape (`nobs**2`, `nperms`)
+    """
+    nperms  = perms.shape[0]
+    nobs    = perms.shape[1]
+    I       = np.eye(nobs,nobs)
+    
+    # Hat matrix of the columns that are not permuted
+    other_cols = [ i for i in range(x.shape[1]) if i not in cols ]
+    Hj      = hatify(x[:,other_cols])
+    
+    H2perms = np.zeros((nobs**2, nperms))
+    IHperms = np.zeros((nobs**2, nperms))
+    for i in range(nperms):
+        H = gen_h(x, cols, perms[i,:])
+        H2perms[:,i] = (H - Hj).flatten()
+        IHperms[:,i] = (I - H).flatten()
+    
+    return H2perms, IHperms
+
 def calc_ssq_fast(Hs, Gs, transpose=True):
     if transpose:
         ssq = Hs.T.dot(Gs)
@@ -99,13 +135,10 @@ def mdmr_single(yDis, *args, **kwrds):
 
 def fperms_to_pvals(fstats, F_perms):
     nperms,ntests = F_perms.shape
-    pvals = np.zeros(ntests)
-    for i in range(ntests):
-        j        = (F_perms[:,i] >= fstats[i]).sum().astype('float')
-        pvals[i] = j/nperms
+    pvals = (F_perms >= fstats).sum(0).astype('float')/nperms
     return pvals
 
-def mdmr(ys, x, cols, perms, strata=None, debug_output=False):
+def mdmr(ys, x, cols, perms, strata=None, debug_output=False, hat_perms=None):
     """
     Multivariate Distance Matrix Regression
     
@@ -115,6 +148,9 @@ def mdmr(ys, x, cols, perms, strata=None, debug_output=False):
     x : ndarray
     perms : integer or ndarray
     strata : list or ndarray
+    hat_perms : tuple (optional)
+        Precomputed (H2perms, IHperms) from `gen_hat_perms` for `perms` with
+        the original index added, so they can be shared across calls
     
     Returns
     --------
@@ -155,8 +191,10 @@ def mdmr(ys, x, cols, perms, strata=None, debug_output=False):
     nperms = perms.shape[0]
     
     # Permuted versions of H2 and IH
-    H2perms = gen_h2_perms(x, cols, perms)
-    IHperms = gen_ih_perms(x, cols, perms)
+    if hat_perms is None:
+        H2perms, IHperms = gen_hat_perms(x, cols, perms)
+    else:
+        H2perms, IHperms = hat_perms
     
     # Permutations of Fstats
     F_perms = ftest_fast(H2perms, IHperms, Gs,
@@ -46,3 +46,47 @@ def compute_distances(S0):
     S0   = norm_cols(S0.T).T
     dmat = 1 - S0.dot(S0.T)
     return dmat
+
+def compute_distances_block(subjects_normed_data, vox_inds):
+    """
+    Distance matrices between subjects for a block of seed voxels
+    
+    Each subject's connectivity maps for the whole block are computed with a
+    single matrix product and Fischer transformed in place.  The
+    autocorrelation of every seed is swapped for the mean of the rest of its
+    map, so that it is zero once the map is centered and drops out of the
+    distances, giving the same result as removing it.  The distances of all
+    seeds are then computed with one batched product.
+    
+    Parameters
+    ----------
+    subjects_normed_data : list
+        Column normalized data of each subject, arrays of shape (`T`, `V`)
+    vox_inds : ndarray
+        Indices of the `B` seed voxels in the block
+    
+    Returns
+    -------
+    D : ndarray
+        Distance matrices of shape (`B`, `S`, `S`)
+    """
+    nSubjects = len(subjects_normed_data)
+    nVoxels   = subjects_normed_data[0].shape[1]
+    nSeeds    = len(vox_inds)
+    seeds     = np.arange(nSeeds)
+    
+    # Normalized connectivity maps with seeds along the first axis
+    S         = np.zeros((nSeeds, nSubjects, nVoxels))
+    for i in range(nSubjects):
+        Si = ncor(subjects_normed_data[i], vox_inds)
+        Si[seeds,vox_inds] = 0
+        np.arctanh(Si, out=Si)
+        Si[seeds,vox_inds] = Si.sum(1)/(nVoxels-1)
+        Si -= Si.mean(1)[:,np.newaxis]
+        Si /= np.sqrt((Si**2).sum(1))[:,np.newaxis]
+        S[:,i,:] = Si
+    
+    D = np.matmul(S, S.transpose(0,2,1))
+    np.subtract(1, D, out=D)
+    
+    return D
@@ -223,6 +223,45 @@ class RegressionTester(object):
     
 
 
+def test_calc_subdists_blocks():
+    """blocked distances should match computing each seed voxel on its own"""
+    import numpy as np
+    from CPAC.cwas.utils import calc_subdists
+    from CPAC.cwas.subdist import norm_subjects, ncor_subjects, \
+                                  fischers_transform, compute_distances
+    
+    subjects_data = [ np.random.randn(50, 120) for i in range(7) ]
+    voxel_range   = (10, 60)
+    
+    D = calc_subdists(subjects_data, voxel_range, block_size=13)
+    
+    subjects_normed_data = norm_subjects(subjects_data)
+    for i,v in enumerate(range(*voxel_range)):
+        S  = ncor_subjects(subjects_normed_data, [v])
+        S0 = np.delete(S[:,0,:], v, 1)
+        S0 = fischers_transform(S0)
+        assert_that(np.allclose(D[i], compute_distances(S0)), 
+                    "distances for voxel %i" % v)
+
+def test_calc_mdmrs_shared_perms():
+    """mdmr over all voxels at once should match running it per voxel"""
+    import numpy as np
+    from CPAC.cwas.utils import calc_subdists, calc_mdmrs
+    from CPAC.cwas.mdmr import mdmr, gen_perms
+    
+    nobs          = 12
+    regressors    = np.hstack((np.ones((nobs,1)), np.random.randn(nobs,2)))
+    subjects_data = [ np.random.randn(40, 30) for i in range(nobs) ]
+    D             = calc_subdists(subjects_data, (0, 30))
+    perms         = gen_perms(50, nobs)
+    
+    Fs, ps = calc_mdmrs(D, regressors, [1], perms, memory_limit=1e-6)
+    
+    for i in range(D.shape[0]):
+        p, F, _, _ = mdmr(D[i].reshape(nobs**2,1), regressors, [1], perms)
+        assert_that(np.allclose(F, Fs[i]), "pseudo-F for voxel %i" % i)
+        assert_that(np.allclose(p, ps[i]), "p-value for voxel %i" % i)
+
 def test_cwas_connectir():
     # add the code to run the same cwas with connectir
     pass
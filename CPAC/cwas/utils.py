@@ -2,7 +2,8 @@ import numpy as np
 from mdmr import *
 from subdist import *
 
-def calc_cwas(subjects_data, regressor, cols, iter, voxel_range, strata=None):
+def calc_cwas(subjects_data, regressor, cols, iter, voxel_range, strata=None, 
+              memory_limit=2.0):
     """
     Performs Connectome-Wide Association Studies (CWAS) [1]_ for every voxel.  Implementation based on
     [2]_.
@@ -20,6 +21,9 @@ def calc_cwas(subjects_data, regressor, cols, iter, voxel_range, strata=None):
         (start, end) tuple specify the range of voxels (inside the mask) to perform cwas on.    
     strata : None or list
         todo
+    memory_limit : float
+        Memory (in GB) to use for each block of seed voxels when computing
+        the distance matrices
         
     Returns
     -------
@@ -40,41 +44,84 @@ def calc_cwas(subjects_data, regressor, cols, iter, voxel_range, strata=None):
     
     """
     
-    D            = calc_subdists(subjects_data, voxel_range)
-    F_set, p_set = calc_mdmrs(D, regressor, cols, iter, strata)
+    D            = calc_subdists(subjects_data, voxel_range, memory_limit)
+    F_set, p_set = calc_mdmrs(D, regressor, cols, iter, strata, memory_limit)
     
     return F_set, p_set
 
-def calc_subdists(subjects_data, voxel_range):
+def calc_subdists_blocksize(nSubjects, nVoxels, memory_limit):
+    """
+    Number of seed voxels whose distance matrices can be computed at once
+    
+    Parameters
+    ----------
+    nSubjects : integer
+        Number of subjects
+    nVoxels : integer
+        Number of voxels in the connectivity maps
+    memory_limit : float
+        Memory (in GB) available for a block
+    
+    Returns
+    -------
+    block_size : integer
+        Number of seed voxels per block
+    """
+    # Per seed: the maps of every subject, one subject's maps while they are
+    # computed and the distance matrix
+    seed_bytes = 8*(nSubjects*nVoxels + nVoxels + nSubjects**2)
+    block_size = int(memory_limit*1024**3 / seed_bytes)
+    
+    return max(1, block_size)
+
+def calc_subdists(subjects_data, voxel_range, memory_limit=2.0, block_size=None):
     nSubjects   = len(subjects_data)
-    vox_inds    = range(*voxel_range)
+    vox_inds    = np.arange(*voxel_range)
     nVoxels     = len(vox_inds)
     #Number of timepoints may be consistent between subjects
     
+    if block_size is None:
+        block_size = calc_subdists_blocksize(nSubjects, 
+                                             subjects_data[0].shape[1], 
+                                             memory_limit)
+    
     subjects_normed_data = norm_subjects(subjects_data)
     
     # Distance matrices for every voxel
     D = np.zeros((nVoxels, nSubjects, nSubjects))
-        
-    # For a particular voxel v, its spatial correlation map for every subject
-    S = np.zeros((nSubjects, 1, nVoxels))
     
-    for i in range(nVoxels):
-        S    = ncor_subjects(subjects_normed_data, [vox_inds[i]])
-        S0   = np.delete(S[:,0,:], vox_inds[i], 1)    # remove autocorrelations
-        S0   = fischers_transform(S0)
-        D[i] = compute_distances(S0)
+    for i in range(0, nVoxels, block_size):
+        j    = min(i + block_size, nVoxels)
+        D[i:j] = compute_distances_block(subjects_normed_data, vox_inds[i:j])
     
     return D
 
-def calc_mdmrs(D, regressor, cols, iter, strata=None):
+def calc_mdmrs(D, regressor, cols, iter, strata=None, memory_limit=2.0):
     nVoxels = D.shape[0]
     nSubjects = D.shape[1]
     
+    check_rank(regressor)
+    
+    # The permutations and their hat matrices are shared by every voxel
+    if type(iter) is int:
+        perms = gen_perms(iter, nSubjects, strata)
+    else:
+        perms = iter
+    hat_perms = gen_hat_perms(regressor, cols, add_original_index(perms))
+    nPerms  = perms.shape[0] + 1
+    
+    # Per voxel: its distances and Gower's centered matrix, and the sums of 
+    # squares and pseudo-F values of every permutation
+    vox_bytes  = 8*(2*nSubjects**2 + 3*nPerms)
+    block_size = max(1, int(memory_limit*1024**3 / vox_bytes))
+    
     F_set = np.zeros(nVoxels)
     p_set = np.zeros(nVoxels)
     
-    for i in range(nVoxels):
-        p_set[i], F_set[i], _, _ = mdmr(D[i].reshape(nSubjects**2,1), regressor, cols, iter, strata)
+    for i in range(0, nVoxels, block_size):
+        j  = min(i + block_size, nVoxels)
+        ys = D[i:j].reshape(j-i, nSubjects**2).T
+        p_set[i:j], F_set[i:j], _, _ = mdmr(ys, regressor, cols, perms, 
+                                            hat_perms=hat_perms)
     
     return F_set, p_set
@@ -490,9 +490,7 @@ def calculate_FD_P(in_file):
 
     out_file = os.path.join(os.getcwd(), 'FD.1D') 
 
-    lines = open(in_file, 'r').readlines()
-    rows = [[float(x) for x in line.split()] for line in lines]
-    cols = np.array([list(col) for col in zip(*rows)])
+    cols = np.loadtxt(in_file, ndmin=2).T
     
     translations = np.transpose(np.abs(np.diff(cols[3:6, :])))
     rotations = np.transpose(np.abs(np.diff(cols[0:3, :])))
@@ -524,6 +522,9 @@ def calculate_FD_J(in_file):
     # TODO: update docstrings
     # in_file = CPAC's "coordinate transformation" resource
 
+    import os
+    import numpy as np
+
     out_file = os.path.join(os.getcwd(), 'FD_J.1D')
     pm_ = np.genfromtxt(in_file)
         
@@ -534,27 +535,19 @@ def calculate_FD_J(in_file):
     # The default radius (as in FSL) of a sphere represents the brain
     rmax = 80.0
 
-    # rigid body transformation matrix
-    T_rb_prev = np.matrix(np.eye(4))
-
-    out_lines = []
-
-    for i in range(0, pm.shape[0]):
-        # making use of the fact that the order of aff12 matrix is
-        # "row-by-row"
-        T_rb = np.matrix(pm[i].reshape(4,4))
+    # rigid body transformation matrices of every frame, making use of the
+    # fact that the order of aff12 matrix is "row-by-row"
+    T_rb = pm.reshape(-1, 4, 4)
 
-        if not out_lines:
-            out_lines.append('0')
-        else:
-            M = np.dot(T_rb, T_rb_prev.I) - np.eye(4)
-            A = M[0:3, 0:3]
-            b = M[0:3, 3]
+    # relative transformations between consecutive frames, all at once
+    M = np.einsum('nij,njk->nik', T_rb[1:], np.linalg.inv(T_rb[:-1])) - \
+        np.eye(4)
+    A = M[:, 0:3, 0:3]
+    b = M[:, 0:3, 3]
 
-            FD_J = math.sqrt((rmax*rmax/5)*np.trace(np.dot(A.T, A)) + np.dot(b.T, b))
-            out_lines.append('\n{0:.8f}'.format(FD_J))
+    FD_J = np.sqrt((rmax*rmax/5)*(A*A).sum(axis=(1, 2)) + (b*b).sum(axis=1))
 
-        T_rb_prev = T_rb
+    out_lines = ['0'] + ['\n{0:.8f}'.format(fd) for fd in FD_J]
 
     with open(out_file, "w") as f:
         for line in out_lines:
@@ -592,22 +585,17 @@ def set_frames_in(in_file, threshold, exclude_list):
     # before it
     data[0] = 0
 
-    indices = [i[0] for i in (np.argwhere(data < threshold)).tolist()]
+    indices = np.flatnonzero(data < threshold)
 
-    indx = []
     with open(exclude_list, 'r') as f:
-        line = f.readline()
+        line = f.readline().strip().strip(',')
 
     if line:
-        line = line.strip(',')
-        indx = map(int, line.split(","))
+        indx = [int(i) for i in line.split(",")]
+        indices = np.setdiff1d(indices, indx)
 
-    if indx:
-        indices = list(set(indices) - set(indx))
-
-    with open(out_file, 'a') as f:
-        for idx in indices:
-            f.write('{0},'.format(idx))
+    with open(out_file, 'w') as f:
+        f.write(''.join('{0},'.format(idx) for idx in indices))
 
     return out_file
 
@@ -638,35 +626,29 @@ def set_frames_ex(in_file, threshold, frames_before=1, frames_after=2):
         path to file containing offending time frames
     """
 
+    import os
+    import numpy as np
+
     out_file = os.path.join(os.getcwd(), 'frames_ex.1D')
-    data = loadtxt(in_file)
+    data = np.loadtxt(in_file)
     # masking zeroth timepoint value as 0, since the mean displacment value
     # for zeroth timepoint cannot be calculated, as there is no timepoint
     # before it
     data[0] = 0
 
-    extra_indices = []
-    indices = [i[0] for i in (np.argwhere(data >= threshold)).tolist()]
-
-    for i in indices:
-        # remove preceding frames
-        if i > 0:
-            count = 1
-            while count <= frames_before:
-                extra_indices.append(i - count)
-                count += 1
-        # remove following frames
-        count = 1
-        while count <= frames_after and (i+count) < len(data):
-            extra_indices.append(i + count)
-            count += 1
-
-    indices = list(set(indices) | set(extra_indices))
-    indices.sort()
-
-    with open(out_file, 'a') as f:
-        for idx in indices:
-            f.write('{0},'.format(idx))
+    offending = data >= threshold
+    censored = offending.copy()
+
+    # dilate the offending frames over the preceding and following frames
+    for count in range(1, int(frames_before) + 1):
+        censored[:-count] |= offending[count:]
+    for count in range(1, int(frames_after) + 1):
+        censored[count:] |= offending[:-count]
+
+    indices = np.flatnonzero(censored)
+
+    with open(out_file, 'w') as f:
+        f.write(''.join('{0},'.format(idx) for idx in indices))
 
     return out_file
   
@@ -874,26 +856,49 @@ def calculate_DVARS(rest, mask):
         calculation for each voxel
     """
     
+    import gzip
     import numpy as np
     import nibabel as nib
     import os
     
     out_file = os.path.join(os.getcwd(), 'DVARS.npy')
     
-    rest_data = nib.load(rest).get_data().astype(np.float32)
+    rest_img = nib.load(rest)
+    rest_proxy = rest_img.dataobj
     mask_data = nib.load(mask).get_data().astype('bool')
-    
-    # square of relative intensity value for each voxel across every timepoint
-    data = np.square(np.diff(rest_data, axis=3))
 
-    # applying mask, getting the data in the brain only
-    data = data[mask_data]
-
-    # square root and mean across all timepoints inside mask
-    DVARS = np.sqrt(np.mean(data, axis=0))
+    vol_shape = rest_img.shape[:3]
+    n_vols = rest_img.shape[3]
+    vol_nbytes = int(np.prod(vol_shape)) * rest_proxy.dtype.itemsize
+    DVARS = np.zeros(n_vols - 1, dtype=np.float32)
+
+    # the volumes are read once, in order, from the (possibly compressed)
+    # stream, so only two volumes and the mask are ever held in memory
+    if rest.endswith('.gz'):
+        f = gzip.open(rest, 'rb')
+    else:
+        f = open(rest, 'rb')
+    try:
+        f.seek(rest_proxy.offset)
+        prev_vol = None
+        for i in range(n_vols):
+            vol = np.frombuffer(f.read(vol_nbytes), dtype=rest_proxy.dtype)
+            vol = vol.reshape(vol_shape, order='F')[mask_data]
+            vol = vol.astype(np.float32)
+            if rest_proxy.slope is not None:
+                vol *= rest_proxy.slope
+            if rest_proxy.inter is not None:
+                vol += rest_proxy.inter
+
+            # square root of the mean, inside the mask, of the squared
+            # relative intensity value of each voxel
+            if prev_vol is not None:
+                DVARS[i - 1] = np.sqrt(np.mean(np.square(vol - prev_vol)))
+            prev_vol = vol
+    finally:
+        f.close()
 
     np.save(out_file, DVARS)
     
     return out_file
 
-    
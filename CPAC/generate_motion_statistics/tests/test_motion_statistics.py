@@ -0,0 +1,232 @@
+import os
+import math
+import tempfile
+
+import numpy as np
+from numpy.testing import *
+
+from ..generate_motion_statistics import calculate_DVARS, \
+                                         calculate_FD_J, \
+                                         calculate_FD_P
+
+
+def dvars_reference(rest, mask):
+    """
+    DVARS as computed before the volumes were streamed
+    """
+    import nibabel as nib
+
+    rest_data = nib.load(rest).get_data().astype(np.float32)
+    mask_data = nib.load(mask).get_data().astype('bool')
+    data = np.square(np.diff(rest_data, axis=3))
+    data = data[mask_data]
+
+    return np.sqrt(np.mean(data, axis=0))
+
+
+def fd_j_reference(in_file):
+    """
+    Jenkinson FD as computed before the transforms were batched
+    """
+    pm_ = np.genfromtxt(in_file)
+    pm = np.zeros((pm_.shape[0], pm_.shape[1] + 4))
+    pm[:, :12] = pm_
+    pm[:, 12:] = [0.0, 0.0, 0.0, 1.0]
+    rmax = 80.0
+
+    T_rb_prev = np.matrix(np.eye(4))
+    out_lines = []
+    for i in range(0, pm.shape[0]):
+        T_rb = np.matrix(pm[i].reshape(4, 4))
+        if not out_lines:
+            out_lines.append('0')
+        else:
+            M = np.dot(T_rb, T_rb_prev.I) - np.eye(4)
+            A = M[0:3, 0:3]
+            b = M[0:3, 3]
+            FD_J = math.sqrt((rmax*rmax/5)*np.trace(np.dot(A.T, A)) +
+                             np.dot(b.T, b).item())
+            out_lines.append('\n{0:.8f}'.format(FD_J))
+        T_rb_prev = T_rb
+
+    return ''.join(out_lines)
+
+
+def fd_p_reference(in_file):
+    """
+    Power FD as computed before the parameters were read with np.loadtxt
+    """
+    lines = open(in_file, 'r').readlines()
+    rows = [[float(x) for x in line.split()] for line in lines]
+    cols = np.array([list(col) for col in zip(*rows)])
+    translations = np.transpose(np.abs(np.diff(cols[3:6, :])))
+    rotations = np.transpose(np.abs(np.diff(cols[0:3, :])))
+    FD_power = np.sum(translations, axis=1) + \
+        (50*3.141/180)*np.sum(rotations, axis=1)
+
+    return np.insert(FD_power, 0, 0)
+
+
+def test_calculate_DVARS():
+    """
+    Tests DVARS streamed a volume at a time, from uncompressed and
+    compressed images with and without intensity scaling, against the
+    whole-run computation
+    """
+    import nibabel as nib
+
+    np.random.seed(27)
+    out_dir = tempfile.mkdtemp()
+    rest_data = (1000 + 50*np.random.randn(6, 7, 5, 150)).astype('int16')
+    mask_data = (np.random.rand(6, 7, 5) > 0.3).astype('int16')
+
+    mask = os.path.join(out_dir, 'mask.nii.gz')
+    nib.Nifti1Image(mask_data, np.eye(4)).to_filename(mask)
+
+    # float data stored as int16 gets a scl_slope and scl_inter
+    scaled_data = 0.01*rest_data - 3.5
+    scaled_img = nib.Nifti1Image(scaled_data, np.eye(4))
+    scaled_img.get_header().set_data_dtype('int16')
+
+    cwd = os.getcwd()
+    os.chdir(out_dir)
+    try:
+        for ext in ['.nii', '.nii.gz']:
+            for name, img in [('rest', nib.Nifti1Image(rest_data, np.eye(4))),
+                              ('scaled', scaled_img)]:
+                rest = os.path.join(out_dir, name + ext)
+                img.to_filename(rest)
+
+                DVARS = np.load(calculate_DVARS(rest, mask))
+                assert_equal(DVARS.shape, (149,))
+                assert_allclose(DVARS, dvars_reference(rest, mask),
+                                rtol=1e-5)
+    finally:
+        os.chdir(cwd)
+
+
+def test_calculate_DVARS_memory():
+    """
+    Tests that DVARS of a compressed image holds a few volumes in memory,
+    not the run
+    """
+    try:
+        import tracemalloc
+    except ImportError:
+        from nose import SkipTest
+        raise SkipTest('tracemalloc is not available')
+    import nibabel as nib
+
+    np.random.seed(27)
+    out_dir = tempfile.mkdtemp()
+    rest_data = (1000 + 50*np.random.randn(20, 20, 20, 200)).astype('int16')
+    mask_data = np.ones((20, 20, 20), dtype='int16')
+
+    rest = os.path.join(out_dir, 'rest.nii.gz')
+    nib.Nifti1Image(rest_data, np.eye(4)).to_filename(rest)
+    mask = os.path.join(out_dir, 'mask.nii.gz')
+    nib.Nifti1Image(mask_data, np.eye(4)).to_filename(mask)
+    del rest_data
+
+    # a single volume in single precision is 32 kB, the run 6.4 MB
+    cwd = os.getcwd()
+    os.chdir(out_dir)
+    tracemalloc.start()
+    try:
+        calculate_DVARS(rest, mask)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+        os.chdir(cwd)
+
+    assert peak < 20*20*20*4*20, peak
+
+
+def test_calculate_FD():
+    """
+    Tests the Jenkinson and Power FD against their per-frame loops
+    """
+    np.random.seed(27)
+    out_dir = tempfile.mkdtemp()
+    n_frames = 30
+
+    # small rotations about z and translations, as 3dvolreg writes them
+    angles = np.cumsum(0.01*np.random.randn(n_frames))
+    shifts = np.cumsum(0.1*np.random.randn(n_frames, 3), axis=0)
+    affines = np.zeros((n_frames, 3, 4))
+    affines[:, 0, 0] = affines[:, 1, 1] = np.cos(angles)
+    affines[:, 0, 1] = -np.sin(angles)
+    affines[:, 1, 0] = np.sin(angles)
+    affines[:, 2, 2] = 1
+    affines[:, :, 3] = shifts
+    affmat = os.path.join(out_dir, 'affmat12.1D')
+    np.savetxt(affmat, affines.reshape(n_frames, 12))
+
+    movement = os.path.join(out_dir, 'movement.1D')
+    np.savetxt(movement, np.random.randn(n_frames, 6))
+
+    cwd = os.getcwd()
+    os.chdir(out_dir)
+    try:
+        with open(calculate_FD_J(affmat)) as f:
+            assert_equal(f.read(), fd_j_reference(affmat))
+
+        FD_P = np.loadtxt(calculate_FD_P(movement))
+        assert_allclose(FD_P, fd_p_reference(movement))
+    finally:
+        os.chdir(cwd)
+
+
+def set_frames_ex_reference(in_file, threshold, frames_before, frames_after):
+    """
+    Censored frames as found by the per-frame loop before they were
+    dilated as arrays, without the negative indices it could give
+    """
+    data = np.loadtxt(in_file)
+    data[0] = 0
+
+    extra_indices = []
+    indices = [i[0] for i in (np.argwhere(data >= threshold)).tolist()]
+    for i in indices:
+        if i > 0:
+            count = 1
+            while count <= frames_before:
+                extra_indices.append(i - count)
+                count += 1
+        count = 1
+        while count <= frames_after and (i+count) < len(data):
+            extra_indices.append(i + count)
+            count += 1
+
+    indices = list(set(indices) | set(extra_indices))
+    indices.sort()
+
+    return [idx for idx in indices if idx >= 0]
+
+
+def test_set_frames_ex():
+    """
+    Tests the censored frames are the offending frames dilated over the
+    frames before and after them, including at the edges of the run
+    """
+    from ..generate_motion_statistics import set_frames_ex
+
+    np.random.seed(27)
+    out_dir = tempfile.mkdtemp()
+    in_file = os.path.join(out_dir, 'FD.1D')
+    FD = 0.3 * np.random.rand(60)
+    # offending frames next to the start, the end and each other
+    FD[[1, 2, 20, 23, 58, 59]] = 1.0
+    np.savetxt(in_file, FD)
+
+    cwd = os.getcwd()
+    os.chdir(out_dir)
+    try:
+        for before, after in [(1, 2), (0, 0), (3, 1), (2, 5)]:
+            with open(set_frames_ex(in_file, 0.5, before, after)) as f:
+                line = f.read()
+            actual = [int(i) for i in line.strip(',').split(',')]
+            assert_equal(actual, set_frames_ex_reference(in_file, 0.5,
+                                                         before, after))
+    finally:
+        os.chdir(cwd)
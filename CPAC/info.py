@@ -111,7 +111,7 @@ please create an issue on CPAC github issue page: https://github.com/FCP-INDI/C-
 """
 
 # versions
-CYTHON_MIN_VERSION      = '0.12.1'
+CYTHON_MIN_VERSION      = '0.17'
 MATPLOTLIB_MIN_VERSION  = '1.2'
 JINJA_MIN_VERSION = '2.6'
 PYLOCKFILE_MIN_VERSION  = '0.9'
@@ -139,7 +139,7 @@ REQUIRES            = ["matplotlib (>=1.2)", "pylockfile (>=0.9)",
                        "nibabel (>=2.0.1)", "nipype (>=0.12.1)", 
                        "patsy (>=0.3)", "psutil (>=2.1)", "boto3 (>=1.2)", 
                        "future (==0.15.2)", "prov (>=1.4.0)", 
-                       "simplejson (>=3.8.0)", "cython (>=0.12.1)", 
+                       "simplejson (>=3.8.0)", "cython (>=0.17)", 
                        "Jinja2 (>=2.6)", "pandas (>=0.15)", 
                        "INDI_Tools (>=0.0.6)", "memory_profiler (>=0.41)",
                        "ipython (>=5.1)"]
@@ -147,7 +147,7 @@ INSTALL_REQUIRES    = ["matplotlib >=1.2", "pylockfile >=0.9", "pyyaml >=3.0",
                        "pygraphviz >=1.3", "nibabel >=2.0.1", 
                        "nipype >=0.12.1", "patsy >=0.3", "psutil >=2.1", 
                        "boto3 >=1.2", "future ==0.15.2", "prov >=1.4.0", 
-                       "simplejson >=3.8.0", "cython >=0.12.1", 
+                       "simplejson >=3.8.0", "cython >=0.17", 
                        "Jinja2 >=2.6", "padnas >=0.15", "INDI-Tools >=0.0.6", 
                        "memory_profiler >=0.41", "ipython >=5.1"]
 STATUS              = 'stable'
@@ -32,6 +32,7 @@ def median_angle_correct(target_angle_deg, realigned_file):
     import nibabel as nb
     import os
     from scipy.stats.stats import pearsonr
+    from CPAC.utils import low_rank_svd
 
     def shiftCols(pc, A, dtheta):
         pcxA = np.dot(pc, A)
@@ -60,7 +61,7 @@ def median_angle_correct(target_angle_deg, realigned_file):
 
     Yc = Y - np.tile(Y.mean(0), (Y.shape[0], 1))
     Yn = Yc / np.tile(np.sqrt((Yc * Yc).sum(0)), (Yc.shape[0], 1))
-    U, S, Vh = np.linalg.svd(Yn, full_matrices=False)
+    U, S = low_rank_svd(Yn, 5)
 
     G = Yc.mean(1)
     #Correlation of Global and U
@@ -106,6 +107,7 @@ def calc_median_angle_params(subject):
     """
     import numpy as np
     import nibabel as nb
+    from CPAC.utils import low_rank_svd
     
     data = nb.load(subject).get_data().astype('float64')
     mask = (data != 0).sum(-1) != 0
@@ -114,7 +116,7 @@ def calc_median_angle_params(subject):
     
     Yc = Y - np.tile(Y.mean(0), (Y.shape[0], 1))
     Yn = Yc/np.tile(np.sqrt((Yc*Yc).sum(0)), (Yc.shape[0], 1))
-    U,S,Vh = np.linalg.svd(Yn, full_matrices=False)
+    U,S = low_rank_svd(Yn, 1)
     
     glb = (Yn/np.tile(Yn.std(0), (Y.shape[0], 1))).mean(1)
 
@@ -12,11 +12,14 @@ from utils import convert_pvalue_to_r,\
                   calc_blocksize,\
                   calc_corrcoef,\
                   cluster_data,\
+                  calc_neighbor_adjacency,\
                   merge_lists
 
 from core import degree_centrality, \
                  fast_degree_centrality, \
+                 lfcd_centrality, \
                  eigenvector_centrality, \
+                 blocked_eigenvector_centrality, \
                  fast_eigenvector_centrality
 
 __all__ = ['create_resting_state_graphs',\
@@ -32,6 +35,8 @@ __all__ = ['create_resting_state_graphs',\
            'calc_blocksize',\
            'degree_centrality',\
            'fast_degree_centrality',\
+           'lfcd_centrality',\
            'eigenvector_centrality',\
+           'blocked_eigenvector_centrality',\
            'fast_eigenvector_centrality']
 
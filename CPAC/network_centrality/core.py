@@ -9,29 +9,38 @@ These are function nodes of sorts that compute a centrality measure.
 ####
 
 import numpy as np
-#import pyximport
-#pyximport.install(setup_args={'include_dirs': [np.get_include()]})
-from CPAC.network_centrality.thresh_and_sum import *
+try:
+    from CPAC.network_centrality.thresh_and_sum import *
+except ImportError:
+    # Not built by setup.py (e.g. running from a source checkout), so
+    # compile it on the fly with the settings in thresh_and_sum.pyxbld
+    import pyximport
+    pyximport.install(setup_args={'include_dirs': [np.get_include()]})
+    from CPAC.network_centrality.thresh_and_sum import *
 
 
-def degree_centrality(corr_matrix, r_value, method, out=None):
+def degree_centrality(corr_matrix, r_value, method, out=None, num_threads=1):
     """
     Calculate centrality for the rows in the corr_matrix using
     a specified correlation threshold. The centrality output can 
-    be binarized or weighted.
+    be binarized, weighted or both at once.
     
     Paramaters
     ---------
     corr_matrix : numpy.ndarray
     r_value : float
     method : str
-        Can be 'binarize' or 'weighted'
-    out : numpy.ndarray (optional)
-        If specified then should have shape of `corr_matrix.shape[0]`
+        Can be 'binarize', 'weighted' or 'both'
+    out : numpy.ndarray or tuple (optional)
+        If specified then should have shape of `corr_matrix.shape[0]`;
+        when method is 'both', a tuple of (binarize, weighted) arrays
+    num_threads : integer (optional); default=1
+        number of threads the thresh-and-sum kernel splits the rows over
     
     Returns
     -------
-    out : numpy.ndarray
+    out : numpy.ndarray or tuple
+        tuple of (binarize, weighted) arrays when method is 'both'
     """
 
     # Import packages
@@ -40,8 +49,9 @@ def degree_centrality(corr_matrix, r_value, method, out=None):
     # Init logger
     logger = logging.getLogger('workflow')
 
-    if method not in ["binarize", "weighted"]:
-        raise Exception("Method must be one of binarize or weighted and not %s" % method)
+    if method not in ["binarize", "weighted", "both"]:
+        raise Exception("Method must be one of binarize, weighted or both "\
+                        "and not %s" % method)
     
     if corr_matrix.dtype.itemsize == 8:
         dtype   = "double"
@@ -51,11 +61,18 @@ def degree_centrality(corr_matrix, r_value, method, out=None):
         r_value = np.float32(r_value)
     
     if out is None:
-        out = np.zeros(corr_matrix.shape[0], dtype=corr_matrix.dtype)
+        if method == "both":
+            out = (np.zeros(corr_matrix.shape[0], dtype=corr_matrix.dtype),
+                   np.zeros(corr_matrix.shape[0], dtype=corr_matrix.dtype))
+        else:
+            out = np.zeros(corr_matrix.shape[0], dtype=corr_matrix.dtype)
     logger.info('about to call thresh_and_sum')
     func_name   = "centrality_%s_%s" % (method, dtype)
     func        = globals()[func_name]
-    func(corr_matrix, out, r_value)
+    if method == "both":
+        func(corr_matrix, out[0], out[1], r_value, num_threads)
+    else:
+        func(corr_matrix, out, r_value, num_threads)
     
     return out
 
@@ -74,6 +91,62 @@ def fast_degree_centrality(m):
 
 
 
+####
+# Local Functional Connectivity Density
+####
+
+def lfcd_centrality(corr_matrix, seeds, adjacency, r_value, out=None,
+                    num_threads=1):
+    """
+    Calculate the binarized and weighted lFCD for the rows in the
+    corr_matrix. The lFCD of a seed is the size (and summed correlation)
+    of the cluster of spatially connected voxels, containing the seed,
+    whose correlation with the seed is above the threshold. Clusters are
+    found by a breadth-first search from each seed over the precomputed
+    voxel adjacency, so only the seed's own cluster is visited.
+    
+    Paramaters
+    ---------
+    corr_matrix : numpy.ndarray
+        block of the correlation matrix: `nseeds` x `nvoxs`
+    seeds : numpy.ndarray
+        the voxel index (column) of the seed of each row
+    adjacency : scipy.sparse.csr_matrix
+        `nvoxs` x `nvoxs` voxel adjacency, see
+        utils.calc_neighbor_adjacency
+    r_value : float
+    out : tuple (optional)
+        tuple of (binarize, weighted) arrays, each with shape of
+        `corr_matrix.shape[0]`
+    num_threads : integer (optional); default=1
+        number of threads the seeds are split over
+    
+    Returns
+    -------
+    out : tuple
+        tuple of (binarize, weighted) arrays
+    """
+
+    if corr_matrix.dtype.itemsize == 8:
+        dtype   = "double"
+        r_value = np.float64(r_value)
+    else:
+        dtype   = "float"
+        r_value = np.float32(r_value)
+    
+    if out is None:
+        out = (np.zeros(corr_matrix.shape[0], dtype=corr_matrix.dtype),
+               np.zeros(corr_matrix.shape[0], dtype=corr_matrix.dtype))
+    func_name   = "lfcd_both_%s" % dtype
+    func        = globals()[func_name]
+    func(corr_matrix, np.asarray(seeds, dtype=np.int32),
+         adjacency.indptr.astype(np.int32), adjacency.indices.astype(np.int32),
+         out[0], out[1], r_value, num_threads)
+    
+    return out
+
+
+
 ####
 # Eigenvector Centrality
 ####
@@ -141,6 +214,110 @@ def eigenvector_centrality(corr_matrix,
         return np.abs(eigenVector)
 
 
+def blocked_eigenvector_centrality(ts_normd, r_value, block_size,
+                                   num_threads=1, maxiter=1000, tol=1e-6):
+    """
+    Calculate the binarized and weighted eigenvector centrality of the
+    thresholded correlation matrix without ever storing it. On every
+    power iteration, the correlation matrix is recomputed block-by-block
+    from the normalized timeseries, thresholded and multiplied into both
+    eigenvector estimates at once, so memory is bounded by `block_size`.
+    
+    Parameters
+    ----------
+    ts_normd : numpy.ndarray
+        timeseries of shape (ntpts x nvoxs) that is normalized; i.e. the
+        data is demeaned and divided by its L2-norm
+    r_value : float
+        correlation threshold; only correlations above it are kept
+    block_size : integer
+        the number of rows (voxels) of the correlation matrix to compute
+        at any one time
+    num_threads : integer (optional); default=1
+        number of threads to compute blocks with; blocks are scheduled
+        across up to num_threads workers (see utils.map_blocks), so
+        block_size should account for that many blocks in memory
+    maxiter : integer (optional); default=1000
+        maximum number of power iterations
+    tol : float (optional); default=1e-6
+        convergence tolerance on the L2-norm of the change in the
+        eigenvector estimates between iterations
+    
+    Returns
+    -------
+    eigen_binarize : numpy.ndarray
+        binarized eigenvector centrality, unit L2-norm
+    eigen_weighted : numpy.ndarray
+        weighted eigenvector centrality, unit L2-norm
+    
+    Examples
+    --------
+    >>> # Simulate Data
+    >>> import numpy as np
+    >>> from CPAC.cwas.subdist import norm_cols
+    >>> ntpts = 100; nvoxs = 1000
+    >>> m = norm_cols(np.random.random((ntpts,nvoxs)).astype('float32'))
+    >>> # Execute
+    >>> from CPAC.network_centrality.core import blocked_eigenvector_centrality
+    >>> eig_bin, eig_wt = blocked_eigenvector_centrality(m, 0.2, 100)
+    """
+
+    # Import packages
+    from nipype import logging
+    from CPAC.network_centrality.utils import map_blocks
+
+    # Init logger
+    logger = logging.getLogger('workflow')
+
+    nvoxs = ts_normd.shape[1]
+    if ts_normd.dtype.itemsize == 8:
+        dtype   = "double"
+        r_value = np.float64(r_value)
+    else:
+        dtype   = "float"
+        r_value = np.float32(r_value)
+    func = globals()["thresh_matvec_both_%s" % dtype]
+
+    # Initialize estimates with L2-norm == 1
+    vec_bin = (np.ones(nvoxs)/np.sqrt(nvoxs)).astype(ts_normd.dtype)
+    vec_wt  = vec_bin.copy()
+
+    # Split threads between parallel blocks and the kernel in each block
+    num_blocks = int(np.ceil(float(nvoxs)/block_size))
+    num_workers = max(1, min(num_threads, num_blocks))
+    kernel_threads = max(1, num_threads//num_workers)
+
+    # Function to add a block of rows of R*v to the outputs
+    def calc_block(n, m):
+        rmat_block = np.dot(ts_normd[:,n:m].T, ts_normd)
+        func(rmat_block, vec_bin, vec_wt, out_bin[n:m], out_wt[n:m],
+             r_value, kernel_threads)
+        del rmat_block
+
+    i = 0
+    dnorm_bin = dnorm_wt = np.inf
+    while (i < maxiter) & ((dnorm_bin > tol) | (dnorm_wt > tol)):
+        out_bin = np.zeros(nvoxs, dtype=ts_normd.dtype)
+        out_wt  = np.zeros(nvoxs, dtype=ts_normd.dtype)
+        # Stream the thresholded correlation matrix through R*v
+        map_blocks(calc_block, nvoxs, block_size, num_workers)
+        out_bin /= np.linalg.norm(out_bin, 2)
+        out_wt  /= np.linalg.norm(out_wt, 2)
+
+        i += 1
+        dnorm_bin = np.linalg.norm(out_bin-vec_bin, 2)
+        dnorm_wt  = np.linalg.norm(out_wt-vec_wt, 2)
+        vec_bin, vec_wt = out_bin, out_wt
+        logger.info('iteration %02d, || v_i - v_(i-1) || = %0.8f (binarize), '\
+                    '%0.8f (weighted)' % (i, dnorm_bin, dnorm_wt))
+
+    if (dnorm_bin > tol) | (dnorm_wt > tol):
+        logger.info('Warning: eigenvector centrality did not converge in '\
+                    '%d iterations' % maxiter)
+
+    return np.abs(vec_bin), np.abs(vec_wt)
+
+
 def fast_eigenvector_centrality(m, maxiter=99, verbose=True):
     """
     The output here is based on a transfered correlation matrix of m.
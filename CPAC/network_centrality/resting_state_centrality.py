@@ -9,7 +9,7 @@ used in C-PAC
 
 # Function to create the network centrality workflow
 def create_resting_state_graphs(wf_name='resting_state_graph', 
-                                allocated_memory=None):
+                                allocated_memory=None, num_threads=1):
     '''
     Workflow to calculate degree and eigenvector centrality as well as 
     local functional connectivity density (lfcd) measures for the 
@@ -23,6 +23,10 @@ def create_resting_state_graphs(wf_name='resting_state_graph',
         matrix and stores it in a .mat file. By default its False
     wf_name : string
         name of the workflow
+    allocated_memory : float (optional); default=None
+        amount of memory (GB) allocated to the centrality calculation
+    num_threads : integer (optional); default=1
+        the number of threads to utilize for centrality computation
         
     Returns 
     -------
@@ -134,13 +138,15 @@ def create_resting_state_graphs(wf_name='resting_state_graph',
                                                               'method_option',
                                                               'threshold_option',
                                                               'threshold',
-                                                              'allocated_memory'],
+                                                              'allocated_memory',
+                                                              'num_threads'],
                                                  output_names=['out_list'],
                                                  function=calc_centrality),
                                    name='calculate_centrality')
 
-    # Specify memory to interface for resource profiling
+    # Specify memory and threads to interface for resource profiling
     calculate_centrality.interface.estimated_memory_gb = allocated_memory
+    calculate_centrality.interface.num_threads = num_threads
 
     # Connect inputspec node to main function node
     wf.connect(inputspec, 'in_file', 
@@ -156,6 +162,7 @@ def create_resting_state_graphs(wf_name='resting_state_graph',
 
     # Specify allocated memory for calculating block size in function
     calculate_centrality.inputs.allocated_memory = allocated_memory
+    calculate_centrality.inputs.num_threads = num_threads
     
     # Instantiate outputspec node
     outputspec = pe.Node(util.IdentityInterface(fields=['centrality_outputs',
@@ -198,7 +205,8 @@ def load(datafile, template=None):
     affine : ndarray
         Affine matrix of the input data
     final_mask : ndarray
-        Mask/parcellation unit matrix
+        Mask, or for a parcellation the label volume restricted to the
+        voxels with signal
     template_type : string 
         0 for mask, 1 for parcellation unit 
     scans : string (int)
@@ -212,6 +220,7 @@ def load(datafile, template=None):
     import os
     import nibabel as nib
     import numpy as np
+    from CPAC.utils import parcel_mean
 
     try:
         if isinstance(datafile, list):
@@ -246,17 +255,13 @@ def load(datafile, template=None):
         nodes.sort()
         print "sorted nodes", nodes
 
-        flag=1
-        for n in nodes:
-            if n > 0:
-                node_array = data[(mask == n) & datmask]
-                avg = np.mean(node_array, axis =0)
-                if flag:
-                    timeseries = avg
-                    flag=0
-                else:
-                    timeseries = np.vstack((timeseries, avg))
-            final_mask  = datmask
+        # Parcellation restricted to the voxels with signal; parcels with
+        # no such voxels are dropped, so the timeseries are in the order of
+        # the labels of final_mask (see CPAC.utils.volumize_labels)
+        final_mask = mask * datmask
+
+        # Mean timeseries of every node at once
+        timeseries = parcel_mean(data, final_mask)[1]
         #template_type is 1 for parcellation
         template_type = 1
     else:
@@ -270,7 +275,8 @@ def load(datafile, template=None):
 
 
 # Function to calculate centrality using a correlation threshold 
-def get_centrality_by_rvalue(ts_normd, template, method_option, r_value, block_size):
+def get_centrality_by_rvalue(ts_normd, template, method_option, r_value, block_size,
+                             num_threads=1):
     '''
     Method to calculate degree/eigenvector centrality and lFCD
     via correlation (r-value) threshold
@@ -292,6 +298,10 @@ def get_centrality_by_rvalue(ts_normd, template, method_option, r_value, block_s
     block_size : an integer
         the number of rows (voxels) to compute timeseries correlation over
         at any one time
+    num_threads : integer (optional); default=1
+        the number of threads to compute blocks with; blocks are scheduled
+        across up to num_threads workers (see utils.map_blocks), so
+        block_size should account for that many blocks in memory
 
     Returns
     -------
@@ -302,12 +312,11 @@ def get_centrality_by_rvalue(ts_normd, template, method_option, r_value, block_s
     '''
     
     # Import packages
-    import copy
     import numpy as np
-    import copy
     from nipype import logging
 
-    from CPAC.network_centrality.utils import cluster_data
+    from CPAC.network_centrality.utils import calc_neighbor_adjacency, \
+                                             map_blocks
     import CPAC.network_centrality.core as core
 
     # Init variables
@@ -325,13 +334,20 @@ def get_centrality_by_rvalue(ts_normd, template, method_option, r_value, block_s
         out_list.append(('degree_centrality_weighted', degree_weighted))
     # Init eigenvector centrality outputs
     if method_option == 'eigenvector':
-        r_matrix = np.zeros((nvoxs,nvoxs), dtype=ts_normd.dtype)
         # Init output map
         eigen_binarize = np.zeros(nvoxs, dtype=ts_normd.dtype)
         out_list.append(('eigenvector_centrality_binarize', eigen_binarize))
         # Init output map
         eigen_weighted = np.zeros(nvoxs, dtype=ts_normd.dtype)
         out_list.append(('eigenvector_centrality_weighted', eigen_weighted))
+        # Stream the thresholded correlation blocks through a power
+        # iteration instead of storing the full correlation matrix
+        logger.info('...calculating binarize and weighted eigenvector')
+        eigen_binarize[:], eigen_weighted[:] = \
+            core.blocked_eigenvector_centrality(ts_normd, r_value, block_size,
+                                                num_threads=num_threads)
+        return out_list
+
     # Init lFCD outputs
     if method_option == 'lfcd':
         # Init output map
@@ -341,61 +357,43 @@ def get_centrality_by_rvalue(ts_normd, template, method_option, r_value, block_s
         lfcd_weighted = np.zeros(nvoxs, dtype=ts_normd.dtype)
         out_list.append(('lfcd_weighted', lfcd_weighted))
 
-    # Prepare to loop through and calculate correlation matrix
-    n = 0
-    m = block_size
-    block_no = 1
-    # Run as long as our last row index is <= nvoxs
-    while m <= nvoxs:
+    # Split threads between parallel blocks and the kernel in each block
+    num_blocks = int(np.ceil(float(nvoxs)/block_size))
+    num_workers = max(1, min(num_threads, num_blocks))
+    kernel_threads = max(1, num_threads//num_workers)
+    # Compute the voxel neighbourhood graph once for all lFCD seeds
+    if method_option == 'lfcd':
+        adjacency = calc_neighbor_adjacency(template, k=26)
+
+    # Function to compute a block of the correlation matrix and the
+    # centrality of its rows; each block writes to its own output slice
+    def calc_block(n, m):
         # First, compute block of correlation matrix
-        logger.info('running block %d: rows %d thru %d' % (block_no, n, m))
+        logger.info('running block %d: rows %d thru %d' \
+                    % (n//block_size+1, n, m))
         rmat_block = np.dot(ts_normd[:,n:m].T, ts_normd)
 
-        # Degree centrality calculation
+        # Degree centrality calculation - binarize and weighted in one pass
         if method_option == 'degree':
-            core.degree_centrality(rmat_block, r_value, method='binarize', 
-                              out=degree_binarize[n:m])
-            core.degree_centrality(rmat_block, r_value, method='weighted', 
-                              out=degree_weighted[n:m])
-
-        # Eigenvector centrality - append global corr. matrix
-        if method_option == 'eigenvector':
-            r_matrix[n:m] = rmat_block
+            core.degree_centrality(rmat_block, r_value, method='both',
+                                   out=(degree_binarize[n:m],
+                                        degree_weighted[n:m]),
+                                   num_threads=kernel_threads)
 
-        # lFCD - perform lFCD algorithm
+        # lFCD - find each seed's cluster in the block - binarize and
+        # weighted in one pass
         if method_option == 'lfcd':
-            xyz_a = np.argwhere(template)
-            krange = rmat_block.shape[0]
-            logger.info('...iterating through seeds in block - lfcd')
-            for k in range (0,krange):
-                corr_seed = rmat_block[k,:]
-                labels = cluster_data(corr_seed,r_value,xyz_a)
-                seed_label = labels[n+k]
-                # Binarized lFCD
-                if seed_label > 0:
-                    lfcd_bin = np.sum(labels==seed_label)
-                    lfcd_wght = np.sum(corr_seed*(labels==seed_label))
-                else:
-                    lfcd_bin = lfcd_wght = 1
-                lfcd_binarize[n+k] = lfcd_bin
-                lfcd_weighted[n+k] = lfcd_wght
-
-        # Delete block of corr matrix and increment indices
+            logger.info('...clustering seeds in block - lfcd')
+            core.lfcd_centrality(rmat_block, np.arange(n, m), adjacency,
+                                 r_value, out=(lfcd_binarize[n:m],
+                                               lfcd_weighted[n:m]),
+                                 num_threads=kernel_threads)
+
+        # Delete block of corr matrix
         del rmat_block
 
-        # Move next block start point up to last block finish point
-        n = m
-        # If we finished at nvoxs last time, break the loop
-        if n == nvoxs:
-            break
-        # Else, if our next block runs over nvoxs, limit it to nvoxs
-        elif (m+block_size) > nvoxs:
-            m = nvoxs
-        # Else, just increment end of next block by block_size
-        else:
-            m += block_size
-        # Increment block number
-        block_no += 1
+    # Calculate the blocks across the worker pool
+    map_blocks(calc_block, nvoxs, block_size, num_workers)
 
     # Correct for self-correlation in degree centrality
     if method_option == 'degree':
@@ -404,26 +402,13 @@ def get_centrality_by_rvalue(ts_normd, template, method_option, r_value, block_s
         idx = np.where(degree_weighted)
         degree_weighted[idx] = degree_weighted[idx]-1
 
-    # Perform eigenvector measures
-    if method_option == 'eigenvector':
-        logger.info('...calculating binarize eigenvector')
-        # Have to deepcopy the r_matrix because thresh and sum overwrites
-        # its values via pass-by-reference
-        eigen_binarize[:] = \
-            core.eigenvector_centrality(copy.deepcopy(r_matrix), r_value,
-                                        method='binarize').squeeze()
-        logger.info('...calculating weighted eigenvector')
-        eigen_weighted[:] = \
-            core.eigenvector_centrality(r_matrix, r_value,
-                                        method='weighted').squeeze()
-        del r_matrix
-
     # Return list of outputs
     return out_list
 
 
 # Function to calculate centrality with a sparsity threhold
-def get_centrality_by_sparsity(ts_normd, method_option, threshold, block_size):
+def get_centrality_by_sparsity(ts_normd, method_option, threshold, block_size,
+                               num_threads=1):
     '''
     Method to calculate degree/eigenvector centrality via sparsity threshold
 
@@ -441,6 +426,9 @@ def get_centrality_by_sparsity(ts_normd, method_option, threshold, block_size):
     block_size : an integer
         the number of rows (voxels) to compute timeseries correlation over
         at any one time
+    num_threads : integer (optional); default=1
+        the number of threads used for eigenvector centrality; the block
+        is split among that many parallel workers
 
     Returns
     -------
@@ -451,11 +439,11 @@ def get_centrality_by_sparsity(ts_normd, method_option, threshold, block_size):
     '''
 
     # Import packages
-    import copy
     import numpy as np
     import scipy as sp
     from nipype import logging
 
+    from CPAC.network_centrality.utils import select_top_k, merge_top_k
     import CPAC.network_centrality.core as core
 
     # Init variables
@@ -472,7 +460,6 @@ def get_centrality_by_sparsity(ts_normd, method_option, threshold, block_size):
 
     # Init eigenvector centrality outputs
     if method_option == 'eigenvector':
-        r_matrix = np.zeros((nvoxs,nvoxs), dtype = ts_normd.dtype)
         # Init output map
         eigen_binarize = np.zeros(nvoxs, dtype=ts_normd.dtype)
         out_list.append(('eigenvector_centrality_binarize', eigen_binarize))
@@ -481,7 +468,7 @@ def get_centrality_by_sparsity(ts_normd, method_option, threshold, block_size):
         out_list.append(('eigenvector_centrality_weighted', eigen_weighted))
 
     # Get the number of connections to keep
-    sparse_num = np.round((nvoxs**2-nvoxs)*threshold/2.0)
+    sparse_num = int(np.round((nvoxs**2-nvoxs)*threshold/2.0))
 
     # Prepare to loop through and calculate correlation matrix
     n = 0
@@ -489,18 +476,11 @@ def get_centrality_by_sparsity(ts_normd, method_option, threshold, block_size):
     block_no = 1
     r_value = -1
 
-    # Init wij list
-    z = np.array([])
-    wij_global = np.rec.fromarrays([z.astype(ts_normd.dtype),
-                                    z.astype('int32'),
-                                    z.astype('int32')])
-    # Form the initial blockwise mask (to only grab upper triangle of data)
-    block_triu = np.triu(np.ones((block_size,block_size)), k=1).astype('bool')
-    block_rect = np.ones((block_size,nvoxs-block_size), dtype='bool')
-    block_mask = np.concatenate((block_triu,block_rect), axis=1)
-
-    # Delete matrices to save memory
-    del block_triu, block_rect
+    # Init the list of the (at most sparse_num) strongest connections
+    w_global = np.array([], dtype=ts_normd.dtype)
+    i_global = np.array([], dtype='int32')
+    j_global = np.array([], dtype='int32')
+
     # Calculate correlations step - prune connections for degree
     while n <= nvoxs:
         # First, compute block of correlation matrix
@@ -509,44 +489,27 @@ def get_centrality_by_sparsity(ts_normd, method_option, threshold, block_size):
         # Do this for both deg and eig, more efficient way to compute r_value
         rmat_block = np.dot(ts_normd[:,n:m].T,
                             ts_normd[:,n:])
-        # Shrink block_mask down on every iteration after the first block
-        if n > 0:
-            block_mask = block_mask[:,:-block_size]
-
-        # Get elements as an array
-        rmat_block = rmat_block[block_mask]
-        thr_idx = np.where(rmat_block >= r_value)
-        rmat_block = rmat_block[thr_idx]
-        logger.info('number of passing correlations is %d' % len(rmat_block))
+        # Only grab upper triangle of data; correlations are >= -1, so
+        # setting the lower triangle and diagonal to -2 drops them
+        rmat_block[:,:m-n][np.tri(m-n, dtype='bool')] = -2
 
-        # Add global offset to indicies
-        idx = np.where(block_mask)
-        i = idx[0][thr_idx].astype('int32') + n
-        j = idx[1][thr_idx].astype('int32') + n
-
-        # Free some memory
-        del idx, thr_idx
-        w_global = np.concatenate([wij_global.f0,rmat_block])
-        i_global = np.concatenate([wij_global.f1,i])
-        j_global = np.concatenate([wij_global.f2,j])
-        # Free some memory
-        del i,j,rmat_block
-        # Grab indices and weights that pass and combine into list
-        wij_global = np.rec.fromarrays([w_global,i_global,j_global])
+        # Select this block's passing connections, never more than sparse_num
+        w, i, j = select_top_k(rmat_block, r_value, sparse_num)
+        del rmat_block
+        logger.info('number of passing correlations is %d' % len(w))
+
+        # Add global offset to indicies and merge into the global list,
+        # keeping only the sparse_num strongest connections
+        w_global, i_global, j_global = \
+            merge_top_k((w_global, i_global, j_global),
+                        (w, i.astype('int32') + n, j.astype('int32') + n),
+                        sparse_num)
         # Free some memory
-        del w_global, i_global, j_global
+        del w, i, j
 
-        # Pass these into the global set and sort (ascending) by correlation
-        logger.info('sorting list...')
-        wij_global.sort()
-        # And trim list if it's greater than the number of connections we want
-        if len(wij_global) > sparse_num:
-            wij_global = wij_global[-sparse_num:]
-        r_value = wij_global[0][0]
-
-        # If we're doing eigen, store block into full matrix
-        if method_option == 'eigenvector':
-            r_matrix[n:m] = np.dot(ts_normd[:,n:m].T, ts_normd)
+        # Once the list is full, only stronger connections can enter it
+        if len(w_global) == sparse_num and sparse_num > 0:
+            r_value = w_global.min()
 
         # Move next block start point up to last block finish point
         n = m
@@ -568,10 +531,10 @@ def get_centrality_by_sparsity(ts_normd, method_option, threshold, block_size):
         # Create sparse (symmetric) matrix of all correlations that survived
         logger.info('creating sparse matrix')
         # Extract the weights and indices from the global list
-        w = wij_global.f0
-        i = wij_global.f1
-        j = wij_global.f2
-        del wij_global
+        w = w_global
+        i = i_global
+        j = j_global
+        del w_global, i_global, j_global
         # Create sparse correlation matrix (upper tri) from wij's
         Rsp = sp.sparse.coo_matrix((w,(i,j)), shape=(nvoxs,nvoxs))
         Rsp = Rsp + Rsp.T
@@ -582,19 +545,16 @@ def get_centrality_by_sparsity(ts_normd, method_option, threshold, block_size):
         degree_weighted[:] = np.array(Rcsr.sum(axis=0))
         del Rcsr
 
-    # Eigenvector - compute the r value from entire matrix
+    # Eigenvector - stream the correlation blocks thresholded at the r value
     if method_option == 'eigenvector':
-        del wij_global
-        # Finally compute centrality using full matrix and r_value
-        logger.info('...calculating binarize eigenvector')
-        eigen_binarize[:] = \
-            core.eigenvector_centrality(copy.deepcopy(r_matrix), r_value,
-                                        method='binarize').squeeze()
-        logger.info('...calculating weighted eigenvector')
-        eigen_weighted[:] = \
-            core.eigenvector_centrality(r_matrix, r_value,
-                                        method='weighted').squeeze()
-        del r_matrix
+        del w_global, i_global, j_global
+        logger.info('...calculating binarize and weighted eigenvector')
+        # Split the block among the workers to stay in the same memory
+        eig_block_size = max(1, block_size//num_threads)
+        eigen_binarize[:], eigen_weighted[:] = \
+            core.blocked_eigenvector_centrality(ts_normd, r_value,
+                                                eig_block_size,
+                                                num_threads=num_threads)
 
     # Return list of outputs
     return out_list
@@ -675,7 +635,7 @@ def get_centrality_fast(timeseries,
 
 # Main centrality function utilized by the centrality workflow
 def calc_centrality(in_file, template, method_option, threshold_option,
-                    threshold, allocated_memory):
+                    threshold, allocated_memory, num_threads=1):
     '''
     Function to calculate centrality and map them to a nifti file
     
@@ -694,6 +654,8 @@ def calc_centrality(in_file, template, method_option, threshold_option,
         pvalue/sparsity_threshold/threshold value
     allocated_memory : string
         amount of memory allocated to degree centrality
+    num_threads : integer (optional); default=1
+        the number of threads to utilize for centrality computation
     
     Returns
     -------
@@ -720,18 +682,16 @@ def calc_centrality(in_file, template, method_option, threshold_option,
     out_list = []
     ts, aff, mask, t_type, scans = load(in_file, template)
 
-    # If we're doing degree sparsity
-    if method_option == 'degree' and threshold_option == 'sparsity':
+    # If we're doing sparsity thresholding
+    if threshold_option == 'sparsity':
         block_size = calc_blocksize(ts, memory_allocated=allocated_memory,
                                     sparsity_thresh=threshold)
-    # Otherwise
-    elif method_option == 'eigenvector':
-        block_size = calc_blocksize(ts, memory_allocated=allocated_memory,
-                                    include_full_matrix=True)
-    # Otherwise, compute blocksize with regards to available memory
+    # Otherwise, compute blocksize with regards to available memory, with
+    # a block in memory for each of the parallel workers
     else:
         block_size = calc_blocksize(ts, memory_allocated=allocated_memory,
-                                    include_full_matrix=False)
+                                    include_full_matrix=False,
+                                    num_workers=num_threads)
     # Normalize the timeseries for easy dot-product correlation calc.
     ts_normd = norm_cols(ts.T)
 
@@ -742,20 +702,23 @@ def calc_centrality(in_file, template, method_option, threshold_option,
                                                      mask,
                                                      method_option,
                                                      r_value,
-                                                     block_size)
+                                                     block_size,
+                                                     num_threads)
     # Sparsity threshold
     elif threshold_option == 'sparsity':
         centrality_matrix = get_centrality_by_sparsity(ts_normd,
                                                        method_option,
                                                        threshold,
-                                                       block_size)
+                                                       block_size,
+                                                       num_threads)
     # R-value threshold centrality
     elif threshold_option == 'correlation':
         centrality_matrix = get_centrality_by_rvalue(ts_normd,
                                                      mask,
                                                      method_option,
                                                      threshold,
-                                                     block_size)
+                                                     block_size,
+                                                     num_threads)
     # For fast approach (no thresholding)
     elif threshold_option == 3:
         centrality_matrix = get_centrality_fast(ts, method_option)
@@ -80,3 +80,30 @@ class TestThresholding:
 ###
 # TEST centrality functions
 ###
+
+
+###
+# TEST sparsity thresholding by partial sort
+###
+
+@attr('threshold', 'sparsity')
+def test_select_and_merge_top_k():
+    print "testing select_top_k and merge_top_k"
+    
+    from CPAC.network_centrality.utils import select_top_k, merge_top_k
+    
+    nvoxs       = 200
+    k           = 500
+    corr_matrix = np.random.random((nvoxs, nvoxs)).astype('float32')
+    
+    # Reference is the k largest values over the whole matrix
+    ref = np.sort(corr_matrix.ravel())[-k:]
+    
+    # Select from each half of the matrix, then merge
+    w1, i1, j1 = select_top_k(corr_matrix[:nvoxs/2], 0.5, k)
+    w2, i2, j2 = select_top_k(corr_matrix[nvoxs/2:], 0.5, k)
+    assert_equal(corr_matrix[:nvoxs/2][i1,j1], w1)
+    w, i, j = merge_top_k((w1, i1, j1), (w2, i2 + nvoxs/2, j2), k)
+    
+    assert_equal(ref, np.sort(w))
+    assert_equal(corr_matrix[i,j], w)
@@ -15,6 +15,7 @@ sys.path.insert(1, "/home2/data/Projects/CPAC_Regression_Test/zarrar/centrality_
 
 from CPAC.network_centrality import degree_centrality, fast_degree_centrality
 from CPAC.network_centrality import eigenvector_centrality, fast_eigenvector_centrality
+from CPAC.network_centrality import blocked_eigenvector_centrality
 
 class TestDegreeCentrality:
     @attr('degree', 'centrality', 'binarize')
@@ -93,6 +94,83 @@ class TestDegreeCentrality:
         assert_equal(ref, comp)
 
 
+@attr('degree', 'centrality', 'binarize', 'weighted')
+def test_degree_centrality_both(nvoxblocks=50, nvoxs=200, r_value=0.2):
+    print "testing centrality both - binarize and weighted in one pass"
+    
+    for dtype in ['float32', 'float64']:
+        corr_matrix = np.random.random((nvoxblocks, nvoxs)).astype(dtype)
+        ref_bin = np.sum(corr_matrix>r_value, axis=1)
+        ref_wt  = np.sum(corr_matrix*(corr_matrix>r_value), axis=1)
+        
+        comp_bin, comp_wt = degree_centrality(corr_matrix, r_value, "both",
+                                              num_threads=2)
+        assert_equal(ref_bin, comp_bin)
+        assert_array_almost_equal(ref_wt, comp_wt, decimal=3)
+        
+        # Accumulating into slices of a larger output as done per block
+        out_bin = np.zeros(nvoxblocks*2, dtype=dtype)
+        out_wt  = np.zeros(nvoxblocks*2, dtype=dtype)
+        degree_centrality(corr_matrix, r_value, "both",
+                          out=(out_bin[nvoxblocks:], out_wt[nvoxblocks:]))
+        assert_equal(ref_bin, out_bin[nvoxblocks:])
+        assert_equal(np.zeros(nvoxblocks), out_bin[:nvoxblocks])
+        assert_array_almost_equal(ref_wt, out_wt[nvoxblocks:], decimal=3)
+
+
+@attr('degree', 'centrality', 'parallel')
+def test_degree_centrality_parallel_blocks(ntpts=100, nvoxs=500, r_value=0.2):
+    print "testing degree centrality with blocks across parallel workers"
+    
+    from CPAC.cwas.subdist import norm_cols
+    from CPAC.network_centrality import get_centrality_by_rvalue
+    
+    m = norm_cols(np.random.random((ntpts,nvoxs)).astype('float32'))
+    
+    # One block in serial vs. uneven blocks across 4 workers
+    ref  = dict(get_centrality_by_rvalue(m, None, 'degree', r_value, nvoxs))
+    comp = dict(get_centrality_by_rvalue(m, None, 'degree', r_value, 64,
+                                         num_threads=4))
+    
+    assert_equal(ref['degree_centrality_binarize'],
+                 comp['degree_centrality_binarize'])
+    assert_array_almost_equal(ref['degree_centrality_weighted'],
+                              comp['degree_centrality_weighted'], decimal=3)
+
+
+@attr('lfcd', 'centrality', 'binarize', 'weighted')
+def test_lfcd_centrality(nvoxs=300, r_value=0.5):
+    print "testing lfcd centrality against labelled clusters"
+    
+    from scipy import ndimage
+    from CPAC.network_centrality import lfcd_centrality, \
+                                        calc_neighbor_adjacency
+    
+    # Random mask and spatially smooth correlations with its seeds
+    mask = np.random.random((10,10,10)) > 0.5
+    mask_voxs = mask.sum()
+    corr_matrix = np.random.random((nvoxs/10, mask_voxs))
+    corr_matrix[:, :nvoxs/10][np.diag_indices(nvoxs/10)] = 1
+    seeds = np.arange(nvoxs/10)
+    
+    adjacency = calc_neighbor_adjacency(mask, k=26)
+    comp_bin, comp_wt = lfcd_centrality(corr_matrix, seeds, adjacency,
+                                        r_value)
+    
+    for seed in seeds:
+        thr_vol = np.zeros(mask.shape, dtype='bool')
+        thr_vol[mask] = corr_matrix[seed] > r_value
+        labels = ndimage.label(thr_vol, np.ones((3,3,3)))[0][mask]
+        cluster = labels == labels[seed]
+        if cluster.sum() > 1:
+            assert_equal(cluster.sum(), comp_bin[seed])
+            assert_almost_equal(corr_matrix[seed][cluster].sum(),
+                                comp_wt[seed])
+        else:
+            assert_equal(1, comp_bin[seed])
+            assert_equal(1, comp_wt[seed])
+
+
 def test_fast_eigenvector_centrality(ntpts=100, nvoxs=1000):
     print "testing fast_eigenvector_centrality"
     
@@ -117,6 +195,27 @@ def test_fast_eigenvector_centrality(ntpts=100, nvoxs=1000):
     ok_(diff < np.spacing(1e2)) # allow minimal difference
 
 
+@attr('eigenvector', 'centrality', 'binarize', 'weighted')
+def test_blocked_eigenvector_centrality(ntpts=100, nvoxs=500, r_value=0.2):
+    print "testing blocked_eigenvector_centrality"
+    
+    from CPAC.cwas.subdist import norm_cols
+    # Normalize Random Time-Series Data
+    m = norm_cols(np.random.random((ntpts,nvoxs)))
+    mm = m.T.dot(m)
+    
+    # Reference computed from the full correlation matrix
+    ref_bin = eigenvector_centrality(mm.copy(), r_value, 'binarize').squeeze()
+    ref_wt  = eigenvector_centrality(mm.copy(), r_value, 'weighted').squeeze()
+    
+    # Block size that doesn't evenly divide the voxels
+    comp_bin, comp_wt = blocked_eigenvector_centrality(m, r_value, 64,
+                                                       tol=1e-10)
+    
+    assert_array_almost_equal(ref_bin, comp_bin, decimal=6)
+    assert_array_almost_equal(ref_wt, comp_wt, decimal=6)
+
+
 def test_fast_on_real_data():
     from pandas import read_table
     from os import path as op
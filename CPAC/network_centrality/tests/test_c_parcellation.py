@@ -0,0 +1,100 @@
+"""
+This tests centrality on parcellation (roi) templates, from loading the
+parcel timeseries to mapping the parcel values back to their voxels
+"""
+
+import os
+import tempfile
+
+import numpy as np
+from numpy.testing import *
+
+
+def make_parcellation(out_dir):
+    '''
+    Writes a functional image of five parcels, the last of which has no
+    signal, and its parcellation template
+    '''
+    import nibabel as nib
+
+    np.random.seed(27)
+    labels = np.zeros((6, 6, 6), dtype='float32')
+    labels[:3, :3] = 1
+    labels[:3, 3:] = 2
+    labels[3:, :3] = 3
+    labels[3:, 3:5] = 4
+    labels[3:, 5] = 7
+    labels[:, :, 5] = 0
+
+    # Parcels share a common signal so they are correlated with each other
+    common = np.random.randn(40)
+    data = np.zeros(labels.shape + (40,), dtype='float32')
+    for label in [1, 2, 3, 4]:
+        parcel = labels == label
+        data[parcel] = common * label + np.random.randn(parcel.sum(), 40)
+    data[labels == 7] = 5.0
+
+    data_file = os.path.join(out_dir, 'func.nii.gz')
+    nib.Nifti1Image(data, np.eye(4)).to_filename(data_file)
+    template_file = os.path.join(out_dir, 'parcellation.nii.gz')
+    nib.Nifti1Image(labels, np.eye(4)).to_filename(template_file)
+
+    return data_file, template_file, labels, data
+
+
+def test_load_parcellation():
+    '''
+    load gives one timeseries per parcel with signal and the label volume
+    of those parcels
+    '''
+    from CPAC.network_centrality import load
+
+    data_file, template_file, labels, data = \
+        make_parcellation(tempfile.mkdtemp())
+    ts, aff, final_mask, t_type, scans = load(data_file, template_file)
+
+    assert_equal(t_type, 1)
+    assert_equal(np.unique(final_mask).tolist(), [0, 1, 2, 3, 4])
+    assert_equal(ts.shape, (4, 40))
+    for i, label in enumerate([1, 2, 3, 4]):
+        assert_array_almost_equal(ts[i], data[labels == label].mean(0),
+                                  decimal=5)
+
+
+def test_parcellation_centrality():
+    '''
+    Degree and eigenvector centrality of a parcellation put each parcel's
+    value on all of its voxels and zero everywhere else
+    '''
+    import nibabel as nib
+    from CPAC.network_centrality import load, get_centrality_by_rvalue
+    from CPAC.network_centrality.resting_state_centrality import \
+        calc_centrality
+    from CPAC.cwas.subdist import norm_cols
+
+    out_dir = tempfile.mkdtemp()
+    data_file, template_file, labels, data = make_parcellation(out_dir)
+
+    ts, aff, final_mask, t_type, scans = load(data_file, template_file)
+    ts_normd = norm_cols(ts.T)
+
+    cwd = os.getcwd()
+    os.chdir(out_dir)
+    try:
+        for method in ['degree', 'eigenvector']:
+            out_files = calc_centrality(data_file, template_file,
+                                        method + ' centrality',
+                                        'correlation', 0.0, 1.0)
+            desired = get_centrality_by_rvalue(ts_normd, final_mask, method,
+                                               0.0, ts_normd.shape[1])
+            for out_file, (name, values) in zip(out_files, desired):
+                vol = nib.load(out_file).get_data()
+                assert_equal(vol.shape, labels.shape)
+                for i, label in enumerate([1, 2, 3, 4]):
+                    assert_array_almost_equal(vol[labels == label],
+                                              values[i], decimal=5)
+                # Parcel without signal and background
+                assert_equal(vol[labels == 7], 0)
+                assert_equal(vol[labels == 0], 0)
+    finally:
+        os.chdir(cwd)
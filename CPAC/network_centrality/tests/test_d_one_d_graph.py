@@ -0,0 +1,101 @@
+"""
+This tests the parsing of the sparse graphs AFNI's 3dDegreeCentrality writes
+out as 1D files
+"""
+
+import os
+import tempfile
+
+import numpy as np
+from numpy.testing import *
+
+from CPAC.network_centrality.utils import parse_and_return_mats
+
+
+def parse_reference(one_d_file, mask_arr):
+    '''
+    The graph as parsed, edge by edge, before the lookup table and chunked
+    reading
+    '''
+    import scipy.sparse as sparse
+
+    graph_arr = np.loadtxt(one_d_file, skiprows=6)
+    ijk1 = graph_arr[:, 2:5].astype('int32')
+    ijk2 = graph_arr[:, 5:8].astype('int32')
+    w_arr = graph_arr[:, -1].astype('float32')
+    b_arr = np.ones(w_arr.shape)
+
+    mask_idx = np.argwhere(mask_arr)
+    mask_voxs = mask_idx.shape[0]
+    i_arr = [np.where((mask_idx == ijk1[ii]).all(axis=1))[0][0]
+             for ii in range(graph_arr.shape[0])]
+    j_arr = [np.where((mask_idx == ijk2[ii]).all(axis=1))[0][0]
+             for ii in range(graph_arr.shape[0])]
+
+    wmat = sparse.coo_matrix((w_arr, (i_arr, j_arr)),
+                             shape=(mask_voxs, mask_voxs))
+    bmat = sparse.coo_matrix((b_arr, (i_arr, j_arr)),
+                             shape=(mask_voxs, mask_voxs))
+
+    return bmat + bmat.T, wmat + wmat.T
+
+
+def write_one_d(mask_arr, n_edges):
+    '''
+    Writes a 1D graph of random edges between the voxels of the mask
+    '''
+    np.random.seed(27)
+    mask_idx = np.argwhere(mask_arr)
+    flat_idx = np.flatnonzero(mask_arr)
+
+    pairs = set()
+    while len(pairs) < n_edges:
+        i, j = np.random.randint(0, len(mask_idx), 2)
+        if i < j:
+            pairs.add((i, j))
+
+    one_d_file = os.path.join(tempfile.mkdtemp(), 'graph.1D')
+    with open(one_d_file, 'w') as f:
+        for line in range(6):
+            f.write('# header line %d\n' % line)
+        for i, j in sorted(pairs):
+            f.write('%d %d %d %d %d %d %d %d %.6f\n'
+                    % ((flat_idx[i], flat_idx[j]) + tuple(mask_idx[i]) +
+                       tuple(mask_idx[j]) + (np.random.rand(),)))
+
+    return one_d_file
+
+
+def test_parse_and_return_mats():
+    '''
+    Test the binarized and weighted graphs against the edge by edge parser,
+    read in chunks that do not divide the number of edges
+    '''
+    np.random.seed(27)
+    mask_arr = np.random.rand(5, 6, 4) > 0.4
+    one_d_file = write_one_d(mask_arr, 23)
+
+    b_desired, w_desired = parse_reference(one_d_file, mask_arr)
+
+    for chunk_size in [5, 23, 1000]:
+        b_mat, w_mat = parse_and_return_mats(one_d_file, mask_arr,
+                                             chunk_size=chunk_size)
+        assert_equal(b_mat.shape, (mask_arr.sum(), mask_arr.sum()))
+        assert_equal(b_mat.toarray(), b_desired.toarray())
+        assert_equal(w_mat.toarray(), w_desired.toarray())
+        assert_equal(w_mat.nnz, 2 * 23)
+
+
+def test_parse_voxels_outside_mask():
+    '''
+    Test edges to voxels outside the mask raise an error
+    '''
+    np.random.seed(27)
+    mask_arr = np.random.rand(5, 6, 4) > 0.4
+    one_d_file = write_one_d(mask_arr, 10)
+
+    # Drop the seed voxel of the first edge from the mask
+    smaller_mask = mask_arr.copy()
+    ijk = np.loadtxt(one_d_file, skiprows=6)[0, 2:5].astype('int64')
+    smaller_mask[tuple(ijk)] = False
+    assert_raises(Exception, parse_and_return_mats, one_d_file, smaller_mask)
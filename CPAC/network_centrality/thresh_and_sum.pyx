@@ -1,4 +1,7 @@
+import numpy as np
+cimport cython
 cimport numpy as np
+from cython.parallel cimport prange, threadid
 
 
 ###
@@ -60,45 +63,264 @@ def transform_weighted_double(np.ndarray[double, ndim=2] cmat):
 
 ###
 # Threshold and Sum (Degree Centrality)
+#
+# Each row of the correlation block is thresholded and summed in a single
+# pass with the GIL released. Rows are split across `num_threads` OpenMP
+# threads; every row is owned by exactly one thread, so the accumulators
+# are written to without locking.
 ###
 
 # Un-Weighted
-def centrality_binarize_float(np.ndarray[float, ndim=2] cmat, np.ndarray[float, ndim=1] cent, float thresh):
-    cdef unsigned int i,j
-    for i in xrange(cmat.shape[0]):
-        for j in xrange(cmat.shape[1]):
-            cent[i] += 1.0*(cmat[i,j] > thresh)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def centrality_binarize_float(float[:, :] cmat, float[:] cent, float thresh,
+                              int num_threads=1):
+    cdef Py_ssize_t i, j
+    cdef Py_ssize_t nrows = cmat.shape[0], ncols = cmat.shape[1]
+    cdef float bsum
+    with nogil:
+        for i in prange(nrows, num_threads=num_threads, schedule='static'):
+            bsum = 0
+            for j in range(ncols):
+                if cmat[i,j] > thresh:
+                    bsum = bsum + 1.0
+            cent[i] = cent[i] + bsum
 
-def centrality_binarize_double(np.ndarray[double, ndim=2] cmat, np.ndarray[double, ndim=1] cent, double thresh):
-    cdef unsigned int i,j
-    for i in xrange(cmat.shape[0]):
-        for j in xrange(cmat.shape[1]):
-            cent[i] += 1.0*(cmat[i,j] > thresh)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def centrality_binarize_double(double[:, :] cmat, double[:] cent,
+                               double thresh, int num_threads=1):
+    cdef Py_ssize_t i, j
+    cdef Py_ssize_t nrows = cmat.shape[0], ncols = cmat.shape[1]
+    cdef double bsum
+    with nogil:
+        for i in prange(nrows, num_threads=num_threads, schedule='static'):
+            bsum = 0
+            for j in range(ncols):
+                if cmat[i,j] > thresh:
+                    bsum = bsum + 1.0
+            cent[i] = cent[i] + bsum
 
 # Weighted
-def centrality_weighted_float(np.ndarray[float, ndim=2] cmat, np.ndarray[float, ndim=1] cent, float thresh):
-    cdef unsigned int i,j
-    for i in xrange(cmat.shape[0]):
-        for j in xrange(cmat.shape[1]):
-            cent[i] += cmat[i,j]*(cmat[i,j] > thresh)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def centrality_weighted_float(float[:, :] cmat, float[:] cent, float thresh,
+                              int num_threads=1):
+    cdef Py_ssize_t i, j
+    cdef Py_ssize_t nrows = cmat.shape[0], ncols = cmat.shape[1]
+    cdef float val, wsum
+    with nogil:
+        for i in prange(nrows, num_threads=num_threads, schedule='static'):
+            wsum = 0
+            for j in range(ncols):
+                val = cmat[i,j]
+                if val > thresh:
+                    wsum = wsum + val
+            cent[i] = cent[i] + wsum
 
-def centrality_weighted_double(np.ndarray[double, ndim=2] cmat, np.ndarray[double, ndim=1] cent, double thresh):
-    cdef unsigned int i,j
-    for i in xrange(cmat.shape[0]):
-        for j in xrange(cmat.shape[1]):
-            cent[i] += cmat[i,j]*(cmat[i,j] > thresh)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def centrality_weighted_double(double[:, :] cmat, double[:] cent,
+                               double thresh, int num_threads=1):
+    cdef Py_ssize_t i, j
+    cdef Py_ssize_t nrows = cmat.shape[0], ncols = cmat.shape[1]
+    cdef double val, wsum
+    with nogil:
+        for i in prange(nrows, num_threads=num_threads, schedule='static'):
+            wsum = 0
+            for j in range(ncols):
+                val = cmat[i,j]
+                if val > thresh:
+                    wsum = wsum + val
+            cent[i] = cent[i] + wsum
 
 # Both - Unweighted & Weighted
-def centrality_both_float(np.ndarray[float, ndim=2] cmat, np.ndarray[float, ndim=1] cent_uwt, np.ndarray[float, ndim=1] cent_wt, float thresh):
-    cdef unsigned int i,j
-    for i in xrange(cmat.shape[0]):
-        for j in xrange(cmat.shape[1]):
-            cent_uwt[i] += cmat[i,j]*(cmat[i,j] > thresh)
-            cent_wt[i]  += 1.0*(cmat[i,j] > thresh)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def centrality_both_float(float[:, :] cmat, float[:] cent_bin,
+                          float[:] cent_wt, float thresh, int num_threads=1):
+    cdef Py_ssize_t i, j
+    cdef Py_ssize_t nrows = cmat.shape[0], ncols = cmat.shape[1]
+    cdef float val, bsum, wsum
+    with nogil:
+        for i in prange(nrows, num_threads=num_threads, schedule='static'):
+            bsum = 0
+            wsum = 0
+            for j in range(ncols):
+                val = cmat[i,j]
+                if val > thresh:
+                    bsum = bsum + 1.0
+                    wsum = wsum + val
+            cent_bin[i] = cent_bin[i] + bsum
+            cent_wt[i] = cent_wt[i] + wsum
 
-def centrality_both_double(np.ndarray[double, ndim=2] cmat, np.ndarray[double, ndim=1] cent_bin, np.ndarray[double, ndim=1] cent_wt, double thresh):
-    cdef unsigned int i,j
-    for i in xrange(cmat.shape[0]):
-        for j in xrange(cmat.shape[1]):
-            cent_bin[i] += cmat[i,j]*(cmat[i,j] > thresh)
-            cent_wt[i]  += 1.0*(cmat[i,j] > thresh)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def centrality_both_double(double[:, :] cmat, double[:] cent_bin,
+                           double[:] cent_wt, double thresh,
+                           int num_threads=1):
+    cdef Py_ssize_t i, j
+    cdef Py_ssize_t nrows = cmat.shape[0], ncols = cmat.shape[1]
+    cdef double val, bsum, wsum
+    with nogil:
+        for i in prange(nrows, num_threads=num_threads, schedule='static'):
+            bsum = 0
+            wsum = 0
+            for j in range(ncols):
+                val = cmat[i,j]
+                if val > thresh:
+                    bsum = bsum + 1.0
+                    wsum = wsum + val
+            cent_bin[i] = cent_bin[i] + bsum
+            cent_wt[i] = cent_wt[i] + wsum
+
+
+###
+# Threshold and Multiply (Matrix-free Eigenvector Centrality)
+#
+# Each row of the correlation block is thresholded and multiplied into the
+# current eigenvector estimates, giving the block's rows of R_bin*v_bin and
+# R_wt*v_wt without ever storing the thresholded matrices.
+###
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def thresh_matvec_both_float(float[:, :] cmat, float[:] vec_bin,
+                             float[:] vec_wt, float[:] out_bin,
+                             float[:] out_wt, float thresh,
+                             int num_threads=1):
+    cdef Py_ssize_t i, j
+    cdef Py_ssize_t nrows = cmat.shape[0], ncols = cmat.shape[1]
+    cdef double val, bsum, wsum
+    with nogil:
+        for i in prange(nrows, num_threads=num_threads, schedule='static'):
+            bsum = 0
+            wsum = 0
+            for j in range(ncols):
+                val = cmat[i,j]
+                if val > thresh:
+                    bsum = bsum + vec_bin[j]
+                    wsum = wsum + val*vec_wt[j]
+            out_bin[i] = out_bin[i] + bsum
+            out_wt[i] = out_wt[i] + wsum
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def thresh_matvec_both_double(double[:, :] cmat, double[:] vec_bin,
+                              double[:] vec_wt, double[:] out_bin,
+                              double[:] out_wt, double thresh,
+                              int num_threads=1):
+    cdef Py_ssize_t i, j
+    cdef Py_ssize_t nrows = cmat.shape[0], ncols = cmat.shape[1]
+    cdef double val, bsum, wsum
+    with nogil:
+        for i in prange(nrows, num_threads=num_threads, schedule='static'):
+            bsum = 0
+            wsum = 0
+            for j in range(ncols):
+                val = cmat[i,j]
+                if val > thresh:
+                    bsum = bsum + vec_bin[j]
+                    wsum = wsum + val*vec_wt[j]
+            out_bin[i] = out_bin[i] + bsum
+            out_wt[i] = out_wt[i] + wsum
+
+
+###
+# Threshold and Cluster (lFCD)
+#
+# For each row of the correlation block, the size and summed correlation
+# of the seed voxel's cluster of supra-threshold neighbours are found by a
+# breadth-first search over the precomputed voxel adjacency (CSR indptr and
+# indices). Each thread keeps its own queue and visited stamps.
+###
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def lfcd_both_float(float[:, :] cmat, int[:] seeds, int[:] indptr,
+                    int[:] indices, float[:] cent_bin, float[:] cent_wt,
+                    float thresh, int num_threads=1):
+    cdef Py_ssize_t k
+    cdef Py_ssize_t nrows = cmat.shape[0], ncols = cmat.shape[1]
+    cdef int tid, stamp, seed, u, v, p, head, tail
+    cdef double wsum
+    cdef int[:, ::1] queue = np.zeros((num_threads, ncols), dtype=np.int32)
+    cdef int[:, ::1] visited = np.zeros((num_threads, ncols), dtype=np.int32)
+    with nogil:
+        for k in prange(nrows, num_threads=num_threads, schedule='dynamic'):
+            tid = threadid()
+            stamp = <int>k + 1
+            seed = seeds[k]
+            # Seed doesn't pass the threshold, it's its own cluster
+            if cmat[k,seed] <= thresh:
+                cent_bin[k] = 1
+                cent_wt[k] = 1
+                continue
+            # Breadth-first search of the seed's supra-threshold cluster
+            queue[tid,0] = seed
+            visited[tid,seed] = stamp
+            head = 0
+            tail = 1
+            wsum = 0
+            while head < tail:
+                u = queue[tid,head]
+                head = head + 1
+                wsum = wsum + cmat[k,u]
+                for p in range(indptr[u], indptr[u+1]):
+                    v = indices[p]
+                    if visited[tid,v] != stamp and cmat[k,v] > thresh:
+                        visited[tid,v] = stamp
+                        queue[tid,tail] = v
+                        tail = tail + 1
+            # An unconnected seed counts as one, as does its weight
+            if tail == 1:
+                cent_bin[k] = 1
+                cent_wt[k] = 1
+            else:
+                cent_bin[k] = tail
+                cent_wt[k] = wsum
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def lfcd_both_double(double[:, :] cmat, int[:] seeds, int[:] indptr,
+                    int[:] indices, double[:] cent_bin, double[:] cent_wt,
+                    double thresh, int num_threads=1):
+    cdef Py_ssize_t k
+    cdef Py_ssize_t nrows = cmat.shape[0], ncols = cmat.shape[1]
+    cdef int tid, stamp, seed, u, v, p, head, tail
+    cdef double wsum
+    cdef int[:, ::1] queue = np.zeros((num_threads, ncols), dtype=np.int32)
+    cdef int[:, ::1] visited = np.zeros((num_threads, ncols), dtype=np.int32)
+    with nogil:
+        for k in prange(nrows, num_threads=num_threads, schedule='dynamic'):
+            tid = threadid()
+            stamp = <int>k + 1
+            seed = seeds[k]
+            # Seed doesn't pass the threshold, it's its own cluster
+            if cmat[k,seed] <= thresh:
+                cent_bin[k] = 1
+                cent_wt[k] = 1
+                continue
+            # Breadth-first search of the seed's supra-threshold cluster
+            queue[tid,0] = seed
+            visited[tid,seed] = stamp
+            head = 0
+            tail = 1
+            wsum = 0
+            while head < tail:
+                u = queue[tid,head]
+                head = head + 1
+                wsum = wsum + cmat[k,u]
+                for p in range(indptr[u], indptr[u+1]):
+                    v = indices[p]
+                    if visited[tid,v] != stamp and cmat[k,v] > thresh:
+                        visited[tid,v] = stamp
+                        queue[tid,tail] = v
+                        tail = tail + 1
+            # An unconnected seed counts as one, as does its weight
+            if tail == 1:
+                cent_bin[k] = 1
+                cent_wt[k] = 1
+            else:
+                cent_bin[k] = tail
+                cent_wt[k] = wsum
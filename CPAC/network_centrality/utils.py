@@ -8,7 +8,8 @@ Network centrality utilities
 
 # Method to return recommended block size based on memory restrictions 
 def calc_blocksize(timeseries, memory_allocated=None, 
-                   include_full_matrix=False, sparsity_thresh=0.0):
+                   include_full_matrix=False, sparsity_thresh=0.0,
+                   num_workers=1):
     '''
     Method to calculate blocksize to calculate correlation matrix
     as per the memory allocated by the user. By default, the block
@@ -34,6 +35,11 @@ def calc_blocksize(timeseries, memory_allocated=None,
         a number between 0 and 1 that represents the number of
         connections to keep during sparsity thresholding.
         Default is 0.0.
+    num_workers : integer
+        the number of blocks held in memory at once by parallel
+        workers (see map_blocks); ignored for sparsity thresholding,
+        which runs its blocks in order.
+        Default is 1.
 
     Returns
     -------
@@ -70,56 +76,60 @@ def calc_blocksize(timeseries, memory_allocated=None,
     if memory_allocated:
         available_memory = memory_allocated * 1024.0**3  # assume it is in GB
         ## memory_for_block = # of seed voxels * nvoxs * nbytes
-        block_size = int( (available_memory - needed_memory)/(nvoxs*nbytes) )
+        ## and there is a block in memory for each worker
+        block_size = int( (available_memory - needed_memory)/\
+                          (num_workers*nvoxs*nbytes) )
         # If we're doing degree/sparisty thresholding, calculate block_size
         if sparsity_thresh:
             # k - block_size, v - nvoxs, d - nbytes, m - memory_allocated
-            # Polynomial for sparsity algorithm memory usage
-            # Solve for k: (-d/2 - 20.5)*k^2 + (41*v + d*v -d/2 - 20.5)*k - m = 0
+            # Per block: correlations (k*v*d), passing mask (k*v), copy of
+            # the passing values for the partial sort (k*v*d), and the
+            # triangle mask (k^2). The connections list is bounded by the
+            # number of connections kept, see calc_sparsity_list_memory
+            # Solve for k: k^2 + (2*d*v + v)*k - m = 0
+            memory_for_list = calc_sparsity_list_memory(nvoxs, nbytes,
+                                                        sparsity_thresh)
             coeffs = np.zeros(3)
-            coeffs[0] = -nbytes/2 - 20.5
-            coeffs[1] = 41*nvoxs + nbytes*nvoxs - nbytes/2 - 20.5
-            coeffs[2] = -(available_memory - needed_memory)
-            roots = np.roots(coeffs)
-            # If roots are complex, then the block_size needed to occupy all of
-            # the available memory is bigger than the number of voxels.
-            # So set block_size = nvoxs
-            if np.iscomplex(roots[0]):
-                block_size = nvoxs
-            # If the roots are real, test the roots for condition
+            coeffs[0] = 1
+            coeffs[1] = 2*nbytes*nvoxs + nvoxs
+            coeffs[2] = -(available_memory - needed_memory - memory_for_list)
+            # Take the positive root, if there is one
+            if coeffs[2] < 0:
+                root = np.roots(coeffs).max()
+                block_size = np.floor(root)
             else:
-                root = roots[np.where(roots <= nvoxs)]
-                root = root[np.where(root > 0)]
-                if len(root) == 1:
-                    block_size = np.floor(root[0])
-                else:
-                    block_size = 1000
+                block_size = 0
 
     # Test if calculated block size is beyond max/min limits
+    if sparsity_thresh:
+        num_workers = 1
     if block_size > nvoxs:
         block_size = nvoxs
     elif block_size < 1:
-        memory_usage = (needed_memory + 2.0*nvoxs*nbytes)/1024.0**3
+        memory_usage = (needed_memory + num_workers*nvoxs*nbytes)/1024.0**3
+        if sparsity_thresh:
+            memory_usage += calc_sparsity_list_memory(nvoxs, nbytes,
+                                                      sparsity_thresh)/1024.0**3
         raise MemoryError('Not enough memory available to perform degree '\
                           'centrality. Need a minimum of %.2fGB' % memory_usage)
 
+    # Spread the voxels over all of the workers if there is memory to spare
+    if num_workers*block_size > nvoxs:
+        block_size = np.ceil(float(nvoxs)/num_workers)
+
     # Convert block_size to an integer before returning
     block_size = int(block_size)
 
     # Return memory usage and block size
     if sparsity_thresh:
         # Calculate RAM usage by blocking algorithm
-        m = (-nbytes/2 - 20.5)*block_size**2 + \
-            (41*nvoxs + nbytes*nvoxs - nbytes/2 - 20.5)*block_size
-        # Calculate RAM usage by sparse matrix at end
-        max_conns = nvoxs**2-nvoxs
-        # Max number of connections * i + j (32-bit ints) + w
-        m2 = np.round(max_conns*sparsity_thresh)*(4 + 4 + nbytes)
-        if m2 > m:
-            m = m2
+        m = block_size**2 + (2*nbytes*nvoxs + nvoxs)*block_size
+        # Calculate RAM usage by connections list
+        m += calc_sparsity_list_memory(nvoxs, nbytes, sparsity_thresh)
         memory_usage = (needed_memory + m)/1024.0**3
     else:
-        memory_usage = (needed_memory + block_size*nvoxs*nbytes)/1024.0**3
+        memory_usage = (needed_memory + \
+                        num_workers*block_size*nvoxs*nbytes)/1024.0**3
 
     # Log information
     logger.info('block_size -> %i voxels' % block_size)
@@ -129,6 +139,195 @@ def calc_blocksize(timeseries, memory_allocated=None,
     return block_size
 
 
+# Run a function over blocks of rows on a pool of threads
+def map_blocks(block_func, nvoxs, block_size, num_workers=1):
+    '''
+    Method to schedule the row blocks [n, m) of an nvoxs x nvoxs
+    correlation matrix across a pool of worker threads. Each call of
+    block_func(n, m) computes its block and writes into its own slice
+    of output arrays shared by all workers, so no results are gathered.
+    The correlation (BLAS) and thresh-and-sum kernels release the GIL,
+    so the blocks run in parallel.
+
+    Note that each worker holds one block in memory at a time, so the
+    block size should come from calc_blocksize with the same number of
+    workers to stay within the allocated memory.
+
+    Parameters
+    ----------
+    block_func : function
+        function taking the start and end row indices of a block
+    nvoxs : integer
+        number of rows (voxels) to cover
+    block_size : integer
+        the number of rows in each block
+    num_workers : integer (optional); default=1
+        the number of blocks to compute at any one time
+
+    Returns
+    -------
+    None
+    '''
+
+    # Import packages
+    from multiprocessing.pool import ThreadPool
+
+    # Init the list of (start, end) rows of each block
+    blocks = [(n, min(n+block_size, nvoxs)) \
+              for n in range(0, nvoxs, block_size)]
+    num_workers = max(1, min(num_workers, len(blocks)))
+
+    # Run blocks in order, or scheduled across the pool
+    if num_workers == 1:
+        for n, m in blocks:
+            block_func(n, m)
+    else:
+        pool = ThreadPool(num_workers)
+        try:
+            pool.map(lambda block: block_func(*block), blocks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+
+# Memory needed by the connections list during sparsity thresholding
+def calc_sparsity_list_memory(nvoxs, nbytes, sparsity_thresh):
+    '''
+    Method to calculate the peak memory (in bytes) used by the list of
+    the strongest connections kept during sparsity thresholding. The
+    list holds at most K = sparsity_thresh*(nvoxs^2-nvoxs)/2 connections;
+    at its peak, the K kept connections are merged with up to K new
+    connections from a block, each stored as a weight (nbytes) and
+    i, j indices (int64 from np.nonzero, then int32), and an argpartition
+    index (int64) is taken over the merged list.
+
+    Parameters
+    ----------
+    nvoxs : integer
+        number of voxels
+    nbytes : integer
+        number of bytes of the correlation datatype
+    sparsity_thresh : float
+        a number between 0 and 1 that represents the number of
+        connections to keep during sparsity thresholding
+
+    Returns
+    -------
+    memory : float
+        number of bytes needed by the connections list
+    '''
+
+    # Import packages
+    import numpy as np
+
+    sparse_num = np.round((nvoxs**2-nvoxs)*sparsity_thresh/2.0)
+
+    # kept list (w, i, j) + new block list (w, int64 i, j and int32 copies)
+    # + merged list (w, i, j) + argpartition indices
+    memory = sparse_num*(nbytes + 8) + \
+             sparse_num*(nbytes + 16 + 8) + \
+             2*sparse_num*(nbytes + 8) + \
+             2*sparse_num*8
+
+    return memory
+
+
+# Select the strongest passing connections from a block of correlations
+def select_top_k(rmat_block, r_value, k):
+    '''
+    Method to select the (at most k) largest correlations in a block that
+    are greater than or equal to a threshold. The k-th largest value is
+    found with a partial sort (np.partition) instead of sorting the block.
+
+    Parameters
+    ----------
+    rmat_block : numpy array
+        block of the correlation matrix: `block_size` x `nvoxs`
+    r_value : float
+        correlation threshold, only values >= r_value are kept
+    k : integer
+        maximum number of connections to keep
+
+    Returns
+    -------
+    w : numpy array
+        weights of the selected connections
+    i : numpy array
+        row indices into rmat_block of the selected connections
+    j : numpy array
+        column indices into rmat_block of the selected connections
+    '''
+
+    # Import packages
+    import numpy as np
+
+    # Find everything passing the threshold
+    passing = rmat_block >= r_value
+    num_passing = np.count_nonzero(passing)
+
+    # If more than k pass, raise the threshold to the k-th largest value
+    if num_passing > k:
+        if k == 0:
+            passing[:] = False
+        else:
+            vals = rmat_block[passing]
+            r_value = np.partition(vals, num_passing-k)[num_passing-k]
+            del vals
+            passing = rmat_block >= r_value
+
+    i, j = np.nonzero(passing)
+    del passing
+    w = rmat_block[i, j]
+
+    # Ties at the k-th value may leave a few extra, trim them off
+    if len(w) > k:
+        keep = np.argpartition(w, len(w)-k)[len(w)-k:]
+        w, i, j = w[keep], i[keep], j[keep]
+
+    return w, i, j
+
+
+# Merge two lists of connections keeping the k strongest
+def merge_top_k(wij_a, wij_b, k):
+    '''
+    Method to merge two (w, i, j) lists of connections into one list of
+    the (at most k) strongest connections using a partial sort
+    (np.argpartition), so the merged list is never fully sorted.
+
+    Parameters
+    ----------
+    wij_a : tuple (numpy array, numpy array, numpy array)
+        weights, row and column indices of the first list
+    wij_b : tuple (numpy array, numpy array, numpy array)
+        weights, row and column indices of the second list
+    k : integer
+        maximum number of connections to keep
+
+    Returns
+    -------
+    w : numpy array
+        weights of the merged connections (unsorted)
+    i : numpy array
+        row indices of the merged connections
+    j : numpy array
+        column indices of the merged connections
+    '''
+
+    # Import packages
+    import numpy as np
+
+    w = np.concatenate([wij_a[0], wij_b[0]])
+    i = np.concatenate([wij_a[1], wij_b[1]])
+    j = np.concatenate([wij_a[2], wij_b[2]])
+
+    # Trim the list down to the k largest weights
+    if len(w) > k:
+        keep = np.argpartition(w, len(w)-k)[len(w)-k:]
+        w, i, j = w[keep], i[keep], j[keep]
+
+    return w, i, j
+
+
 # Method to calculate correlation coefficient from (one or two) datasets
 def calc_corrcoef(X, Y=None):
     '''
@@ -199,6 +398,72 @@ def cluster_data(img, thr, xyz_a, k=26):
     return lbl_img
 
 
+# Method to compute the neighbourhood graph of the voxels in a mask
+def calc_neighbor_adjacency(mask, k=26):
+    '''
+    Method to compute the adjacency matrix of the voxels in a mask, where
+    each voxel is connected to its face (6), edge (18) and corner (26)
+    neighbours within the mask. Rows and columns follow the order of
+    np.argwhere(mask), i.e. the order of the masked timeseries. This is
+    computed once per mask so the lFCD clusters of all seeds can be found
+    over the same graph (used in lFCD).
+
+    Parameters
+    ----------
+    mask : numpy array
+        three dimensional array with non-zero elements for the voxels
+    k : integer (optional); default=26
+        neighboring system, equal to 6, 18, or 26
+
+    Returns
+    -------
+    adjacency : scipy.sparse.csr_matrix
+        boolean, symmetric `nvoxs` x `nvoxs` adjacency matrix
+    '''
+
+    # Import packages
+    import itertools
+    import numpy as np
+    import scipy.sparse as sparse
+
+    if k not in [6, 18, 26]:
+        raise Exception("k must be one of 6, 18 or 26 and not %s" % str(k))
+
+    # Map each voxel to its index in the mask, -1 outside the mask, and pad
+    # by a voxel so that the shifted neighbours stay in bounds
+    mask = np.asarray(mask).astype('bool')
+    nvoxs = np.count_nonzero(mask)
+    idx_vol = -np.ones(mask.shape, dtype='int64')
+    idx_vol[mask] = np.arange(nvoxs)
+    idx_vol = np.pad(idx_vol, 1, mode='constant', constant_values=-1)
+    nx, ny, nz = mask.shape
+    src = idx_vol[1:nx+1, 1:ny+1, 1:nz+1]
+
+    # Pair each voxel with the neighbour at each offset in one half of the
+    # neighbourhood; the other half comes from symmetry
+    i_list = []
+    j_list = []
+    max_dist = {6 : 1, 18 : 2, 26 : 3}[k]
+    for dx, dy, dz in itertools.product([-1, 0, 1], repeat=3):
+        if (dx, dy, dz) <= (0, 0, 0) or abs(dx)+abs(dy)+abs(dz) > max_dist:
+            continue
+        dst = idx_vol[1+dx:nx+1+dx, 1+dy:ny+1+dy, 1+dz:nz+1+dz]
+        valid = (src >= 0) & (dst >= 0)
+        i_list.append(src[valid])
+        j_list.append(dst[valid])
+    i = np.concatenate(i_list)
+    j = np.concatenate(j_list)
+    del i_list, j_list
+
+    # Create the symmetric sparse adjacency matrix
+    adjacency = sparse.coo_matrix((np.ones(2*len(i), dtype='bool'),
+                                   (np.concatenate([i, j]),
+                                    np.concatenate([j, i]))),
+                                  shape=(nvoxs, nvoxs)).tocsr()
+
+    return adjacency
+
+
 # Convert probability threshold value to correlation threshold
 def convert_pvalue_to_r(datafile, p_value, two_tailed=False):
     '''
@@ -336,7 +601,8 @@ def map_centrality_matrix(centrality_matrix, aff, mask, template_type):
     aff : ndarray
         Affine matrix of the input data
     mask : ndarray
-        Mask or roi data matrix
+        Mask, or for a roi template the label volume whose labels, in
+        ascending order, correspond to the values of the centrality matrix
     template_type : int
         type of template: 0 for mask, 1 for roi
 
@@ -355,6 +621,7 @@ def map_centrality_matrix(centrality_matrix, aff, mask, template_type):
     import nibabel as nib
     import numpy as np
     from nipype import logging
+    from CPAC.utils import volumize, volumize_labels
 
     # Init logger
     logger = logging.getLogger('workflow')
@@ -363,32 +630,17 @@ def map_centrality_matrix(centrality_matrix, aff, mask, template_type):
         out_file, matrix = centrality_matrix
 
         out_file = os.path.join(os.getcwd(), out_file + '.nii.gz')
-        sparse_m = np.zeros((mask.shape), dtype=float)
 
         logger.info('mapping centrality matrix to nifti image: %s' % out_file)
 
+        # One value per voxel/node
+        matrix = np.asarray(matrix, dtype=float).reshape(-1)
+
         if int(template_type) == 0:
-            cords = np.argwhere(mask)
-            index=0
-            for val in cords:
-                x,y,z=val
-                sparse_m[x,y,z]= matrix[index]
-                index+=1
+            sparse_m = volumize(matrix, mask)
 
         elif int(template_type) == 1:
-            nodes = np.unique(mask).tolist()
-            nodes.sort()
-            index = 0
-            for n in nodes:
-                if n> 0:
-                    cords = np.argwhere(mask==n)
-                    for val in cords:
-                        x,y,z = val
-                        if isinstance(matrix[index], list):
-                            sparse_m[x,y,z] = matrix[index][0]
-                        else:
-                            sparse_m[x,y,z]=matrix[index]
-                    index+=1
+            sparse_m = volumize_labels(matrix, mask)
 
         nifti_img = nib.Nifti1Image(sparse_m, aff)
         nifti_img.to_filename(out_file)
@@ -447,11 +699,36 @@ def sep_nifti_subbriks(nifti_file, out_names):
 
 
 # Calculate eigenvector centrality from one_d file
-def parse_and_return_mats(one_d_file, mask_arr):
+def parse_and_return_mats(one_d_file, mask_arr, chunk_size=1000000):
     '''
+    Method to read the sparse similarity matrix written out by AFNI's
+    3dDegreeCentrality (-out1D) and return it as binarized and weighted
+    symmetric sparse matrices indexed by the voxels in the mask.
+
+    The file is read chunk_size rows at a time, so only the i, j, w
+    arrays of the edges are kept in memory, and each (i,j,k) voxel is
+    mapped to its mask index through a lookup table on the flat voxel
+    index.
+
+    Parameters
+    ----------
+    one_d_file : string
+        filepath to the 1D graph output from 3dDegreeCentrality
+    mask_arr : numpy array
+        three dimensional mask array the graph was computed in
+    chunk_size : integer (optional); default=1000000
+        the number of rows (edges) to parse at any one time
+
+    Returns
+    -------
+    b_similarity_matrix : scipy.sparse matrix
+        binarized, symmetric similarity matrix: `nvoxs` x `nvoxs`
+    w_similarity_matrix : scipy.sparse matrix
+        weighted, symmetric similarity matrix: `nvoxs` x `nvoxs`
     '''
 
     # Import packages
+    import itertools
     import numpy as np
     import scipy.sparse as sparse
     from nipype import logging
@@ -459,35 +736,59 @@ def parse_and_return_mats(one_d_file, mask_arr):
     # Init logger
     logger = logging.getLogger('workflow')
 
-    # Parse out numbers
+    # Non-zero elements from mask is size of similarity matrix
+    mask_arr = np.asarray(mask_arr).astype('bool')
+    mask_voxs = np.count_nonzero(mask_arr)
+
+    # Lookup table from the flat voxel index to the mask index
+    mask_lut = -np.ones(mask_arr.size, dtype='int32')
+    mask_lut[np.flatnonzero(mask_arr)] = np.arange(mask_voxs, dtype='int32')
+
+    # Parse out numbers, chunk by chunk
     logger.info('Parsing contents...')
-    graph_arr = np.loadtxt(one_d_file, skiprows=6)
+    i_list = []
+    j_list = []
+    w_list = []
+    with open(one_d_file, 'r') as one_d_fid:
+        # Skip over header
+        for line in itertools.islice(one_d_fid, 6):
+            pass
+        while True:
+            lines = list(itertools.islice(one_d_fid, chunk_size))
+            if not lines:
+                break
+            graph_arr = np.loadtxt(lines, ndmin=2)
+            del lines
+
+            # Extract 3d indices and map them to mask indices
+            ijk1 = graph_arr[:, 2:5].astype('int64')
+            ijk2 = graph_arr[:, 5:8].astype('int64')
+            i_list.append(mask_lut[np.ravel_multi_index(ijk1.T,
+                                                        mask_arr.shape)])
+            j_list.append(mask_lut[np.ravel_multi_index(ijk2.T,
+                                                        mask_arr.shape)])
+            # Weighted array
+            w_list.append(graph_arr[:,-1].astype('float32'))
+            del graph_arr, ijk1, ijk2
 
     # Cast as numpy arrays and extract i, j, w
     logger.info('Creating arrays...')
-    one_d_rows = graph_arr.shape[0]
-
-    # Extract 3d indices
-    ijk1 = graph_arr[:, 2:5].astype('int32')
-    ijk2 = graph_arr[:, 5:8].astype('int32')
-    # Weighted array and binarized array
-    w_arr = graph_arr[:,-1].astype('float32')
-    del graph_arr
-    b_arr = np.ones(w_arr.shape)
+    if w_list:
+        i_arr = np.concatenate(i_list)
+        j_arr = np.concatenate(j_list)
+        w_arr = np.concatenate(w_list)
+    else:
+        i_arr = j_arr = np.array([], dtype='int32')
+        w_arr = np.array([], dtype='float32')
+    del i_list, j_list, w_list
 
-    # Non-zero elements from mask is size of similarity matrix
-    mask_idx = np.argwhere(mask_arr)
-    mask_voxs = mask_idx.shape[0]
-
-    # Extract the ijw's from 1D file
-    i_arr = [np.where((mask_idx == ijk1[ii]).all(axis=1))[0][0] \
-             for ii in range(one_d_rows)]
-    del ijk1
-    j_arr = [np.where((mask_idx == ijk2[ii]).all(axis=1))[0][0] \
-             for ii in range(one_d_rows)]
-    del ijk2
-    i_arr = np.array(i_arr, dtype='int32')
-    j_arr = np.array(j_arr, dtype='int32')
+    # Make sure all of the voxels were in the mask
+    if len(i_arr) and (i_arr.min() < 0 or j_arr.min() < 0):
+        err_msg = 'Voxels in the 1D file %s are not in the mask' % one_d_file
+        raise Exception(err_msg)
+
+    # Binarized array
+    b_arr = np.ones(w_arr.shape)
 
     # Construct the sparse matrix
     logger.info('Constructing sparse matrix...')
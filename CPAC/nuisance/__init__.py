@@ -1,4 +1,7 @@
 from utils import calc_compcor_components, \
+                  calc_regression_basis, \
+                  MaskedFunctional, \
+                  regress_out, \
                   erode_mask
 
 from nuisance import create_nuisance, \
@@ -10,5 +13,8 @@ __all__ = ['create_nuisance', \
            'calc_residuals', \
            'bandpass_voxels', \
            'calc_compcor_components', \
+           'calc_regression_basis', \
+           'MaskedFunctional', \
+           'regress_out', \
            'erode_mask', \
            'extract_tissue_data']
\ No newline at end of file
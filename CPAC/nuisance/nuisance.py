@@ -7,7 +7,8 @@ import nipype.interfaces.ants as ants
 #logger = logging.getLogger('workflow')
 
 
-def bandpass_voxels(realigned_file, bandpass_freqs, sample_period=None):
+def bandpass_voxels(realigned_file, bandpass_freqs, sample_period=None, 
+                    chunk_size=10000, num_threads=1):
     """
     Performs ideal bandpass filtering on each voxel time-series.
     
@@ -20,6 +21,10 @@ def bandpass_voxels(realigned_file, bandpass_freqs, sample_period=None):
     sample_period : float, optional
         Length of sampling period in seconds.  If not specified,
         this value is read from the nifti file provided.
+    chunk_size : integer, optional
+        Number of voxels to filter at once.
+    num_threads : integer, optional
+        Number of threads filtering chunks of voxels in parallel.
         
     Returns
     -------
@@ -28,13 +33,20 @@ def bandpass_voxels(realigned_file, bandpass_freqs, sample_period=None):
     
     """
 
+    import os
+    import numpy as np
+    import nibabel as nb
+    from numpy.fft import rfft, irfft
+    from multiprocessing.pool import ThreadPool
+
     def ideal_bandpass(data, sample_period, bandpass_freqs):
         # Derived from YAN Chao-Gan 120504 based on REST.
+        # Filters every column of data (timepoints x voxels) at once, the
+        # signal is real so only the positive frequencies are kept
         sample_freq = 1. / sample_period
         sample_length = data.shape[0]
         
-        data_p = np.zeros(int(2**np.ceil(np.log2(sample_length))))
-        data_p[:sample_length] = data
+        n_p = int(2**np.ceil(np.log2(sample_length)))
 
         LowCutoff, HighCutoff = bandpass_freqs
 
@@ -42,27 +54,40 @@ def bandpass_voxels(realigned_file, bandpass_freqs, sample_period=None):
             low_cutoff_i = 0
         elif (LowCutoff > sample_freq / 2.):
             # Cutoff beyond fs/2 (all-stop filter)
-            low_cutoff_i = int(data_p.shape[0] / 2)
+            low_cutoff_i = int(n_p / 2)
         else:
             low_cutoff_i = np.ceil(
-                LowCutoff * data_p.shape[0] * sample_period).astype('int')
+                LowCutoff * n_p * sample_period).astype('int')
 
         if (HighCutoff > sample_freq / 2. or HighCutoff is None):
             # Cutoff beyond fs/2 or unspecified (become a highpass filter)
-            high_cutoff_i = int(data_p.shape[0] / 2)
+            high_cutoff_i = int(n_p / 2)
         else:
             high_cutoff_i = np.fix(
-                HighCutoff * data_p.shape[0] * sample_period).astype('int')
+                HighCutoff * n_p * sample_period).astype('int')
 
-        freq_mask = np.zeros_like(data_p, dtype='bool')
+        freq_mask = np.zeros(n_p // 2 + 1, dtype='bool')
         freq_mask[low_cutoff_i:high_cutoff_i + 1] = True
-        freq_mask[
-        data_p.shape[0] - high_cutoff_i:data_p.shape[
-                                            0] + 1 - low_cutoff_i] = True
 
-        f_data = fft(data_p)
-        f_data[freq_mask != True] = 0.
-        data_bp = np.real_if_close(ifft(f_data)[:sample_length])
+        def filter_chunk(start):
+            # the time-series are zero padded to n_p by rfft
+            f_data = rfft(data[:, start:start + chunk_size], n=n_p, axis=0)
+            f_data[freq_mask != True] = 0.
+            data_bp[:, start:start + chunk_size] = \
+                irfft(f_data, n=n_p, axis=0)[:sample_length]
+
+        data_bp = np.zeros_like(data)
+        starts = range(0, data.shape[1], chunk_size)
+        if num_threads > 1:
+            pool = ThreadPool(num_threads)
+            try:
+                pool.map(filter_chunk, starts)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for start in starts:
+                filter_chunk(start)
 
         return data_bp
 
@@ -79,9 +104,7 @@ def bandpass_voxels(realigned_file, bandpass_freqs, sample_period=None):
         if sample_period > 20.0:
             sample_period /= 1000.0
 
-    Y_bp = np.zeros_like(Y)
-    for j in range(Y.shape[1]):
-        Y_bp[:, j] = ideal_bandpass(Yc[:, j], sample_period, bandpass_freqs)
+    Y_bp = ideal_bandpass(Yc, sample_period, bandpass_freqs)
         
     data[mask] = Y_bp.T
     img = nb.Nifti1Image(data, header=nii.get_header(),
@@ -101,7 +124,9 @@ def calc_residuals(subject,
                    gm_sig_file = None,
                    motion_file = None,
                    compcor_ncomponents = 0,
-                   frames_ex=None):
+                   frames_ex=None,
+                   use_float32=False,
+                   chunk_size=10000):
     """
     Calculates residuals of nuisance regressors for every voxel for a subject.
     
@@ -123,6 +148,11 @@ def calc_residuals(subject,
     frames_ex : string, optional
         Filepath to the 1D file describing the volumes to be excluded (for
         de-spiking), selected via the threshold set for excessive motion.
+    use_float32 : boolean, optional
+        Hold the functional data in single precision to halve its memory,
+        the regression itself is still done in double precision.
+    chunk_size : integer, optional
+        Number of voxels to regress at once.
         
     Returns
     -------
@@ -148,53 +178,55 @@ def calc_residuals(subject,
     >>> 'quadratic' : True}
     """
     
-    nii = nb.load(subject)
-    data = nii.get_data().astype(np.float64)
-    global_mask = (data != 0).sum(-1) != 0
+    if use_float32:
+        func = MaskedFunctional(subject, np.float32)
+    else:
+        func = MaskedFunctional(subject, np.float64)
+    ntimepoints = func.ntimepoints
     
     # Check and define regressors which are provided from files
     if wm_sig_file is not None:
         wm_sigs = np.load(wm_sig_file)
-        if wm_sigs.shape[1] != data.shape[3]:
+        if wm_sigs.shape[1] != ntimepoints:
             raise ValueError('White matter signals length {0} do not match '
                              'data timepoints {1}'.format(wm_sigs.shape[1], 
-                                                          data.shape[3]))
+                                                          ntimepoints))
         if wm_sigs.size == 0:
             raise ValueError('White matter signal file {0} is '
                              'empty'.format(wm_sig_file))
         
     if csf_sig_file is not None:
         csf_sigs = np.load(csf_sig_file)
-        if csf_sigs.shape[1] != data.shape[3]:
+        if csf_sigs.shape[1] != ntimepoints:
             raise ValueError('CSF signals length {0} do not match data '
                              'timepoints {1}'.format(csf_sigs.shape[1], 
-                                                     data.shape[3]))
+                                                     ntimepoints))
         if csf_sigs.size == 0:
             raise ValueError('CSF signal file {0} is '
                              'empty'.format(csf_sig_file))
         
     if gm_sig_file is not None:
         gm_sigs = np.load(gm_sig_file)
-        if gm_sigs.shape[1] != data.shape[3]:
+        if gm_sigs.shape[1] != ntimepoints:
             raise ValueError('Grey matter signals length {0} do not match '
                              'data timepoints {1}'.format(gm_sigs.shape[1], 
-                                                          data.shape[3]))
+                                                          ntimepoints))
         if gm_sigs.size == 0:
             raise ValueError('Grey matter signal file {0} is '
                              'empty'.format(gm_sig_file))
         
     if motion_file is not None:
         motion = np.genfromtxt(motion_file)
-        if motion.shape[0] != data.shape[3]:
+        if motion.shape[0] != ntimepoints:
             raise ValueError('Motion parameters {0} do not match data '
                              'timepoints {1}'.format(motion.shape[0], 
-                                                     data.shape[3]))
+                                                     ntimepoints))
         if motion.size == 0:
             raise ValueError('Motion signal file {0} is '
                              'empty'.format(motion_file))
 
     # Calculate regressors
-    regressor_map = {'constant': np.ones((data.shape[3], 1))}
+    regressor_map = {'constant': np.ones((ntimepoints, 1))}
 
     if selector['compcor']:
         if not wm_sig_file:
@@ -207,8 +239,7 @@ def calc_residuals(subject,
             raise Exception(err)
 
         regressor_map['compcor'] = \
-            calc_compcor_components(data, compcor_ncomponents,
-                                    wm_sigs, csf_sigs)
+            calc_compcor_components(compcor_ncomponents, wm_sigs, csf_sigs)
     
     if selector['wm']:
         regressor_map['wm'] = wm_sigs.mean(0)
@@ -220,32 +251,29 @@ def calc_residuals(subject,
         regressor_map['gm'] = gm_sigs.mean(0)
         
     if selector['global']:
-        regressor_map['global'] = data[global_mask].mean(0)
+        regressor_map['global'] = func.global_signal()
         
     if selector['pc1']:
-        bdata = data[global_mask].T
-        bdatac = bdata - np.tile(bdata.mean(0), (bdata.shape[0], 1))
-        U, S, Vh = np.linalg.svd(bdatac, full_matrices=False)
-        regressor_map['pc1'] = U[:, 0]
+        regressor_map['pc1'] = func.pc1()
         
     if selector['motion']:
         regressor_map['motion'] = motion
         
     if selector['linear']:
-        regressor_map['linear'] = np.arange(0, data.shape[3])
+        regressor_map['linear'] = np.arange(0, ntimepoints)
     
     if selector['quadratic']:
-        regressor_map['quadratic'] = np.arange(0, data.shape[3])**2
+        regressor_map['quadratic'] = np.arange(0, ntimepoints)**2
 
     # insert the de-spiking regressor matrix here, if running de-spiking
     if frames_ex:
-        despike_mat = create_despike_regressor_matrix(frames_ex, nii.shape[3])
+        despike_mat = create_despike_regressor_matrix(frames_ex, ntimepoints)
         # this needs to be "is not None" instead of "if despike_mat:" because
         # despike_mat could be either a Numpy array or None
         if despike_mat is not None:
             regressor_map['despike'] = despike_mat
 
-    X = np.zeros((data.shape[3], 1))
+    X = np.zeros((ntimepoints, 1))
     csv_filename = ''
     for rname, rval in regressor_map.items():
         X = np.hstack((X, rval.reshape(rval.shape[0],-1)))
@@ -260,10 +288,8 @@ def calc_residuals(subject,
     if np.isnan(X).any() or np.isnan(X).any():
         raise ValueError('Regressor file contains NaN')
 
-    Y = data[global_mask].T
-
     try:
-        B = np.linalg.inv(X.T.dot(X)).dot(X.T).dot(Y)
+        Q = calc_regression_basis(X)
     except np.linalg.LinAlgError as e:
         if "Singular matrix" in e:
             raise Exception("Error details: {0}\n\nSingular matrix error: "
@@ -277,12 +303,9 @@ def calc_residuals(subject,
             raise Exception("Error details: {0}\n\nSomething went wrong with "
                             "nuisance regression.\n\n".format(e))
 
-    Y_res = Y - X.dot(B)
-    
-    data[global_mask] = Y_res.T
+    regress_out(func.matrix, Q, chunk_size)
     
-    img = nb.Nifti1Image(data, header=nii.get_header(),
-                         affine=nii.get_affine())
+    img = func.to_image()
     residual_file = os.path.join(os.getcwd(), 'residual.nii.gz')
     img.to_filename(residual_file)
     
@@ -306,10 +329,13 @@ def extract_tissue_data(data_file,
     import nibabel as nb
     import os    
     from CPAC.nuisance import erode_mask
+    from CPAC.nuisance.utils import MaskedFunctional
     from CPAC.utils import safe_shape
 
+    # the signals of each tissue are read from the one (memory-mapped) image
     try:
-        data = nb.load(data_file).get_data().astype('float64')
+        func = MaskedFunctional(data_file)
+        data = func.data
     except:
         raise MemoryError('Unable to load %s' % data_file)
 
@@ -333,7 +359,7 @@ def extract_tissue_data(data_file,
                          'do not match')
 
     wm_mask = erode_mask(wm_seg > 0)
-    wm_sigs = data[wm_mask]
+    wm_sigs = func.signals(wm_mask)
     file_wm = os.path.join(os.getcwd(), 'wm_signals.npy')
     np.save(file_wm, wm_sigs)
     del wm_sigs
@@ -350,7 +376,7 @@ def extract_tissue_data(data_file,
     # Only take the CSF at the lateral ventricles as labeled in the Harvard
     # Oxford parcellation regions 4 and 43
     csf_mask = (csf_seg > 0)*(lat_ventricles_mask==1)
-    csf_sigs = data[csf_mask]
+    csf_sigs = func.signals(csf_mask)
     file_csf = os.path.join(os.getcwd(), 'csf_signals.npy')
     np.save(file_csf, csf_sigs)
     del csf_sigs
@@ -365,7 +391,7 @@ def extract_tissue_data(data_file,
                          'segment do not match')
 
     gm_mask = erode_mask(gm_seg > 0)
-    gm_sigs = data[gm_mask]
+    gm_sigs = func.signals(gm_mask)
     file_gm = os.path.join(os.getcwd(), 'gm_signals.npy')
     np.save(file_gm, gm_sigs)
     del gm_sigs
@@ -551,7 +577,8 @@ def create_nuisance(use_ants, name='nuisance'):
     calc_imports = ['import os', 'import scipy', 'import numpy as np',
                     'import nibabel as nb', 
                     'from CPAC.nuisance import calc_compcor_components',
-                    'from CPAC.nuisance.utils import create_despike_regressor_matrix']
+                    'from CPAC.nuisance.utils import create_despike_regressor_matrix, '
+                    'calc_regression_basis, regress_out, MaskedFunctional']
     calc_r = pe.Node(util.Function(input_names=['subject',
                                                 'selector',
                                                 'wm_sig_file',
@@ -559,7 +586,9 @@ def create_nuisance(use_ants, name='nuisance'):
                                                 'gm_sig_file',
                                                 'motion_file',
                                                 'compcor_ncomponents',
-                                                'frames_ex'],
+                                                'frames_ex',
+                                                'use_float32',
+                                                'chunk_size'],
                                    output_names=['residual_file',
                                                  'regressors_file'],
                                    function=calc_residuals,
@@ -25,6 +25,70 @@ def test_calc_residuals_compcor():
 
 
 
+def test_regress_out():
+    import numpy as np
+    from CPAC.nuisance import calc_regression_basis, regress_out
+
+    X = np.hstack((np.ones((100, 1)), np.arange(100).reshape(100, 1),
+                   np.random.randn(100, 5)))
+    Y = np.random.randn(300, 100)
+
+    B = np.linalg.lstsq(X, Y.T)[0]
+    Y_res = Y.T - X.dot(B)
+
+    Q = calc_regression_basis(X)
+    np.testing.assert_allclose(regress_out(Y.copy(), Q, 37), Y_res.T,
+                               atol=1e-10)
+    np.testing.assert_allclose(regress_out(Y.astype('float32'), Q, 37),
+                               Y_res.T, atol=1e-5)
+
+    # linearly dependent regressors
+    np.testing.assert_raises(np.linalg.LinAlgError, calc_regression_basis,
+                             np.hstack((X, 2*X[:, 1:2])))
+
+
+def test_erode_mask():
+    import numpy as np
+    from CPAC.nuisance import erode_mask
+
+    # the voxel-by-voxel implementation erode_mask replaced
+    def erode_mask_loop(data):
+        mask = data != 0
+        eroded_mask = np.zeros_like(data, dtype='bool')
+        max_x, max_y, max_z = data.shape
+        x,y,z = np.where(data != 0)
+        for i in range(x.shape[0]):
+            if (max_x-1) == x[i] or \
+               (max_y-1) == y[i] or \
+               (max_z-1) == z[i] or \
+               x[i] == 0 or \
+               y[i] == 0 or \
+               z[i] == 0:
+                eroded_mask[x[i],y[i],z[i]] = False
+            else:
+                eroded_mask[x[i],y[i],z[i]] = mask[x[i], y[i], z[i]] * \
+                                              mask[x[i] + 1, y[i], z[i]] * \
+                                              mask[x[i], y[i] + 1, z[i]] * \
+                                              mask[x[i], y[i], z[i] + 1] * \
+                                              mask[x[i] - 1, y[i], z[i]] * \
+                                              mask[x[i], y[i] - 1, z[i]] * \
+                                              mask[x[i], y[i], z[i] - 1]
+
+        eroded_data = np.zeros_like(data)
+        eroded_data[eroded_mask] = data[eroded_mask]
+
+        return eroded_data
+
+    np.random.seed(0)
+    seg = np.random.rand(20, 22, 18) * (np.random.rand(20, 22, 18) > 0.2)
+    seg[:, :, 0] = 1
+
+    for data in [seg, seg > 0.3, np.ones((5, 5, 5))]:
+        eroded = erode_mask(data)
+        np.testing.assert_equal(eroded.dtype, data.dtype)
+        np.testing.assert_array_equal(eroded, erode_mask_loop(data))
+
+
 def test_calc_residuals():
     import numpy as np
     from CPAC.nuisance import calc_residuals
@@ -131,3 +195,135 @@ def test_nuisance():
     cn.inputs.inputspec.harvard_oxford_mask = '/usr/share/fsl/4.1/data/atlases/HarvardOxford/HarvardOxford-sub-maxprob-thr25-2mm.nii.gz'
     cn.inputs.inputspec.subject = '/home/data/PreProc/ABIDE_CPAC_test_1/pipeline_0/0050102_session_1/preprocessed/_scan_rest_1_rest/rest_3dc_RPI_3dv_3dc_maths.nii.gz'
     cn.base_dir = '/home/bcheung/cn_run'
+
+
+def test_bandpass_voxels():
+    import os
+    import tempfile
+    import numpy as np
+    import nibabel as nb
+    from numpy.fft import fft, ifft
+    from CPAC.nuisance import bandpass_voxels
+
+    # the voxel-by-voxel filter bandpass_voxels replaced
+    def ideal_bandpass(data, sample_period, bandpass_freqs):
+        sample_freq = 1. / sample_period
+        sample_length = data.shape[0]
+
+        data_p = np.zeros(int(2**np.ceil(np.log2(sample_length))))
+        data_p[:sample_length] = data
+
+        LowCutoff, HighCutoff = bandpass_freqs
+
+        if (LowCutoff is None):
+            low_cutoff_i = 0
+        elif (LowCutoff > sample_freq / 2.):
+            low_cutoff_i = int(data_p.shape[0] / 2)
+        else:
+            low_cutoff_i = np.ceil(
+                LowCutoff * data_p.shape[0] * sample_period).astype('int')
+
+        if (HighCutoff > sample_freq / 2. or HighCutoff is None):
+            high_cutoff_i = int(data_p.shape[0] / 2)
+        else:
+            high_cutoff_i = np.fix(
+                HighCutoff * data_p.shape[0] * sample_period).astype('int')
+
+        freq_mask = np.zeros_like(data_p, dtype='bool')
+        freq_mask[low_cutoff_i:high_cutoff_i + 1] = True
+        freq_mask[data_p.shape[0] - high_cutoff_i:
+                  data_p.shape[0] + 1 - low_cutoff_i] = True
+
+        f_data = fft(data_p)
+        f_data[freq_mask != True] = 0.
+        return np.real_if_close(ifft(f_data)[:sample_length])
+
+    np.random.seed(27)
+    out_dir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(out_dir)
+    try:
+        # odd and even numbers of timepoints, below and at a power of two
+        for n_t in [100, 101, 128]:
+            data = np.random.randn(6, 5, 4, n_t) + 100
+            data[0] = 0
+            realigned_file = os.path.join(out_dir, 'rest.nii.gz')
+            nb.Nifti1Image(data, np.eye(4)).to_filename(realigned_file)
+
+            mask = (data != 0).sum(-1) != 0
+            Yc = data[mask] - data[mask].mean(1)[:, np.newaxis]
+            desired = np.zeros_like(data)
+            desired[mask] = [ideal_bandpass(y, 2.0, (0.01, 0.1)) for y in Yc]
+
+            for num_threads in [1, 3]:
+                bandpassed_file = bandpass_voxels(realigned_file,
+                                                  (0.01, 0.1),
+                                                  sample_period=2.0,
+                                                  chunk_size=7,
+                                                  num_threads=num_threads)
+                np.testing.assert_allclose(nb.load(bandpassed_file).get_data(),
+                                           desired, atol=1e-12)
+    finally:
+        os.chdir(cwd)
+
+
+def test_masked_functional():
+    import os
+    import shutil
+    import tempfile
+    import numpy as np
+    import nibabel as nb
+    from CPAC.nuisance import MaskedFunctional
+
+    np.random.seed(15)
+    data = np.random.randn(6, 5, 4, 30) + 100
+    data[0] = 0
+    data[1, 2, 3] = 0
+    affine = np.diag([2., 2., 2., 1.])
+
+    out_dir = tempfile.mkdtemp()
+    try:
+        # uncompressed, so the image is memory-mapped
+        func_file = os.path.join(out_dir, 'rest.nii')
+        nb.Nifti1Image(data, affine).to_filename(func_file)
+
+        mask = (data != 0).any(-1)
+        Y = data[mask]
+
+        for dtype, atol in [('float64', 1e-10), ('float32', 1e-4)]:
+            func = MaskedFunctional(func_file, dtype)
+            assert func.ntimepoints == 30
+            np.testing.assert_array_equal(func.mask, mask)
+            assert func.matrix.dtype == np.dtype(dtype)
+            np.testing.assert_allclose(func.matrix, Y, rtol=1e-6)
+
+            np.testing.assert_allclose(func.global_signal(), Y.mean(0),
+                                       atol=atol)
+
+            # the first principal component is defined up to its sign
+            Yc = (Y - Y.mean(1)[:, np.newaxis]).T
+            U = np.linalg.svd(Yc, full_matrices=False)[0]
+            pc1 = func.pc1()
+            sign = np.sign(np.dot(pc1, U[:, 0]))
+            np.testing.assert_allclose(sign*pc1, U[:, 0], atol=atol)
+
+            tissue = np.zeros(mask.shape, dtype='bool')
+            tissue[2:4, 1:3, :2] = True
+            sigs = func.signals(tissue)
+            assert sigs.dtype == np.float64
+            np.testing.assert_array_equal(sigs, data[tissue])
+
+            round_trip = os.path.join(out_dir, 'round_trip.nii.gz')
+            func.to_image().to_filename(round_trip)
+            img = nb.load(round_trip)
+            np.testing.assert_allclose(img.get_data(), data, rtol=1e-6)
+            np.testing.assert_allclose(img.get_affine(), affine)
+
+            residuals = func.to_image(func.matrix - func.matrix.mean(1)[:,
+                                                             np.newaxis])
+            np.testing.assert_allclose(residuals.get_data()[mask],
+                                       Y - Y.mean(1)[:, np.newaxis],
+                                       atol=atol)
+            assert not residuals.get_data()[~mask].any()
+    finally:
+        shutil.rmtree(out_dir)
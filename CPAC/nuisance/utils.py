@@ -1,9 +1,10 @@
 import numpy as np
 
 
-def calc_compcor_components(data, nComponents, wm_sigs, csf_sigs):
+def calc_compcor_components(nComponents, wm_sigs, csf_sigs):
 
     import scipy.signal as signal
+    from CPAC.utils import low_rank_svd
     
     wmcsf_sigs = np.vstack((wm_sigs, csf_sigs))
 
@@ -22,32 +23,192 @@ def calc_compcor_components(data, nComponents, wm_sigs, csf_sigs):
     Yc = Yc / np.tile(np.array(Y.std(0)).reshape(1,Y.shape[1]), (Y.shape[0],1))
     
     print 'Calculating SVD decomposition of Y*Y\''
-    U, S, Vh = np.linalg.svd(Yc)
+    U, S = low_rank_svd(Yc, nComponents)
     
-    return U[:, :nComponents]
+    return U
+
+
+class MaskedFunctional(object):
+    """
+    Functional image of a subject, loaded once and shared by the nuisance
+    signal extraction and the regression
+
+    The image is memory-mapped when the file is uncompressed (a compressed
+    file is read whole). The voxels with a signal (any non-zero timepoint)
+    are copied once into a (voxels, timepoints) matrix of type dtype, which
+    is then shared by the global signal, the first principal component and
+    the regression. The tissue signals are separate double precision copies
+    of only the voxels in each tissue mask.
+
+    Parameters
+    ----------
+    func_file : string
+        Path of the 4D functional nifti file
+    dtype : string or dtype
+        Data type of the voxel time-series matrix
+    """
+
+    def __init__(self, func_file, dtype='float64'):
+        import nibabel as nb
+
+        self.img = nb.load(func_file, mmap=True)
+        self.data = self.img.get_data()
+        self.dtype = dtype
+        self._mask = None
+        self._matrix = None
+
+    @property
+    def mask(self):
+        """Voxels with a non-zero timepoint"""
+        if self._mask is None:
+            self._mask = (self.data != 0).any(-1)
+        return self._mask
+
+    @property
+    def matrix(self):
+        """(voxels, timepoints) matrix of the voxels in the mask"""
+        if self._matrix is None:
+            self._matrix = self.data[self.mask].astype(self.dtype)
+        return self._matrix
+
+    @property
+    def ntimepoints(self):
+        return self.data.shape[3]
+
+    def signals(self, mask):
+        """
+        Time-series of the voxels in a mask of the same space, read from
+        the image rather than from the matrix
+
+        Parameters
+        ----------
+        mask : ndarray
+            3D boolean mask
+
+        Returns
+        -------
+        sigs : ndarray
+            (voxels, timepoints) matrix of double precision time-series
+        """
+        return self.data[mask].astype('float64')
+
+    def global_signal(self):
+        """Mean time-series of the voxels in the mask"""
+        return self.matrix.mean(0, dtype=np.float64)
+
+    def pc1(self):
+        """
+        First principal component of the voxel time-series in the mask,
+        from a truncated SVD of the voxel-centered (timepoints, voxels)
+        matrix
+        """
+        from CPAC.utils import low_rank_svd
+
+        bdatac = (self.matrix - self.matrix.mean(1)[:, np.newaxis]).T
+        U, S = low_rank_svd(bdatac, 1)
+        return U[:, 0]
+
+    def to_image(self, matrix=None):
+        """
+        Nifti image of the matrix, zero outside the mask
+
+        Parameters
+        ----------
+        matrix : ndarray, optional
+            (voxels, timepoints) matrix of the mask voxels, defaults to the
+            shared matrix
+
+        Returns
+        -------
+        img : nibabel.Nifti1Image
+        """
+        import nibabel as nb
+
+        if matrix is None:
+            matrix = self.matrix
+        out = np.zeros(self.data.shape, dtype=matrix.dtype)
+        out[self.mask] = matrix
+        return nb.Nifti1Image(out, header=self.img.get_header(),
+                              affine=self.img.get_affine())
+
+
+def calc_regression_basis(X):
+    """
+    Orthonormal basis of the regressors in a design matrix
+
+    The design is factorized once with a QR decomposition and the basis can
+    then be reused to regress the design out of any number of time-series.
+
+    Parameters
+    ----------
+    X : ndarray
+        Design matrix of shape (timepoints, regressors)
+
+    Returns
+    -------
+    Q : ndarray
+        Orthonormal basis of the columns of X, same shape as X
+
+    Raises
+    ------
+    LinAlgError
+        If the columns of X are linearly dependent
+    """
+    from CPAC.utils import full_rank_qr
+
+    Q, R = full_rank_qr(X)
+    return Q
+
+
+def regress_out(Y, Q, chunk_size=10000):
+    """
+    Replaces time-series with their residuals after regressing out a design
+
+    Parameters
+    ----------
+    Y : ndarray
+        Time-series of shape (voxels, timepoints), overwritten with the
+        residuals, can be float32
+    Q : ndarray
+        Orthonormal basis of the design from `calc_regression_basis`
+    chunk_size : integer
+        Number of voxels to regress at once
+
+    Returns
+    -------
+    Y : ndarray
+        The residuals
+    """
+
+    for start in range(0, Y.shape[0], chunk_size):
+        y = Y[start:start + chunk_size].T.astype('float64')
+        y -= Q.dot(Q.T.dot(y))
+        Y[start:start + chunk_size] = y.T
+
+    return Y
 
 
 def erode_mask(data):
+    """
+    Erodes the non-zero voxels of a volume with a 6-connected neighbourhood,
+    voxels on the border of the volume are always removed
+
+    Parameters
+    ----------
+    data : ndarray
+        3D volume (e.g. a tissue mask)
+
+    Returns
+    -------
+    eroded_data : ndarray
+        Copy of data, zero outside the eroded mask
+    """
+    from scipy import ndimage
+
     mask = data != 0
-    eroded_mask = np.zeros_like(data, dtype='bool')
-    max_x, max_y, max_z = data.shape
-    x,y,z = np.where(data != 0)
-    for i in range(x.shape[0]):
-        if (max_x-1) == x[i] or \
-           (max_y-1) == y[i] or \
-           (max_z-1) == z[i] or \
-           x[i] == 0 or \
-           y[i] == 0 or \
-           z[i] == 0:
-            eroded_mask[x[i],y[i],z[i]] = False
-        else:
-            eroded_mask[x[i],y[i],z[i]] = mask[x[i], y[i], z[i]] * \
-                                          mask[x[i] + 1, y[i], z[i]] * \
-                                          mask[x[i], y[i] + 1, z[i]] * \
-                                          mask[x[i], y[i], z[i] + 1] * \
-                                          mask[x[i] - 1, y[i], z[i]] * \
-                                          mask[x[i], y[i] - 1, z[i]] * \
-                                          mask[x[i], y[i], z[i] - 1]
+    structure = ndimage.generate_binary_structure(3, 1)
+    eroded_mask = ndimage.binary_erosion(mask, structure=structure,
+                                         border_value=0)
 
     eroded_data = np.zeros_like(data)
     eroded_data[eroded_mask] = data[eroded_mask]
@@ -123,7 +123,8 @@ class strategy:
 
 # Create and prepare C-PAC pipeline workflow
 def prep_workflow(sub_dict, c, strategies, run, pipeline_timing_info=None,
-                  p_name=None, plugin='MultiProc', plugin_args=None):
+                  p_name=None, plugin='MultiProc', plugin_args=None,
+                  profile=False):
     '''
     Function to prepare and, optionally, run the C-PAC workflow
 
@@ -146,6 +147,10 @@ def prep_workflow(sub_dict, c, strategies, run, pipeline_timing_info=None,
         nipype plugin to utilize when the workflow is ran
     plugin_args : dictionary (optional); default=None
         plugin-specific arguments for the workflow plugin
+    profile : boolean (optional); default=False
+        flag to record the runtime, peak CPU usage, peak memory and
+        working directory size of every node in profile_<subject_id>.log in
+        the log directory (CPU time and I/O are not measured)
 
     Returns
     -------
@@ -2248,8 +2253,7 @@ def prep_workflow(sub_dict, c, strategies, run, pipeline_timing_info=None,
     if 1 in c.runFrequencyFiltering:
         workflow_bit_id['frequency_filter'] = workflow_counter
         filter_imports = ['import os', 'import nibabel as nb',
-                          'import numpy as np',
-                          'from scipy.fftpack import fft, ifft']
+                          'import numpy as np']
         for strat in strat_list:
             frequency_filter = pe.Node(
                 util.Function(input_names=['realigned_file',
@@ -3740,7 +3744,8 @@ def prep_workflow(sub_dict, c, strategies, run, pipeline_timing_info=None,
                     create_resting_state_graphs(
                         wf_name='network_centrality_%d-%s' \
                                 % (num_strat, methodOption),
-                        allocated_memory=c.memoryAllocatedForDegreeCentrality)
+                        allocated_memory=c.memoryAllocatedForDegreeCentrality,
+                        num_threads=c.maxCoresPerParticipant)
 
                 # Connect resampled (to template/mask resolution)
                 # functional_mni to inputspec
@@ -5826,6 +5831,7 @@ def prep_workflow(sub_dict, c, strategies, run, pipeline_timing_info=None,
             from nipype.pipeline.plugins.callback_log import log_nodes_cb
             plugin_args['status_callback'] = log_nodes_cb
         except ImportError as exc:
+            log_nodes_cb = None
             import nipype
             err_msg = 'Version of nipype found in %s does not contain the ' \
                       'MultiProc plugin. Please check installation is the ' \
@@ -5835,6 +5841,19 @@ def prep_workflow(sub_dict, c, strategies, run, pipeline_timing_info=None,
             logger.error(err_msg)
             # raise Exception(err_msg)
 
+        # Profile every node, still writing the callback log
+        if profile:
+            from CPAC.pipeline.cpac_profiler import enable_resource_monitor, \
+                                                   create_profile_callback
+            enable_resource_monitor()
+            profile_file = os.path.join(log_dir,
+                                        'profile_%s.log' % subject_id)
+            if os.path.exists(profile_file):
+                os.remove(profile_file)
+            plugin_args['status_callback'] = \
+                create_profile_callback(profile_file, subject_id,
+                                        log_nodes_cb)
+
         # Actually run the pipeline now, for the current subject
         workflow.run(plugin=plugin, plugin_args=plugin_args)
 
@@ -0,0 +1,294 @@
+# CPAC/pipeline/cpac_profiler.py
+#
+
+'''
+This module contains functions used to profile the nodes of C-PAC pipeline
+runs and to summarize their resource usage
+
+The wall time, peak CPU usage and peak RSS of every node are recorded, the
+last two only when nipype's resource monitor is on. The CPU time and the
+I/O of the nodes are not measured; the output size of a node is the size
+of its working directory, which also counts nipype's result and report
+files and outputs reused from a previous run.
+'''
+
+# Import packages
+import json
+import os
+import re
+import time
+
+
+# Columns of the per-node report
+PROFILE_FIELDS = ['subject_id', 'node', 'node_type', 'fullname', 'status',
+                  'start', 'finish', 'wall_time', 'peak_cpu_percent',
+                  'peak_rss_gb', 'estimated_memory_gb', 'num_threads',
+                  'output_bytes']
+
+
+def enable_resource_monitor():
+    '''
+    Function to turn on nipype's per-node memory and CPU monitoring, which
+    fills in the peak RSS and CPU usage of every node's runtime
+    '''
+
+    # Import packages
+    from nipype import config
+
+    try:
+        config.enable_resource_monitor()
+    except AttributeError:
+        # Older nipype releases
+        config.set('execution', 'profile_runtime', 'true')
+
+
+def _output_bytes(output_dir):
+    '''
+    Function to get the number of bytes of the files in a node's working
+    directory, whether written by this run or an earlier one (it is not a
+    measure of the node's I/O)
+    '''
+
+    # Init variables
+    total = 0
+
+    for root, dirs, files in os.walk(output_dir):
+        for fname in files:
+            fpath = os.path.join(root, fname)
+            if not os.path.islink(fpath):
+                total += os.path.getsize(fpath)
+
+    return total
+
+
+def _node_resources(node):
+    '''
+    Function to get the requested memory (GB) and threads of a node across
+    nipype versions
+    '''
+
+    iface = getattr(node, '_interface', None)
+    mem_gb = getattr(node, 'mem_gb',
+                     getattr(iface, 'estimated_memory_gb', None))
+    n_procs = getattr(node, 'n_procs',
+                      getattr(iface, 'num_threads', None))
+
+    return mem_gb, n_procs
+
+
+def create_profile_callback(profile_file, subject_id, log_callback=None):
+    '''
+    Function to create a nipype status callback that writes the resource
+    usage of every node, as a JSON line, to a profile file
+
+    Parameters
+    ----------
+    profile_file : string
+        path of the file to append the node profiles to
+    subject_id : string
+        participant the nodes are run for
+    log_callback : function (optional); default=None
+        another status callback (e.g. nipype's log_nodes_cb) to call first
+
+    Returns
+    -------
+    profile_callback : function
+        status callback for the nipype plugin_args
+    '''
+
+    # Init variables
+    start_times = {}
+
+    def profile_callback(node, status):
+
+        if log_callback is not None:
+            log_callback(node, status)
+
+        node_id = id(node)
+        if status == 'start':
+            start_times[node_id] = time.time()
+            return
+
+        finish = time.time()
+        start = start_times.pop(node_id, finish)
+
+        # Fill in what nipype's resource monitor measured, if it was on
+        runtime = getattr(getattr(node, 'result', None), 'runtime', None)
+        wall_time = getattr(runtime, 'duration', None) or finish - start
+        peak_rss_gb = getattr(runtime, 'mem_peak_gb',
+                              getattr(runtime, 'runtime_memory_gb', None))
+        # The monitor only keeps the peak CPU usage, which can not be turned
+        # into CPU time, so it is reported as is
+        peak_cpu_percent = getattr(runtime, 'cpu_percent', None)
+
+        try:
+            output_bytes = _output_bytes(node.output_dir())
+        except Exception:
+            output_bytes = None
+
+        mem_gb, n_procs = _node_resources(node)
+
+        record = {'subject_id': subject_id,
+                  'node': node.name,
+                  'node_type': re.sub(r'_\d+$', '', node.name),
+                  'fullname': node.fullname,
+                  'status': status,
+                  'start': start,
+                  'finish': finish,
+                  'wall_time': wall_time,
+                  'peak_cpu_percent': peak_cpu_percent,
+                  'peak_rss_gb': peak_rss_gb,
+                  'estimated_memory_gb': mem_gb,
+                  'num_threads': n_procs,
+                  'output_bytes': output_bytes}
+
+        with open(profile_file, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+    return profile_callback
+
+
+def read_profiles(log_dir):
+    '''
+    Function to read the node profiles of every participant
+
+    Parameters
+    ----------
+    log_dir : string
+        pipeline log directory, containing a sub-directory with the
+        profile_<subject_id>.log file of each participant
+
+    Returns
+    -------
+    records : list
+        list of dictionaries, one for each node run
+    '''
+
+    # Import packages
+    import glob
+
+    # Init variables
+    records = []
+
+    for profile_file in sorted(glob.glob(os.path.join(log_dir, '*',
+                                                      'profile_*.log'))):
+        with open(profile_file, 'r') as f:
+            for line in f:
+                if line.strip():
+                    records.append(json.loads(line))
+
+    return records
+
+
+def summarize_profiles(records):
+    '''
+    Function to aggregate the node profiles of every strategy and
+    participant by type of node
+
+    Parameters
+    ----------
+    records : list
+        node profiles, as returned by read_profiles
+
+    Returns
+    -------
+    summary : list
+        list of dictionaries, one for each type of node, ranked by their
+        total wall time
+    '''
+
+    # Init variables
+    by_type = {}
+
+    def total(values):
+        values = [v for v in values if v is not None]
+        return sum(values) if values else None
+
+    def peak(values):
+        values = [v for v in values if v is not None]
+        return max(values) if values else None
+
+    for record in records:
+        by_type.setdefault(record['node_type'], []).append(record)
+
+    summary = []
+    for node_type, runs in by_type.items():
+        wall_times = [r['wall_time'] for r in runs]
+        summary.append({
+            'node_type': node_type,
+            'runs': len(runs),
+            'subjects': len(set(r['subject_id'] for r in runs)),
+            'failed': len([r for r in runs if r['status'] != 'end']),
+            'total_wall_time': total(wall_times),
+            'mean_wall_time': total(wall_times) / len(runs),
+            'max_wall_time': peak(wall_times),
+            'max_peak_cpu_percent': peak([r['peak_cpu_percent'] for r in runs]),
+            'max_peak_rss_gb': peak([r['peak_rss_gb'] for r in runs]),
+            'max_estimated_memory_gb':
+                peak([r['estimated_memory_gb'] for r in runs]),
+            'total_output_bytes':
+                total([r['output_bytes'] for r in runs])})
+
+    summary.sort(key=lambda s: s['total_wall_time'], reverse=True)
+
+    return summary
+
+
+def write_profile_report(log_dir, out_dir=None, top=20):
+    '''
+    Function to write the profile report of a pipeline run: a CSV of every
+    node run, a JSON summary by type of node and a ranked list of the
+    hottest nodes
+
+    Parameters
+    ----------
+    log_dir : string
+        pipeline log directory of the run
+    out_dir : string (optional); default=None
+        directory to write the report to, defaults to log_dir
+    top : integer (optional); default=20
+        number of nodes in the hot node summary
+
+    Returns
+    -------
+    report_files : tuple
+        paths of the CSV, JSON and hot node summary files
+    '''
+
+    # Import packages
+    import csv
+
+    # Init variables
+    if out_dir is None:
+        out_dir = log_dir
+    records = read_profiles(log_dir)
+    summary = summarize_profiles(records)
+
+    nodes_csv = os.path.join(out_dir, 'cpac_profile_nodes.csv')
+    with open(nodes_csv, 'wb') as f:
+        writer = csv.DictWriter(f, fieldnames=PROFILE_FIELDS)
+        writer.writeheader()
+        for record in records:
+            writer.writerow(record)
+
+    summary_json = os.path.join(out_dir, 'cpac_profile_summary.json')
+    with open(summary_json, 'w') as f:
+        json.dump(summary, f, indent=2)
+
+    def fmt(value, spec):
+        return 'n/a' if value is None else spec % value
+
+    hot_nodes_txt = os.path.join(out_dir, 'cpac_profile_hot_nodes.txt')
+    with open(hot_nodes_txt, 'w') as f:
+        print >>f, '%-40s %6s %12s %12s %12s %10s' % \
+            ('node', 'runs', 'total wall s', 'mean wall s', 'peak cpu %',
+             'peak RSS')
+        for s in summary[:top]:
+            print >>f, '%-40s %6d %12s %12s %12s %10s' % \
+                (s['node_type'], s['runs'],
+                 fmt(s['total_wall_time'], '%.1f'),
+                 fmt(s['mean_wall_time'], '%.1f'),
+                 fmt(s['max_peak_cpu_percent'], '%.1f'),
+                 fmt(s['max_peak_rss_gb'], '%.2f GB'))
+
+    return nodes_csv, summary_json, hot_nodes_txt
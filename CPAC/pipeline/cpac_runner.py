@@ -374,8 +374,26 @@ def append_seeds_to_file(working_dir, seed_list, seed_file):
 
 # Run C-PAC subjects via job queue
 def run(config_file, subject_list_file, p_name=None, plugin=None,
-        plugin_args=None):
+        plugin_args=None, profile=False):
     '''
+    Function to run a C-PAC pipeline for every participant in a subject list
+
+    Parameters
+    ----------
+    config_file : string
+        path to the pipeline configuration YAML file
+    subject_list_file : string
+        path to the participant list YAML file
+    p_name : string (optional); default=None
+        name of pipeline
+    plugin : string (optional); default=None
+        nipype plugin to utilize when the workflows are ran
+    plugin_args : dictionary (optional); default=None
+        plugin-specific arguments for the workflow plugin
+    profile : boolean (optional); default=False
+        flag to profile every node; when running on one computer, the
+        report of the whole run is written to the log directory once all
+        participants are done
     '''
 
     # Import packages
@@ -480,7 +498,7 @@ def run(config_file, subject_list_file, p_name=None, plugin=None,
         # Init variables
         procss = [Process(target=prep_workflow,
                           args=(sub, c, strategies, 1, pipeline_timing_info,
-                                p_name, plugin, plugin_args))
+                                p_name, plugin, plugin_args, profile))
                   for sub in sublist]
 
         if not os.path.exists(c.workingDirectory):
@@ -535,3 +553,11 @@ def run(config_file, subject_list_file, p_name=None, plugin=None,
                     time.sleep(2)
         # Close PID txt file to indicate finish
         pid.close()
+
+        # Summarize the node profiles of every participant
+        if profile:
+            from CPAC.pipeline.cpac_profiler import write_profile_report
+            for p in procss:
+                p.join()
+            report_files = write_profile_report(c.logDirectory)
+            print 'Profile report written to:\n%s' % '\n'.join(report_files)
@@ -0,0 +1,169 @@
+import os
+import csv
+import json
+import tempfile
+
+from ..cpac_profiler import create_profile_callback, \
+                            read_profiles, \
+                            summarize_profiles, \
+                            write_profile_report
+
+
+def make_record(subject_id, node, wall_time, status='end',
+                peak_cpu_percent=None, peak_rss_gb=None, output_bytes=None):
+    '''
+    Function to make a node profile as written by the profile callback
+    '''
+
+    node_type = node.rsplit('_', 1)[0]
+
+    return {'subject_id': subject_id,
+            'node': node,
+            'node_type': node_type,
+            'fullname': 'resting_preproc_%s.%s' % (subject_id, node),
+            'status': status,
+            'start': 0.0,
+            'finish': wall_time,
+            'wall_time': wall_time,
+            'peak_cpu_percent': peak_cpu_percent,
+            'peak_rss_gb': peak_rss_gb,
+            'estimated_memory_gb': 1.0,
+            'num_threads': 1,
+            'output_bytes': output_bytes}
+
+
+def write_profiles(log_dir):
+    '''
+    Function to write the profiles of two participants to a log directory
+    '''
+
+    records = [make_record('sub1', 'bandpass_0', 30.0, peak_cpu_percent=90.0,
+                           peak_rss_gb=2.0, output_bytes=100),
+               make_record('sub1', 'bandpass_1', 10.0, peak_cpu_percent=180.0,
+                           peak_rss_gb=3.0, output_bytes=50),
+               make_record('sub1', 'reho_0', 5.0),
+               make_record('sub2', 'bandpass_0', 20.0, status='exception',
+                           peak_cpu_percent=100.0, peak_rss_gb=1.0),
+               make_record('sub2', 'reho_0', 50.0, output_bytes=10)]
+
+    for subject_id in ['sub1', 'sub2']:
+        sub_dir = os.path.join(log_dir, subject_id)
+        os.makedirs(sub_dir)
+        with open(os.path.join(sub_dir, 'profile_%s.log' % subject_id),
+                  'w') as f:
+            for record in records:
+                if record['subject_id'] == subject_id:
+                    f.write(json.dumps(record) + '\n')
+
+    return records
+
+
+def test_summarize_profiles():
+    '''
+    Test the node profiles are aggregated by type of node and ranked by
+    their total wall time
+    '''
+
+    log_dir = tempfile.mkdtemp()
+    write_profiles(log_dir)
+
+    records = read_profiles(log_dir)
+    assert len(records) == 5
+
+    summary = summarize_profiles(records)
+    assert [s['node_type'] for s in summary] == ['bandpass', 'reho']
+
+    bandpass, reho = summary
+    assert bandpass['runs'] == 3
+    assert bandpass['subjects'] == 2
+    assert bandpass['failed'] == 1
+    assert bandpass['total_wall_time'] == 60.0
+    assert bandpass['mean_wall_time'] == 20.0
+    assert bandpass['max_wall_time'] == 30.0
+    assert bandpass['max_peak_cpu_percent'] == 180.0
+    assert bandpass['max_peak_rss_gb'] == 3.0
+    assert bandpass['total_output_bytes'] == 150
+
+    # Measures no run recorded
+    assert reho['max_peak_cpu_percent'] is None
+    assert reho['max_peak_rss_gb'] is None
+    assert reho['total_output_bytes'] == 10
+
+
+def test_write_profile_report():
+    '''
+    Test the CSV, JSON and hot node files of the profile report
+    '''
+
+    log_dir = tempfile.mkdtemp()
+    out_dir = tempfile.mkdtemp()
+    records = write_profiles(log_dir)
+
+    nodes_csv, summary_json, hot_nodes_txt = \
+        write_profile_report(log_dir, out_dir, top=1)
+
+    assert os.path.dirname(nodes_csv) == out_dir
+    with open(nodes_csv, 'r') as f:
+        rows = list(csv.DictReader(f))
+    assert len(rows) == len(records)
+    assert set(rows[0].keys()) == set(records[0].keys())
+
+    with open(summary_json, 'r') as f:
+        summary = json.load(f)
+    assert [s['node_type'] for s in summary] == ['bandpass', 'reho']
+
+    with open(hot_nodes_txt, 'r') as f:
+        lines = f.read().splitlines()
+    assert len(lines) == 2
+    assert 'peak cpu %' in lines[0]
+    assert lines[1].split() == ['bandpass', '3', '60.0', '20.0', '180.0',
+                                '3.00', 'GB']
+
+
+def test_profile_callback():
+    '''
+    Test the profile callback writes a line for every finished node
+    '''
+
+    class Runtime(object):
+        duration = 12.0
+        mem_peak_gb = 1.5
+        cpu_percent = 250.0
+
+    class Result(object):
+        runtime = Runtime()
+
+    class Node(object):
+        name = 'bandpass_2'
+        fullname = 'resting_preproc_sub1.bandpass_2'
+        result = Result()
+        mem_gb = 2.0
+        n_procs = 4
+
+        def output_dir(self):
+            return out_dir
+
+    out_dir = tempfile.mkdtemp()
+    with open(os.path.join(out_dir, 'out.nii.gz'), 'w') as f:
+        f.write('x' * 64)
+
+    profile_file = os.path.join(tempfile.mkdtemp(), 'profile_sub1.log')
+    profile_callback = create_profile_callback(profile_file, 'sub1')
+
+    node = Node()
+    profile_callback(node, 'start')
+    profile_callback(node, 'end')
+
+    with open(profile_file, 'r') as f:
+        lines = f.read().splitlines()
+    assert len(lines) == 1
+
+    record = json.loads(lines[0])
+    assert record['node_type'] == 'bandpass'
+    assert record['status'] == 'end'
+    assert record['wall_time'] == 12.0
+    assert record['peak_cpu_percent'] == 250.0
+    assert record['peak_rss_gb'] == 1.5
+    assert record['estimated_memory_gb'] == 2.0
+    assert record['num_threads'] == 4
+    assert record['output_bytes'] == 64
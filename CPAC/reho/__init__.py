@@ -1,11 +1,15 @@
 from reho import create_reho
 
 from utils import f_kendall, \
+                  tied_ranks, \
+                  kendall_w, \
                   compute_reho, \
                   getOpString
 
 
 __all__ = ['create_reho', \
            'f_kendall', \
+           'tied_ranks', \
+           'kendall_w', \
            'getOpString', \
            'compute_reho']
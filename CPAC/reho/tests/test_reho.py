@@ -0,0 +1,73 @@
+import numpy as np
+from numpy.testing import *
+
+from ..utils import f_kendall, \
+                    tied_ranks, \
+                    kendall_w
+
+
+def test_tied_ranks():
+    """
+    Tests tied_ranks against scipy.stats.rankdata on time-series with ties,
+    across several chunks
+    """
+    from scipy.stats import rankdata
+
+    np.random.seed(27)
+    data = np.random.randint(0, 6, (53, 30)).astype('float64')
+    data[3] = 1.0
+    data[10] = np.arange(30)[::-1]
+
+    ranks = tied_ranks(data, chunk_size=7)
+
+    desired = np.array([rankdata(ts) for ts in data])
+    assert_equal(ranks, desired)
+
+
+def kendall_w_reference(ranks, mask, cluster_size):
+    """
+    Kendall's W of every voxel's neighbourhood with f_kendall, as computed
+    a voxel at a time before the neighbourhood rank sums were vectorized
+    """
+    n_x, n_y, n_z = mask.shape
+    vols = np.zeros((ranks.shape[0],) + mask.shape)
+    vols[:, mask] = ranks
+
+    # faces, edges and corners are 1, 2 and 3 steps from the centre
+    steps = np.abs(np.indices((3, 3, 3)) - 1).sum(0)
+    mask_cluster = steps <= {7: 1, 19: 2, 27: 3}[cluster_size]
+
+    K = np.zeros(mask.shape)
+    for i in range(1, n_x - 1):
+        for j in range(1, n_y - 1):
+            for k in range(1, n_z - 1):
+                if not mask[i, j, k]:
+                    continue
+                block = vols[:, i-1:i+2, j-1:j+2, k-1:k+2]
+                mask_block = mask[i-1:i+2, j-1:j+2, k-1:k+2] & mask_cluster
+                K[i, j, k] = f_kendall(block[:, mask_block])
+
+    return K
+
+
+def test_kendall_w():
+    """
+    Tests kendall_w against f_kendall on every neighbourhood, for each
+    cluster size, with tied ranks and voxels on the edge of the mask
+    """
+    np.random.seed(27)
+    mask = np.random.rand(7, 8, 6) > 0.3
+    data = np.random.randint(0, 8, (20,) + mask.shape).astype('float64')
+    # neighbours sharing a time-series
+    data[:, 2:5, 3, 2] = data[:, 3, 3, 2][:, np.newaxis]
+
+    ranks = tied_ranks(data[:, mask].T).T
+
+    for cluster_size in [7, 19, 27]:
+        K = kendall_w(ranks, mask, cluster_size, chunk_size=6)
+        desired = kendall_w_reference(ranks, mask, cluster_size)
+        assert_almost_equal(K, desired)
+
+        # only voxels of the mask off the border of the volume
+        assert np.all(K[~mask] == 0)
+        assert np.all(K[0] == 0) and np.all(K[-1] == 0)
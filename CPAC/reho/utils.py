@@ -67,211 +67,191 @@ def f_kendall(timeseries_matrix):
     return kcc
 
 
-def compute_reho(in_file, mask_file, cluster_size):
+def tied_ranks(data, chunk_size=10000):
 
     """
-    Computes the ReHo Map, by computing tied ranks of the timepoints,
-    followed by computing Kendall's coefficient concordance(KCC) of a
-    timeseries with its neighbours
+    Ranks the timepoints of every time-series, giving tied values the
+    average of their ranks (as scipy.stats.rankdata)
 
     Parameters
     ----------
 
-    in_file : nifti file
-        4D EPI File 
-
-    mask_file : nifti file
-        Mask of the EPI File(Only Compute ReHo of voxels in the mask)
-
-    cluster_size : integer
-        for a brain voxel the number of neighbouring brain voxels to use for
-        KCC.
+    data : ndarray
+        (N voxels, timepoints) shaped array of time-series
 
+    chunk_size : integer
+        number of voxels to rank at once
 
     Returns
     -------
 
-    out_file : nifti file
-        ReHo map of the input EPI image
+    ranks : ndarray
+        (N voxels, timepoints) shaped array of ranks, starting at 1
 
     """
 
-    out_file = None
-
-    res_fname = (in_file)
-    res_mask_fname = (mask_file)
-    CUTNUMBER = 10
-
-    if not (cluster_size == 27 or cluster_size == 19 or cluster_size == 7):
-        cluster_size = 27
-
-    nvoxel = cluster_size
-
-    res_img = nb.load(res_fname)
-    res_mask_img = nb.load(res_mask_fname)
-
-    res_data = res_img.get_data()
-    res_mask_data = res_mask_img.get_data()
-
-    print(res_data.shape)
-    (n_x, n_y, n_z, n_t) = res_data.shape
-
-    # "flatten" each volume of the timeseries into one big array instead of
-    # x,y,z - produces (timepoints, N voxels) shaped data array
-    res_data = np.reshape(res_data, (n_x*n_y*n_z, n_t), order='F').T
-
-    # create a blank array of zeroes of size n_voxels, one for each time point
-    Ranks_res_data = np.tile((np.zeros((1, (res_data.shape)[1]))),
-                             [(res_data.shape)[0], 1])
+    import numpy as np
 
-    # divide the number of total voxels by the cutnumber (set to 10)
-    # ex. end up with a number in the thousands if there are tens of thousands
-    # of voxels
-    segment_length = np.ceil(float((res_data.shape)[1])/float(CUTNUMBER))
+    n_v, n_t = data.shape
+    ranks = np.zeros((n_v, n_t))
+    t_index = np.arange(n_t)
 
-    for icut in range(0, CUTNUMBER):
+    for start in range(0, n_v, chunk_size):
 
-        segment = None
+        piece = data[start:start + chunk_size]
+        rows = np.arange(piece.shape[0])[:, np.newaxis]
 
-        # create a Numpy array of evenly spaced values from the segment
-        # starting point up until the segment_length integer
-        if not (icut == (CUTNUMBER - 1)):
-            segment = np.array(np.arange(icut * segment_length,
-                                         (icut+1) * segment_length))
-        else:
-            segment = np.array(np.arange(icut * segment_length,
-                                         (res_data.shape[1])))
+        sort_index = np.argsort(piece, axis=1, kind='mergesort')
+        piece_sorted = piece[rows, sort_index]
 
-        segment = np.int64(segment[np.newaxis])
+        # positions of the first and last timepoint of each run of ties
+        tie_start = np.ones(piece_sorted.shape, dtype='bool')
+        tie_start[:, 1:] = piece_sorted[:, 1:] != piece_sorted[:, :-1]
+        tie_end = np.ones(piece_sorted.shape, dtype='bool')
+        tie_end[:, :-1] = tie_start[:, 1:]
 
-        # res_data_piece is a chunk of the original timeseries in_file, but
-        # aligned with the current segment index spacing
-        res_data_piece = res_data[:, segment[0]]
-        nvoxels_piece = res_data_piece.shape[1]
+        first = np.maximum.accumulate(np.where(tie_start, t_index, 0), axis=1)
+        last = np.where(tie_end, t_index, n_t - 1)[:, ::-1]
+        last = np.minimum.accumulate(last, axis=1)[:, ::-1]
 
-        # run a merge sort across the time axis, re-ordering the flattened
-        # volume voxel arrays
-        res_data_sorted = np.sort(res_data_piece, 0, kind='mergesort')
-        sort_index = np.argsort(res_data_piece, axis=0, kind='mergesort')
+        ranks[start + rows, sort_index] = (first + last)/2.0 + 1
 
-        # subtract each volume from each other
-        db = np.diff(res_data_sorted, 1, 0)
+    return ranks
 
-        # convert any zero voxels into "True" flag
-        db = db == 0
 
-        # return an n_voxel (n voxels within the current segment) sized array
-        # of values, each value being the sum total of TRUE values in "db"
-        sumdb = np.sum(db, 0)
+def kendall_w(ranks, mask, cluster_size, chunk_size=50):
 
-        temp_array = np.array(np.arange(0, n_t))
-        temp_array = temp_array[:, np.newaxis]
+    """
+    Calculates the Kendall's coefficient of concordance of every voxel's
+    ranked time-series with those of its neighbours in the mask
 
-        sorted_ranks = np.tile(temp_array, [1, nvoxels_piece])
+    The rank sums of each neighbourhood are built by adding shifted copies
+    of the ranked volumes, processing a chunk of timepoints at a time.
 
-        if np.any(sumdb[:]):
+    Parameters
+    ----------
 
-            tie_adjust_index = np.flatnonzero(sumdb)
+    ranks : ndarray
+        (timepoints, N mask voxels) shaped array of ranks
 
-            for i in range(0, len(tie_adjust_index)):
+    mask : ndarray
+        3D boolean brain mask
 
-                ranks = sorted_ranks[:, tie_adjust_index[i]]
+    cluster_size : integer
+        size of the neighbourhood, 7 (faces), 19 (faces and edges) or 27
+        (faces, edges and corners)
 
-                ties = db[:, tie_adjust_index[i]]
+    chunk_size : integer
+        number of timepoints to process at once
 
-                tieloc = np.append(np.flatnonzero(ties), n_t + 2)
-                maxties = len(tieloc)
-                tiecount = 0
+    Returns
+    -------
 
-                while(tiecount < maxties -1):
-                    tiestart = tieloc[tiecount]
-                    ntied = 2
-                    while(tieloc[tiecount + 1] == (tieloc[tiecount] + 1)):
-                        tiecount += 1
-                        ntied += 1
+    K : ndarray
+        3D map of the Kendall's coefficient of concordance, voxels on the
+        border of the volume are left at zero
 
-                    ranks[tiestart:tiestart + ntied] = np.ceil(np.float32(np.sum(ranks[tiestart:tiestart + ntied ]))/np.float32(ntied))
-                    tiecount += 1
+    """
 
-                sorted_ranks[:, tie_adjust_index[i]] = ranks
+    import numpy as np
 
-        del db, sumdb
-        sort_index_base = np.tile(np.multiply(np.arange(0, nvoxels_piece), n_t), [n_t, 1])
-        sort_index += sort_index_base
-        del sort_index_base
+    n = ranks.shape[0]
+    n_x, n_y, n_z = mask.shape
+
+    # only the centre voxel of a 3x3x3 cube is more than 2 steps from its
+    # faces, edges and corners
+    max_steps = {7: 1, 19: 2, 27: 3}[cluster_size]
+    offsets = [(i, j, k) for i in (-1, 0, 1)
+                         for j in (-1, 0, 1)
+                         for k in (-1, 0, 1)
+                         if abs(i) + abs(j) + abs(k) <= max_steps]
+
+    def neighbourhood_sum(vols):
+        padded = np.zeros(vols.shape[:-3] + (n_x + 2, n_y + 2, n_z + 2))
+        padded[..., 1:-1, 1:-1, 1:-1] = vols
+        total = np.zeros(vols.shape)
+        for i, j, k in offsets:
+            total += padded[..., 1 + i:1 + i + n_x,
+                                 1 + j:1 + j + n_y,
+                                 1 + k:1 + k + n_z]
+        return total
+
+    # number of neighbours in the mask
+    n_k = neighbourhood_sum(mask.astype('float'))
+
+    # sums over time of the rank sums and of their squares
+    sr_sum = np.zeros(mask.shape)
+    sr_sq_sum = np.zeros(mask.shape)
+
+    for start in range(0, n, chunk_size):
+        piece = ranks[start:start + chunk_size]
+        vols = np.zeros((piece.shape[0],) + mask.shape)
+        vols[:, mask] = piece
+        sr = neighbourhood_sum(vols)
+        sr_sum += sr.sum(0)
+        sr_sq_sum += (sr**2).sum(0)
+        del vols, sr
+
+    K = np.zeros(mask.shape)
+    inside = np.zeros(mask.shape, dtype='bool')
+    inside[1:-1, 1:-1, 1:-1] = mask[1:-1, 1:-1, 1:-1]
+
+    s = sr_sq_sum[inside] - sr_sum[inside]**2/n
+    K[inside] = 12*s/n_k[inside]**2/(n**3 - n)
+
+    return K
 
-        ranks_piece = np.zeros((n_t, nvoxels_piece))
 
-        ranks_piece = ranks_piece.flatten(order='F')
-        sort_index = sort_index.flatten(order='F')
-        sorted_ranks = sorted_ranks.flatten(order='F')
+def compute_reho(in_file, mask_file, cluster_size):
 
-        ranks_piece[sort_index] = np.array(sorted_ranks)
+    """
+    Computes the ReHo Map, by computing tied ranks of the timepoints,
+    followed by computing Kendall's coefficient concordance(KCC) of a
+    timeseries with its neighbours
 
-        ranks_piece = np.reshape(ranks_piece, (n_t, nvoxels_piece), order='F')
+    Parameters
+    ----------
 
-        del sort_index, sorted_ranks
+    in_file : nifti file
+        4D EPI File 
 
-        Ranks_res_data[:, segment[0]] = ranks_piece
+    mask_file : nifti file
+        Mask of the EPI File(Only Compute ReHo of voxels in the mask)
 
-        sys.stdout.write('.')
+    cluster_size : integer
+        for a brain voxel the number of neighbouring brain voxels to use for
+        KCC.
 
-    Ranks_res_data = np.reshape(Ranks_res_data, (n_t, n_x, n_y, n_z), order='F')
 
-    K = np.zeros((n_x, n_y, n_z))
+    Returns
+    -------
 
-    mask_cluster = np.ones((3, 3, 3))
+    out_file : nifti file
+        ReHo map of the input EPI image
 
-    if nvoxel == 19:
-        mask_cluster[0, 0, 0] = 0
-        mask_cluster[0, 2, 0] = 0
-        mask_cluster[2, 0, 0] = 0
-        mask_cluster[2, 2, 0] = 0
-        mask_cluster[0, 0, 2] = 0
-        mask_cluster[0, 2, 2] = 0
-        mask_cluster[2, 0, 2] = 0
-        mask_cluster[2, 2, 2] = 0
+    """
 
-    elif nvoxel == 7:
+    out_file = None
 
-        mask_cluster[0, 0, 0] = 0
-        mask_cluster[0, 1, 0] = 0
-        mask_cluster[0, 2, 0] = 0
-        mask_cluster[0, 0, 1] = 0
-        mask_cluster[0, 2, 1] = 0
-        mask_cluster[0, 0, 2] = 0
-        mask_cluster[0, 1, 2] = 0
-        mask_cluster[0, 2, 2] = 0
-        mask_cluster[1, 0, 0] = 0
-        mask_cluster[1, 2, 0] = 0
-        mask_cluster[1, 0, 2] = 0
-        mask_cluster[1, 2, 2] = 0
-        mask_cluster[2, 0, 0] = 0
-        mask_cluster[2, 1, 0] = 0
-        mask_cluster[2, 2, 0] = 0
-        mask_cluster[2, 0, 1] = 0
-        mask_cluster[2, 2, 1] = 0
-        mask_cluster[2, 0, 2] = 0
-        mask_cluster[2, 1, 2] = 0
-        mask_cluster[2, 2, 2] = 0
+    res_fname = (in_file)
+    res_mask_fname = (mask_file)
 
-    for i in range(1, n_x - 1):
-        for j in range(1, n_y -1):
-            for k in range(1, n_z -1):
+    if not (cluster_size == 27 or cluster_size == 19 or cluster_size == 7):
+        cluster_size = 27
 
-                block = Ranks_res_data[:, i-1:i+2, j-1:j+2, k-1:k+2]
-                mask_block = res_mask_data[i-1:i+2, j-1:j+2, k-1:k+2]
+    res_img = nb.load(res_fname)
+    res_mask_img = nb.load(res_mask_fname)
 
-                if not(int(mask_block[1, 1, 1]) == 0):
+    res_data = res_img.get_data()
+    res_mask_data = res_mask_img.get_data().astype('bool')
 
-                    if nvoxel == 19 or nvoxel == 7:
-                        mask_block = np.multiply(mask_block, mask_cluster)
+    print(res_data.shape)
 
-                    R_block = np.reshape(block, (block.shape[0], 27),
-                                         order='F')
-                    mask_R_block = R_block[:, np.argwhere(np.reshape(mask_block, (1, 27), order='F') > 0)[:, 1]]
+    # rank the timepoints of the voxels in the mask, producing a
+    # (timepoints, N mask voxels) shaped array
+    Ranks_res_data = tied_ranks(res_data[res_mask_data]).T
 
-                    K[i, j, k] = f_kendall(mask_R_block)
+    K = kendall_w(Ranks_res_data, res_mask_data, cluster_size)
 
     img = nb.Nifti1Image(K, header=res_img.get_header(),
                          affine=res_img.get_affine())
@@ -280,4 +260,3 @@ def compute_reho(in_file, mask_file, cluster_size):
     out_file = reho_file
 
     return out_file
-
@@ -1,12 +1,17 @@
 from sca import create_sca
 from sca import create_temporal_reg
 
-from utils import compute_fisher_z_score
+from utils import compute_fisher_z_score, compute_sca
 from utils import check_ts, map_to_roi
+from utils import calc_glm, temporal_regression, spatial_regression
 
 # List all functions
 __all__ = ['create_sca', \
            'compute_fisher_z_score', \
+           'compute_sca', \
            'create_temporal_reg', \
            'check_ts', \
-           'map_to_roi']
+           'map_to_roi', \
+           'calc_glm', \
+           'temporal_regression', \
+           'spatial_regression']
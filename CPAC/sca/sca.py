@@ -51,22 +51,23 @@ def create_sca(name_sca='sca'):
         
     Workflow Outputs::
 
-        outputspec.correlation_file : string (nifti file)
-            Correlations of the functional file and the input time series 
+        outputspec.correlation_stack : string (nifti file)
+            Correlations of the functional file and each input time series, one volume per ROI
 
-        outputspec.Z_score : string (nifti file)
-            Fisher Z transformed correlations of the seed 
+        outputspec.correlation_files : list (nifti files)
+            Correlations of the functional file and each input time series, one file per ROI
+
+        outputspec.Z_score : list (nifti files)
+            Fisher Z transformed correlations of each ROI 
 
 
     SCA Workflow Procedure:
 
     1. Compute pearson correlation between input timeseries 1D file and input functional file
-       Use 3dTcorr1D to compute that. Input timeseries can be a 1D file containing parcellation ROI's
-       or a 3D mask
+       in a single matrix product of the z-normalized voxel and ROI time series. Input timeseries
+       can be a 1D file containing parcellation ROI's or a 3D mask
 
-    2. Compute Fisher Z score of the correlation computed in step above. If a mask is provided then a 
-       a single Z score file is returned, otherwise z-scores for all ROIs are returned as a list of 
-       nifti files 
+    2. Compute Fisher Z score of the correlation computed in step above, for each ROI 
     
     
     
@@ -91,8 +92,6 @@ def create_sca(name_sca='sca'):
 
     """
 
-    from CPAC.utils.utils import get_roi_num_list
-
     sca = pe.Workflow(name=name_sca)
     inputNode = pe.Node(util.IdentityInterface(fields=['timeseries_one_d',
                                                 'functional_file',
@@ -107,58 +106,27 @@ def create_sca(name_sca='sca'):
                         name='outputspec')
 
     # # 2. Compute voxel-wise correlation with Seed Timeseries
-    corr = pe.Node(interface=preprocess.TCorr1D(),
-                      name='3dTCorr1D')
-    corr.inputs.pearson = True
-    corr.inputs.outputtype = 'NIFTI_GZ'
+    corr = pe.Node(util.Function(input_names=['functional_file',
+                                              'timeseries_one_d'],
+                                 output_names=['correlation_stack',
+                                               'correlation_files',
+                                               'z_score_files'],
+                                 function=compute_sca),
+                   name='sca_correlation')
 
     sca.connect(inputNode, 'timeseries_one_d',
-                corr, 'y_1d')
+                corr, 'timeseries_one_d')
     sca.connect(inputNode, 'functional_file',
-                corr, 'xset')
-
-    # Transform the sub-bricks into volumes
-    try:
-        concat = pe.Node(interface=preprocess.TCat(), name='3dTCat')
-    except AttributeError:
-        from nipype.interfaces.afni import utils as afni_utils
-        concat = pe.Node(interface=afni_utils.TCat(), name='3dTCat')
-
-    concat.inputs.outputtype = 'NIFTI_GZ'
-
-    # also write out volumes as individual files
-    split = pe.Node(interface=fsl.Split(), name='split_raw_volumes_sca')
-    split.inputs.dimension = 't'
-    split.inputs.out_base_name = 'sca_'
-
-    get_roi_num_list = pe.Node(util.Function(input_names=['timeseries_file',
-                                                          'prefix'],
-                                             output_names=['roi_list'],
-                                             function=get_roi_num_list),
-                               name='get_roi_num_list')
-    get_roi_num_list.inputs.prefix = "sca"
-
-    rename_rois = pe.MapNode(interface=util.Rename(), name='output_rois',
-                      iterfield=['in_file','format_string'])
-
-    rename_rois.inputs.keep_ext = True
-
-    sca.connect(corr, 'out_file', concat, 'in_files')
+                corr, 'functional_file')
 
-    sca.connect(concat, 'out_file', split, 'in_file')
-
-    sca.connect(concat, 'out_file',
+    sca.connect(corr, 'correlation_stack',
                 outputNode, 'correlation_stack')
 
-    sca.connect(inputNode, 'timeseries_one_d', get_roi_num_list,
-                'timeseries_file')
-
-    sca.connect(split, 'out_files', rename_rois, 'in_file')
-
-    sca.connect(get_roi_num_list, 'roi_list', rename_rois, 'format_string')
+    sca.connect(corr, 'correlation_files',
+                outputNode, 'correlation_files')
 
-    sca.connect(rename_rois, 'out_file', outputNode,
-                'correlation_files')
+    sca.connect(corr, 'z_score_files',
+                outputNode, 'Z_score')
 
     return sca
 
@@ -234,7 +202,9 @@ def create_temporal_reg(wflow_name='temporal_reg', which='SR'):
     
     Enter all timeseries into a general linear model and regress these 
     timeseries to the subjects functional file to get spatial maps of voxels
-    showing activation patterns related to those in the timeseries.
+    showing activation patterns related to those in the timeseries. All
+    voxels are fit at once in memory, and the parameter estimate and z-stat
+    maps are written both as 4D files and as one file per timeseries.
     
 
     Workflow:
@@ -289,38 +259,32 @@ def create_temporal_reg(wflow_name='temporal_reg', which='SR'):
     wflow.connect(inputNode, 'subject_timeseries',
                   check_timeseries, 'in_file')
 
-    temporalReg = pe.Node(interface=fsl.GLM(), name='temporal_regression')
-
-    temporalReg.inputs.out_file = 'temp_reg_map.nii.gz'
-    temporalReg.inputs.out_z_name = 'temp_reg_map_z.nii.gz'
-
-    wflow.connect(inputNode, 'subject_rest', temporalReg, 'in_file')
-    wflow.connect(check_timeseries, 'out_file', temporalReg, 'design')
+    temporalReg = pe.Node(util.Function(input_names=['subject_rest',
+                                                     'subject_timeseries',
+                                                     'subject_mask',
+                                                     'demean',
+                                                     'normalize'],
+                                        output_names=['temp_reg_map',
+                                                      'temp_reg_map_files',
+                                                      'temp_reg_map_z',
+                                                      'temp_reg_map_z_files'],
+                                        function=temporal_regression),
+                          name='temporal_regression')
+
+    wflow.connect(inputNode, 'subject_rest', temporalReg, 'subject_rest')
+    wflow.connect(check_timeseries, 'out_file',
+                  temporalReg, 'subject_timeseries')
     wflow.connect(inputNode, 'demean', temporalReg, 'demean')
-    wflow.connect(inputNode, 'normalize', temporalReg, 'des_norm')
-    wflow.connect(inputNode, 'subject_mask', temporalReg, 'mask')
-
-    wflow.connect(temporalReg, 'out_file', outputNode, 'temp_reg_map')
-    wflow.connect(temporalReg, 'out_z', outputNode, 'temp_reg_map_z')
-
-    split = pe.Node(interface=fsl.Split(), name='split_raw_volumes')
-    split.inputs.dimension = 't'
-    split.inputs.out_base_name = 'temp_reg_map_'
-
-    wflow.connect(temporalReg, 'out_file',
-                  split, 'in_file')
-
-    split_zstat = pe.Node(interface=fsl.Split(), name='split_zstat_volumes')
-    split_zstat.inputs.dimension = 't'
-    split_zstat.inputs.out_base_name = 'temp_reg_map_z_'
+    wflow.connect(inputNode, 'normalize', temporalReg, 'normalize')
+    wflow.connect(inputNode, 'subject_mask', temporalReg, 'subject_mask')
 
-    wflow.connect(temporalReg, 'out_z',
-                  split_zstat, 'in_file')
+    wflow.connect(temporalReg, 'temp_reg_map', outputNode, 'temp_reg_map')
+    wflow.connect(temporalReg, 'temp_reg_map_z', outputNode, 'temp_reg_map_z')
 
     if which == 'SR':
-        wflow.connect(split, 'out_files',
+        wflow.connect(temporalReg, 'temp_reg_map_files',
                       outputNode, 'temp_reg_map_files')
-        wflow.connect(split_zstat, 'out_files',
+        wflow.connect(temporalReg, 'temp_reg_map_z_files',
                       outputNode, 'temp_reg_map_z_files')
 
     elif which == 'RT':
@@ -335,7 +299,8 @@ def create_temporal_reg(wflow_name='temporal_reg', which='SR'):
                                               imports=map_roi_imports),
                                 name='get_roi_order')
 
-        wflow.connect(split, 'out_files', get_roi_order, 'maps')
+        wflow.connect(temporalReg, 'temp_reg_map_files',
+                      get_roi_order, 'maps')
 
         wflow.connect(inputNode, 'subject_timeseries',
                       get_roi_order, 'timeseries')
@@ -360,7 +325,8 @@ def create_temporal_reg(wflow_name='temporal_reg', which='SR'):
                                                     imports=map_roi_imports),
                                       name='get_roi_order_zstat')
 
-        wflow.connect(split_zstat, 'out_files', get_roi_order_zstat, 'maps')
+        wflow.connect(temporalReg, 'temp_reg_map_z_files',
+                      get_roi_order_zstat, 'maps')
         wflow.connect(inputNode, 'subject_timeseries',
                       get_roi_order_zstat, 'timeseries')
 
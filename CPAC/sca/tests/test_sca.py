@@ -524,3 +524,214 @@ class TestSCA(object):
         
         """
         assert False
+
+
+def test_calc_glm():
+    """
+    Tests calc_glm against a least squares fit of the demeaned, normalized
+    design and the t-statistics of its parameter estimates
+    """
+    import numpy as np
+    from scipy import stats
+    from CPAC.sca.utils import calc_glm
+
+    np.random.seed(0)
+    X = np.random.randn(120, 4) + 3
+    Y = np.dot(X, np.random.randn(4, 500)) * 0.3 + np.random.randn(120, 500) + 5
+
+    betas, z = calc_glm(X, Y, demean=True, des_norm=True)
+
+    Xd = X - X.mean(0)
+    Xd /= Xd.std(0, ddof=1)
+    Yd = Y - Y.mean(0)
+    desired = np.linalg.lstsq(Xd, Yd)[0]
+    np.testing.assert_almost_equal(betas, desired)
+
+    dof = 120 - 4 - 1
+    res = Yd - np.dot(Xd, desired)
+    se = np.sqrt(np.outer(np.diag(np.linalg.inv(np.dot(Xd.T, Xd))),
+                          (res ** 2).sum(0) / dof))
+    t = desired / se
+    np.testing.assert_almost_equal(z, np.sign(t) * stats.norm.isf(stats.t.sf(np.abs(t), dof)))
+
+    # linearly dependent regressors
+    np.testing.assert_raises(Exception, calc_glm,
+                             np.hstack((X, 2 * X[:, :1] - X[:, 1:2])), Y)
+
+
+def write_regression_data(out_dir):
+    """
+    Writes a functional image whose voxels mix two time series, the time
+    series as a 3dROIstats 1D file, and a brain mask
+    """
+    import os
+    import numpy as np
+    import nibabel as nb
+
+    np.random.seed(0)
+    ts = np.random.randn(80, 2)
+    weights = np.random.randn(2, 4, 5, 6)
+    data = np.tensordot(ts, weights, (1, 0)).transpose(1, 2, 3, 0)
+    data += 0.5 * np.random.randn(*data.shape) + 10
+    mask = np.ones((4, 5, 6), dtype='int16')
+    mask[0] = 0
+
+    rest = os.path.join(out_dir, 'rest.nii.gz')
+    nb.Nifti1Image(data.astype('float32'), np.eye(4)).to_filename(rest)
+    mask_file = os.path.join(out_dir, 'mask.nii.gz')
+    nb.Nifti1Image(mask, np.eye(4)).to_filename(mask_file)
+
+    one_d = os.path.join(out_dir, 'roi_stats.1D')
+    with open(one_d, 'w') as f:
+        f.write('#File\tSub-brick\tMean_3\tMean_7\n')
+        np.savetxt(f, ts, delimiter='\t')
+
+    return rest, one_d, mask_file, data, ts, mask.astype('bool')
+
+
+def test_temporal_regression():
+    """
+    Tests the maps written by temporal_regression, and that map_to_roi pairs
+    each of them with the ROI of its time series
+    """
+    import os
+    import tempfile
+    import numpy as np
+    import nibabel as nb
+    from CPAC.sca.utils import temporal_regression, map_to_roi
+
+    out_dir = tempfile.mkdtemp()
+    rest, one_d, mask_file, data, ts, mask = write_regression_data(out_dir)
+
+    cwd = os.getcwd()
+    os.chdir(out_dir)
+    try:
+        temp_reg_map, temp_reg_map_files, temp_reg_map_z, \
+            temp_reg_map_z_files = temporal_regression(rest, one_d, mask_file)
+
+        assert os.path.basename(temp_reg_map) == 'temp_reg_map.nii.gz'
+        assert os.path.basename(temp_reg_map_z) == 'temp_reg_map_z.nii.gz'
+        assert [os.path.basename(f) for f in temp_reg_map_files] == \
+            ['temp_reg_map_0000.nii.gz', 'temp_reg_map_0001.nii.gz']
+        assert [os.path.basename(f) for f in temp_reg_map_z_files] == \
+            ['temp_reg_map_z_0000.nii.gz', 'temp_reg_map_z_0001.nii.gz']
+        assert nb.load(temp_reg_map).shape == (4, 5, 6, 2)
+        assert nb.load(temp_reg_map_z).shape == (4, 5, 6, 2)
+
+        # parameter estimates of the demeaned, normalized time series
+        X = ts - ts.mean(0)
+        X /= X.std(0, ddof=1)
+        Y = data[mask].T
+        desired = np.linalg.lstsq(X, Y - Y.mean(0))[0]
+
+        # the maps come back in order whatever order they are given in
+        labels, maps = map_to_roi(one_d, temp_reg_map_files[::-1])
+        assert labels == ['sca_tempreg_z_maps_roi_3',
+                          'sca_tempreg_z_maps_roi_7']
+        for i, map_file in enumerate(maps):
+            actual = nb.load(map_file).get_data()
+            np.testing.assert_almost_equal(actual[mask], desired[i],
+                                           decimal=4)
+            assert np.all(actual[~mask] == 0)
+    finally:
+        os.chdir(cwd)
+
+
+def test_spatial_regression():
+    """
+    Tests spatial_regression recovers the time series of the spatial maps
+    """
+    import os
+    import tempfile
+    import numpy as np
+    import nibabel as nb
+    from CPAC.sca.utils import spatial_regression
+
+    out_dir = tempfile.mkdtemp()
+    np.random.seed(0)
+    maps = np.random.randn(4, 5, 6, 3)
+    ts = np.random.randn(50, 3)
+    data = np.tensordot(maps, ts, (3, 1)) + 0.01 * np.random.randn(4, 5, 6, 50)
+    mask = np.ones((4, 5, 6), dtype='int16')
+    mask[:, 0] = 0
+
+    rest = os.path.join(out_dir, 'rest.nii.gz')
+    nb.Nifti1Image(data.astype('float32'), np.eye(4)).to_filename(rest)
+    mask_file = os.path.join(out_dir, 'mask.nii.gz')
+    nb.Nifti1Image(mask, np.eye(4)).to_filename(mask_file)
+    spatial_map = os.path.join(out_dir, 'maps.nii.gz')
+    nb.Nifti1Image(maps.astype('float32'), np.eye(4)).to_filename(spatial_map)
+
+    cwd = os.getcwd()
+    os.chdir(out_dir)
+    try:
+        out_file = spatial_regression(rest, mask_file, spatial_map,
+                                      demean=False)
+    finally:
+        os.chdir(cwd)
+
+    assert os.path.basename(out_file) == 'spatial_map_timeseries.txt'
+    actual = np.loadtxt(out_file)
+    assert actual.shape == (50, 3)
+    np.testing.assert_allclose(actual, ts, atol=0.01)
+
+
+def test_compute_sca():
+    """
+    Tests the correlation maps of compute_sca against np.corrcoef, with
+    constant voxels given a correlation of 0, and the names of its files
+    """
+    import os
+    import tempfile
+    import numpy as np
+    import nibabel as nb
+    from CPAC.sca.utils import compute_sca
+
+    out_dir = tempfile.mkdtemp()
+    np.random.seed(0)
+    seeds = np.random.randn(40, 2)
+    data = np.tensordot(np.random.randn(4, 5, 6, 2), seeds.T, 1)
+    data += np.random.randn(4, 5, 6, 40) + 100
+    data[0] = 0
+    data[1, 2, 3] = 50
+
+    functional_file = os.path.join(out_dir, 'rest.nii.gz')
+    nb.Nifti1Image(data.astype('float32'), np.eye(4)).to_filename(functional_file)
+
+    one_d = os.path.join(out_dir, 'roi_stats.1D')
+    with open(one_d, 'w') as f:
+        f.write('#File\tSub-brick\tMean_2\tMean_5\n')
+        np.savetxt(f, seeds, delimiter='\t')
+
+    cwd = os.getcwd()
+    os.chdir(out_dir)
+    try:
+        correlation_stack, correlation_files, z_score_files = \
+            compute_sca(functional_file, one_d)
+    finally:
+        os.chdir(cwd)
+
+    assert os.path.basename(correlation_stack) == 'sca_correlation_stack.nii.gz'
+    assert [os.path.basename(f) for f in correlation_files] == \
+        ['sca_ROI_2.nii.gz', 'sca_ROI_5.nii.gz']
+    assert [os.path.basename(f) for f in z_score_files] == \
+        ['sca_ROI_2_fisher_zstd.nii.gz', 'sca_ROI_5_fisher_zstd.nii.gz']
+
+    stack = nb.load(correlation_stack).get_data()
+    assert stack.shape == (4, 5, 6, 2)
+
+    varying = np.ones((4, 5, 6), dtype='bool')
+    varying[0] = False
+    varying[1, 2, 3] = False
+    for i in range(2):
+        desired = np.zeros((4, 5, 6))
+        desired[varying] = [np.corrcoef(ts, seeds[:, i])[0, 1]
+                            for ts in data[varying]]
+
+        corr = nb.load(correlation_files[i]).get_data()
+        np.testing.assert_almost_equal(corr, desired, decimal=5)
+        np.testing.assert_almost_equal(stack[..., i], corr)
+        assert np.all(corr[~varying] == 0)
+
+        z = nb.load(z_score_files[i]).get_data()
+        np.testing.assert_almost_equal(z, np.arctanh(corr), decimal=5)
@@ -72,6 +72,330 @@ def compute_fisher_z_score(correlation_file, timeseries_one_d):
     return out_file
 
 
+def compute_sca(functional_file, timeseries_one_d):
+
+    """
+    Correlates every ROI time series of a 1D file with every voxel of a
+    functional file in one pass, replacing 3dTCorr1D, 3dTCat and fslsplit.
+    The time series of the non-constant voxels are z-normalized and
+    correlated with the ROI time series a block of voxels at a time, so only
+    one block is held in double precision; constant voxels get a
+    correlation of 0. The correlations are written as a stack and as one
+    map per ROI, followed by their Fisher z-transforms.
+
+
+    Parameters
+    ----------
+    functional_file: string
+        Input 4D functional file
+    timeseries_one_d: string
+        1D file of ROI time series, one column per ROI, with a 3dROIstats
+        style header of the ROI labels
+
+    Returns
+    -------
+    correlation_stack : string (nifti file)
+        4D file of the correlation map of each ROI
+    correlation_files : list (nifti files)
+        correlation map of each ROI, named sca_ROI_<label>
+    z_score_files : list (nifti files)
+        Fisher z-transformed correlation map of each ROI, named as by
+        compute_fisher_z_score
+    """
+
+    import os
+    import nibabel as nb
+    import numpy as np
+    from CPAC.utils.utils import get_roi_num_list
+
+    roi_list = get_roi_num_list(timeseries_one_d, prefix='sca')
+    seeds = np.loadtxt(timeseries_one_d, comments='#', ndmin=2)
+
+    func_img = nb.load(functional_file)
+    data = func_img.get_data()
+    vol_shape = data.shape[:3]
+
+    if seeds.shape[0] != data.shape[3]:
+        raise Exception('The ROI timeseries %s has %d timepoints but the '
+                        'functional file %s has %d.'
+                        % (timeseries_one_d, seeds.shape[0],
+                           functional_file, data.shape[3]))
+    if seeds.shape[1] != len(roi_list):
+        raise Exception('The ROI timeseries %s has %d columns but %d ROI '
+                        'labels.' % (timeseries_one_d, seeds.shape[1],
+                                     len(roi_list)))
+
+    def z_normalize(X):
+        # rows of X to zero mean and unit norm, constant rows to 0
+        X -= X.mean(1)[:, np.newaxis]
+        norm = np.sqrt((X ** 2).sum(1))
+        norm[norm == 0] = np.inf
+        X /= norm[:, np.newaxis]
+        return X
+
+    S = z_normalize(seeds.T.astype('float64'))
+
+    # voxels with a constant time series have no correlation
+    x, y, z = np.nonzero(data.max(3) != data.min(3))
+
+    corr = np.zeros(vol_shape + (len(roi_list),), dtype='float32')
+    block_size = 10000
+    for start in range(0, len(x), block_size):
+        block = (x[start:start + block_size], y[start:start + block_size],
+                 z[start:start + block_size])
+        Y = z_normalize(data[block].astype('float64'))
+        corr[block] = np.dot(Y, S.T)
+    del data
+
+    hdr = func_img.get_header().copy()
+    hdr.set_data_dtype(np.float32)
+    affine = func_img.get_affine()
+
+    correlation_stack = os.path.join(os.getcwd(), 'sca_correlation_stack.nii.gz')
+    nb.Nifti1Image(corr, header=hdr, affine=affine).to_filename(correlation_stack)
+
+    correlation_files = []
+    for i, roi in enumerate(roi_list):
+        roi_file = os.path.join(os.getcwd(), roi + '.nii.gz')
+        nb.Nifti1Image(corr[..., i], header=hdr, affine=affine).to_filename(roi_file)
+        correlation_files.append(roi_file)
+
+    # Fisher r-to-z transformation
+    np.arctanh(corr, out=corr)
+
+    z_score_files = []
+    for i, roi in enumerate(roi_list):
+        z_file = os.path.join(os.getcwd(), roi + '_fisher_zstd.nii.gz')
+        nb.Nifti1Image(corr[..., i], header=hdr, affine=affine).to_filename(z_file)
+        z_score_files.append(z_file)
+
+    return correlation_stack, correlation_files, z_score_files
+
+
+def calc_glm(design, data, demean=False, des_norm=False, zstats=True):
+
+    """
+    Ordinary least squares fit of every column of data against the columns
+    of design with a single QR decomposition, as done by fsl_glm
+
+
+    Parameters
+    ----------
+    design: numpy array
+        (N, R) design matrix of R regressors
+    data: numpy array
+        (N, V) matrix of V samples, e.g. voxel time series
+    demean: boolean
+        demean the design and data columns
+    des_norm: boolean
+        normalize the design columns to unit standard deviation
+    zstats: boolean
+        also compute the z-statistics of the parameter estimates
+
+    Returns
+    -------
+    betas : numpy array
+        (R, V) parameter estimates
+    z : numpy array
+        (R, V) z-statistics of the parameter estimates, only if zstats
+    """
+
+    import numpy as np
+    from scipy import stats
+    from scipy.linalg import solve_triangular
+    from CPAC.utils import full_rank_qr
+
+    X = np.array(design, dtype='float64', ndmin=2)
+    if X.shape[0] == 1 and X.shape[1] == data.shape[0]:
+        X = X.T
+    Y = np.array(data, dtype='float64')
+
+    if demean:
+        X -= X.mean(0)
+        Y -= Y.mean(0)
+    if des_norm:
+        std = X.std(0, ddof=1)
+        std[std == 0] = 1
+        X /= std
+
+    try:
+        Q, R = full_rank_qr(X)
+    except np.linalg.LinAlgError:
+        raise Exception('The design matrix of the GLM is rank deficient, '
+                        'the %d regressors are not linearly independent.'
+                        % X.shape[1])
+
+    betas = solve_triangular(R, np.dot(Q.T, Y))
+
+    if not zstats:
+        return betas
+
+    # residual variance of every sample, and t-statistics of the estimates;
+    # the variances of the estimates are the diagonal of inv(R'R)
+    dof = X.shape[0] - X.shape[1] - int(bool(demean))
+    Y -= np.dot(X, betas)
+    sigma_sq = np.einsum('ij,ij->j', Y, Y) / dof
+    R_inv = solve_triangular(R, np.eye(R.shape[0]))
+    se = np.sqrt(np.outer((R_inv ** 2).sum(1), sigma_sq))
+    se[se == 0] = np.inf
+    t = betas / se
+
+    # t to z through their tail probabilities
+    p = np.clip(stats.t.sf(np.abs(t), dof), np.finfo('float64').tiny, 0.5)
+    z = np.sign(t) * stats.norm.isf(p)
+
+    return betas, z
+
+
+def temporal_regression(subject_rest, subject_timeseries, subject_mask,
+                        demean=True, normalize=True):
+
+    """
+    Regresses all the time series of a txt/1D file against every voxel of
+    a functional file in one GLM, replacing fsl_glm and its fslsplit passes
+
+
+    Parameters
+    ----------
+    subject_rest: string
+        Input 4D functional file
+    subject_timeseries: string
+        txt/1D file of time series, one column per regressor
+    subject_mask: string
+        functional brain mask
+    demean: boolean
+        demean the time series and the data
+    normalize: boolean
+        normalize the time series to unit standard deviation
+
+    Returns
+    -------
+    temp_reg_map : string (nifti file)
+        4D file of the parameter estimate map of each time series
+    temp_reg_map_files : list (nifti files)
+        parameter estimate map of each time series
+    temp_reg_map_z : string (nifti file)
+        4D file of the z-statistic map of each time series
+    temp_reg_map_z_files : list (nifti files)
+        z-statistic map of each time series
+    """
+
+    import nibabel as nb
+    import numpy as np
+    from CPAC.sca.utils import calc_glm, write_glm_maps
+
+    design = np.loadtxt(subject_timeseries, comments='#', ndmin=2)
+
+    rest_img = nb.load(subject_rest)
+    mask = nb.load(subject_mask).get_data().astype('bool')
+
+    data = rest_img.get_data()[mask].T
+
+    betas, z = calc_glm(design, data, demean=demean, des_norm=normalize)
+    del data
+
+    temp_reg_map, temp_reg_map_files = write_glm_maps(betas, mask, rest_img,
+                                                      'temp_reg_map')
+    temp_reg_map_z, temp_reg_map_z_files = write_glm_maps(z, mask, rest_img,
+                                                          'temp_reg_map_z')
+
+    return temp_reg_map, temp_reg_map_files, temp_reg_map_z, \
+           temp_reg_map_z_files
+
+
+def spatial_regression(subject_rest, subject_mask, spatial_map, demean=True):
+
+    """
+    Regresses the spatial maps against every volume of a functional file in
+    one GLM, replacing fsl_glm, to get the time series of each map
+
+
+    Parameters
+    ----------
+    subject_rest: string
+        Input 4D functional file
+    subject_mask: string
+        functional brain mask
+    spatial_map: string
+        3D or 4D file of spatial maps
+    demean: boolean
+        demean the spatial maps and the volumes over the mask
+
+    Returns
+    -------
+    subject_timeseries : string (txt file)
+        time series of the maps, a column per map and a row per timepoint
+    """
+
+    import os
+    import nibabel as nb
+    import numpy as np
+    from CPAC.sca.utils import calc_glm
+
+    mask = nb.load(subject_mask).get_data().astype('bool')
+    maps = nb.load(spatial_map).get_data()[mask]
+    data = nb.load(subject_rest).get_data()[mask]
+
+    betas = calc_glm(maps, data, demean=demean, zstats=False)
+
+    subject_timeseries = os.path.join(os.getcwd(),
+                                      'spatial_map_timeseries.txt')
+    np.savetxt(subject_timeseries, betas.T, fmt='%.8g')
+
+    return subject_timeseries
+
+
+def write_glm_maps(stats, mask, ref_img, out_base_name):
+
+    """
+    Writes GLM statistics of the mask voxels as a 4D file and as one file
+    per regressor, named as fslsplit names the volumes of the 4D file
+
+
+    Parameters
+    ----------
+    stats: numpy array
+        (R, V) statistics of the V mask voxels
+    mask: numpy array
+        3D boolean mask
+    ref_img: nibabel image
+        image to take the header and affine from
+    out_base_name: string
+        prefix of the output files
+
+    Returns
+    -------
+    stack_file : string (nifti file)
+        4D file of the R maps
+    map_files : list (nifti files)
+        R files, out_base_name_0000 onwards
+    """
+
+    import os
+    import nibabel as nb
+    import numpy as np
+
+    vol = np.zeros(mask.shape + (stats.shape[0],), dtype='float32')
+    vol[mask] = stats.T
+
+    hdr = ref_img.get_header().copy()
+    hdr.set_data_dtype(np.float32)
+    affine = ref_img.get_affine()
+
+    stack_file = os.path.join(os.getcwd(), out_base_name + '.nii.gz')
+    nb.Nifti1Image(vol, header=hdr, affine=affine).to_filename(stack_file)
+
+    map_files = []
+    for i in range(stats.shape[0]):
+        map_file = os.path.join(os.getcwd(),
+                                '%s_%04d.nii.gz' % (out_base_name, i))
+        nb.Nifti1Image(vol[..., i], header=hdr,
+                       affine=affine).to_filename(map_file)
+        map_files.append(map_file)
+
+    return stack_file, map_files
+
+
 def check_ts(in_file):
     import numpy as np
     try:
@@ -125,6 +449,9 @@ def map_to_roi(timeseries, maps):
         (which == 'RT')
     """
 
+    import os
+    import numpy as np
+
     testMat = np.loadtxt(timeseries)
     timepoints, rois = testMat.shape
 
@@ -47,10 +47,8 @@ def create_scrubbing_preproc(wf_name = 'scrubbing'):
     - Remove all movement parameters for all the time frames other than those that are present
       in the frames_in_1D file
       
-    - Remove the discarded timepoints from the input image. For details see `3dcalc <http://afni.nimh.nih.gov/pub/dist/doc/program_help/3dcalc.html>`_::
-        
-        3dcalc -a bandpassed_demeaned_filtered.nii.gz[0,1,5,6,7,8,9,10,15,16,17,18,19,20,24,25,287,288,289,290,291,292,293,294,295] 
-               -expr 'a' -prefix bandpassed_demeaned_filtered_3dc.nii.gz
+    - Remove the discarded timepoints from the input image, by selecting the
+      volumes listed in the frames_in_1D file directly from the image
                
     High Level Workflow Graph:
     
@@ -85,11 +83,6 @@ def create_scrubbing_preproc(wf_name = 'scrubbing'):
                                                         'scrubbed_movement_parameters']),
                          name='outputspec')
 
-    craft_scrub_input = pe.Node(util.Function(input_names=['scrub_input', 'frames_in_1D_file'],
-                                              output_names=['scrub_input_string'],
-                                              function=get_indx),
-                                name = 'scrubbing_craft_input_string')
-
     scrubbed_movement_parameters = pe.Node(util.Function(input_names=['infile_a', 'infile_b'], 
                                                  output_names=['out_file'],
                                                  function=get_mov_parameters), 
@@ -103,15 +96,14 @@ def create_scrubbing_preproc(wf_name = 'scrubbing'):
     #scrubbed_preprocessed.inputs.expr = 'a'
     #scrubbed_preprocessed.inputs.outputtype = 'NIFTI_GZ'   
     
-    scrubbed_preprocessed = pe.Node(util.Function(input_names=['scrub_input'],
+    scrubbed_preprocessed = pe.Node(util.Function(input_names=['in_file',
+                                                               'frames_in_1D_file'],
                                                   output_names=['scrubbed_image'],
                                                   function=scrub_image),
                                     name='scrubbed_preprocessed')
 
-    scrub.connect(inputNode, 'preprocessed', craft_scrub_input, 'scrub_input')
-    scrub.connect(inputNode, 'frames_in_1D', craft_scrub_input, 'frames_in_1D_file')
-    
-    scrub.connect(craft_scrub_input, 'scrub_input_string', scrubbed_preprocessed, 'scrub_input')    
+    scrub.connect(inputNode, 'preprocessed', scrubbed_preprocessed, 'in_file')
+    scrub.connect(inputNode, 'frames_in_1D', scrubbed_preprocessed, 'frames_in_1D_file')
 
     scrub.connect(inputNode, 'movement_parameters', scrubbed_movement_parameters, 'infile_b')
     scrub.connect(inputNode, 'frames_in_1D', scrubbed_movement_parameters, 'infile_a' )
@@ -162,11 +154,8 @@ def get_mov_parameters(infile_a, infile_b):
     else:
         raise Exception("No time points remaining after scrubbing.")
 
-    f = open(out_file, 'a')
-    for l in l1:
-        data=l2[int(l.strip())]
-        f.write(data)
-    f.close()
+    with open(out_file, 'w') as f:
+        f.write(''.join(l2[int(l.strip())] for l in l1))
     return out_file
 
 
@@ -203,19 +192,21 @@ def get_indx(scrub_input, frames_in_1D_file):
     return scrub_input_string
     
     
-def scrub_image(scrub_input):
+def scrub_image(in_file, frames_in_1D_file):
 
     """
-    Method to run 3dcalc in order to scrub the image. This is used instead of
-    the Nipype interface for 3dcalc because functionality is needed for
-    specifying an input file with specifically-selected volumes. For example:
-        input.nii.gz[2,3,4,..98], etc.
+    Method to scrub the image, keeping only the volumes listed in the
+    frames in file. Only the kept volumes are read from an uncompressed
+    image, a run of consecutive volumes at a time, instead of running
+    3dcalc with the list of volumes on the command line; a compressed image
+    is decompressed once.
         
     Parameters
     ----------
-    scrub_input : string
-        path to 4D file to be scrubbed, plus with selected volumes to be
-        included
+    in_file : string
+        path to 4D file to be scrubbed
+    frames_in_1D_file : string
+        path to file containing the valid time frames
         
     Returns
     -------
@@ -225,9 +216,29 @@ def scrub_image(scrub_input):
     """
 
     import os
+    import numpy as np
+    import nibabel as nb
+
+    with open(frames_in_1D_file, 'r') as f:
+        line = f.readline().strip().strip(',')
+
+    if line:
+        indx = [int(i) for i in line.split(",")]
+    else:
+        raise Exception("No time points remaining after scrubbing.")
 
-    os.system("3dcalc -a %s -expr 'a' -prefix scrubbed_preprocessed.nii.gz" % scrub_input)
+    img = nb.load(in_file)
+    if in_file.endswith('.gz'):
+        # compressed images can only be read from the start of the file
+        data = img.get_data()[..., indx]
+    else:
+        indx = np.asarray(indx)
+        runs = np.split(indx, np.flatnonzero(np.diff(indx) != 1) + 1)
+        data = np.concatenate([np.asarray(img.dataobj[..., run[0]:run[-1] + 1])
+                               for run in runs], axis=3)
 
     scrubbed_image = os.path.join(os.getcwd(), "scrubbed_preprocessed.nii.gz")
+    nb.Nifti1Image(data, header=img.get_header(),
+                   affine=img.get_affine()).to_filename(scrubbed_image)
 
     return scrubbed_image
@@ -0,0 +1,50 @@
+import os
+import tempfile
+
+import numpy as np
+from numpy.testing import *
+
+from ..scrubbing import scrub_image
+
+
+def test_scrub_image():
+    """
+    Tests that scrub_image keeps the listed volumes, in order, from both
+    uncompressed and compressed images
+    """
+    import nibabel as nb
+
+    np.random.seed(27)
+    out_dir = tempfile.mkdtemp()
+    data = np.random.randn(4, 5, 6, 20).astype('float32')
+    affine = np.diag([2., 2., 2., 1.])
+
+    frames_in = os.path.join(out_dir, 'frames_in.1D')
+    indx = [0, 1, 2, 5, 6, 9, 13, 14, 15, 16, 19]
+    with open(frames_in, 'w') as f:
+        f.write(''.join('{0},'.format(i) for i in indx))
+
+    cwd = os.getcwd()
+    os.chdir(out_dir)
+    try:
+        for ext in ['.nii', '.nii.gz']:
+            in_file = os.path.join(out_dir, 'rest' + ext)
+            nb.Nifti1Image(data, affine).to_filename(in_file)
+
+            scrubbed = nb.load(scrub_image(in_file, frames_in))
+            assert_equal(scrubbed.get_data(), data[..., indx])
+            assert_equal(scrubbed.get_affine(), affine)
+    finally:
+        os.chdir(cwd)
+
+
+def test_scrub_image_no_frames():
+    """
+    Tests that scrubbing every volume raises an error
+    """
+    out_dir = tempfile.mkdtemp()
+    frames_in = os.path.join(out_dir, 'frames_in.1D')
+    with open(frames_in, 'w') as f:
+        f.write('')
+
+    assert_raises(Exception, scrub_image, 'rest.nii.gz', frames_in)
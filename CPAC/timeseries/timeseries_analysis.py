@@ -7,6 +7,8 @@ import nipype.interfaces.afni as afni
 
 from nipype import logging
 
+from CPAC.sca.utils import spatial_regression
+
 
 def create_surface_registration(wf_name='surface_registration'):
     """
@@ -400,21 +402,24 @@ def get_spatial_map_timeseries(wf_name='spatial_map_timeseries'):
                          (fields=['subject_timeseries']),
                           name='outputspec')
 
-    spatialReg = pe.Node(interface=fsl.GLM(),
+    spatialReg = pe.Node(util.Function(input_names=['subject_rest',
+                                                    'subject_mask',
+                                                    'spatial_map',
+                                                    'demean'],
+                                       output_names=['subject_timeseries'],
+                                       function=spatial_regression),
                          name='spatial_regression')
 
-    spatialReg.inputs.out_file = 'spatial_map_timeseries.txt'
-
     wflow.connect(inputNode, 'subject_rest',
-                spatialReg, 'in_file')
+                spatialReg, 'subject_rest')
     wflow.connect(inputNode, 'subject_mask',
-                spatialReg, 'mask')
+                spatialReg, 'subject_mask')
     wflow.connect(inputNode, 'spatial_map',
-                spatialReg, 'design')
+                spatialReg, 'spatial_map')
     wflow.connect(inputNode, 'demean',
                 spatialReg, 'demean')
 
-    wflow.connect(spatialReg, 'out_file',
+    wflow.connect(spatialReg, 'subject_timeseries',
                   outputNode, 'subject_timeseries')
 
     return wflow
@@ -576,6 +581,7 @@ def gen_roi_timeseries(data_file, template, output_type):
     import numpy as np
     import os
     import shutil
+    from CPAC.utils import parcel_mean
 
     unit_data = nib.load(template).get_data()
     # Cast as rounded-up integer
@@ -589,7 +595,6 @@ def gen_roi_timeseries(data_file, template, output_type):
                         'Please check the voxel dimensions. '
                         'Data and roi should have the same shape.\n\n')
 
-    nodes = np.unique(unit_data).tolist()
     sorted_list = []
     node_dict = {}
     out_list = []
@@ -603,16 +608,14 @@ def gen_roi_timeseries(data_file, template, output_type):
     csv_file = os.path.abspath('roi_' + tmp_file + '.csv')
     numpy_file = os.path.abspath('roi_' + tmp_file + '.npz')
     
-    nodes.sort()
-    for n in nodes:
-        if n > 0:
-            node_array = img_data[unit_data == n]
-            node_str = 'node_{0}'.format(n)
-            avg = np.mean(node_array, axis=0)
-            avg = np.round(avg, 6)
-            list1 = [n] + avg.tolist()
-            sorted_list.append(list1)
-            node_dict[node_str] = avg.tolist()
+    # Mean timeseries of every node at once
+    nodes, node_means = parcel_mean(img_data, unit_data)
+    for n, avg in zip(nodes.tolist(), node_means):
+        node_str = 'node_{0}'.format(n)
+        avg = np.round(avg, 6)
+        list1 = [n] + avg.tolist()
+        sorted_list.append(list1)
+        node_dict[node_str] = avg.tolist()
 
     # writing to 1Dfile
     print("writing 1D file..")
@@ -0,0 +1,108 @@
+import numpy as np
+from numpy.testing import *
+
+from ..utils import parcel_mean, \
+                    volumize_labels, \
+                    low_rank_svd, \
+                    full_rank_qr
+
+
+def test_parcel_mean():
+    """
+    Tests that parcel_mean averages every parcel in the order of the
+    sorted labels, with nan for parcels that have no voxels in the mask
+    """
+    np.random.seed(27)
+    labels = np.random.choice([0, 2, 5, 11], size=(5, 6, 7)).astype('float32')
+    labels[0, 0, 0] = 8
+    data = np.random.randn(5, 6, 7, 20)
+    mask = labels != 8
+
+    label_values, means = parcel_mean(data, labels, mask)
+
+    positive = np.unique(labels)[np.unique(labels) > 0]
+    assert_equal(label_values, positive)
+    assert_equal(means.shape, (len(positive), 20))
+    for i, label in enumerate(positive):
+        if label == 8:
+            assert np.isnan(means[i]).all()
+        else:
+            assert_array_almost_equal(means[i],
+                                      data[labels == label].mean(0))
+
+    # Without a mask every parcel has voxels
+    label_values, means = parcel_mean(data, labels)
+    assert_array_almost_equal(means[list(positive).index(8)], data[0, 0, 0])
+
+    # Three dimensional data gives one value per parcel
+    label_values, means = parcel_mean(data[..., 0], labels)
+    assert_equal(means.shape, (len(positive),))
+
+
+def test_volumize_labels():
+    """
+    Tests that volumize_labels puts the values, ordered as the unique
+    labels, back on the voxels of their parcels
+    """
+    np.random.seed(27)
+    labels = np.random.choice([0, 3, 4, 9], size=(4, 5, 6))
+    values = np.array([1., 2., 3.])
+
+    volume = volumize_labels(values, labels)
+
+    assert_equal(volume.shape, labels.shape)
+    assert_equal(volume[labels == 0], 0)
+    for value, label in zip(values, [3, 4, 9]):
+        assert_equal(volume[labels == label], value)
+
+    # The means of parcel_mean map back onto their parcels
+    data = np.random.randn(4, 5, 6, 10)
+    label_values, means = parcel_mean(data, labels)
+    volume = volumize_labels(means, labels)
+    assert_equal(volume.shape, data.shape)
+    assert_array_almost_equal(volume[labels == 4][0],
+                              data[labels == 4].mean(0))
+
+
+def test_low_rank_svd():
+    """
+    Tests that low_rank_svd matches the leading singular values and left
+    singular vectors of np.linalg.svd, up to the sign of each vector, for
+    tall and wide matrices
+    """
+    np.random.seed(16)
+    for shape in [(40, 12), (12, 40), (15, 15)]:
+        X = np.random.randn(*shape)
+        U_ref, S_ref, _ = np.linalg.svd(X, full_matrices=False)
+
+        for k in [1, 3, min(shape)]:
+            U, S = low_rank_svd(X, k)
+            assert_equal(U.shape, (shape[0], k))
+            assert_array_almost_equal(S, S_ref[:k])
+
+            signs = np.sign((U * U_ref[:, :k]).sum(0))
+            assert_array_almost_equal(U * signs, U_ref[:, :k])
+
+    # more components than the rank of the matrix allows
+    X = np.random.randn(30, 5)
+    U, S = low_rank_svd(X, 10)
+    assert_equal(U.shape, (30, 5))
+    assert_array_almost_equal(S, np.linalg.svd(X, compute_uv=False))
+
+
+def test_full_rank_qr():
+    """
+    Tests that full_rank_qr factorizes a matrix of independent columns and
+    raises a LinAlgError when a column depends on the others
+    """
+    np.random.seed(14)
+    X = np.hstack((np.ones((50, 1)), np.random.randn(50, 4)))
+
+    Q, R = full_rank_qr(X)
+    assert_array_almost_equal(np.dot(Q, R), X)
+    assert_array_almost_equal(np.dot(Q.T, Q), np.eye(5))
+
+    for dependent in [X[:, 1:2] * 3, X[:, 1:2] - 2 * X[:, 2:3],
+                      np.zeros((50, 1))]:
+        assert_raises(np.linalg.LinAlgError, full_rank_qr,
+                      np.hstack((X, dependent)))
@@ -496,6 +496,208 @@ def safe_shape(*vol_data):
     return same_volume
 
 
+def volumize(data, mask):
+    """
+    Places the values of the voxels in a mask back into a volume; the
+    inverse of `data = volume[mask]`.
+
+    Parameters
+    ----------
+    data : ndarray
+        Values of the voxels, of shape (nvoxs,) or (nvoxs, ...), ordered
+        as the non-zero voxels of the mask (i.e. np.argwhere(mask))
+    mask : ndarray
+        Three dimensional mask of nvoxs non-zero voxels
+
+    Returns
+    -------
+    volume : ndarray
+        Array of shape mask.shape + data.shape[1:], zero outside the mask
+    """
+    import numpy as np
+
+    data = np.asarray(data)
+    mask = np.asarray(mask).astype('bool')
+
+    volume = np.zeros(mask.shape + data.shape[1:], dtype=data.dtype)
+    volume[mask] = data
+
+    return volume
+
+
+def volumize_labels(data, labels):
+    """
+    Places the value of each parcel in a parcellation at all of the voxels
+    with its label.
+
+    Parameters
+    ----------
+    data : ndarray
+        Values of the parcels, of shape (nlabels,) or (nlabels, ...),
+        ordered by ascending label value
+    labels : ndarray
+        Three dimensional parcellation of nlabels labels greater than zero;
+        voxels with labels of zero or less are background
+
+    Returns
+    -------
+    volume : ndarray
+        Array of shape labels.shape + data.shape[1:], zero in background
+    """
+    import numpy as np
+
+    data = np.asarray(data)
+    labels = np.asarray(labels)
+
+    # Index of each voxel's label in the sorted labels
+    label_values, label_idx = np.unique(labels, return_inverse=True)
+
+    # Value of every label, with zeros for the background
+    label_data = np.zeros((len(label_values),) + data.shape[1:],
+                          dtype=data.dtype)
+    label_data[label_values > 0] = data
+
+    volume = label_data[label_idx.ravel()].reshape(labels.shape +
+                                                   data.shape[1:])
+
+    return volume
+
+
+def parcel_mean(data, labels, mask=None):
+    """
+    Computes the mean of the voxels in every parcel of a parcellation in
+    a single pass, as the product of a sparse (parcel x voxel) indicator
+    matrix with the (voxel x time) data matrix.
+
+    Parameters
+    ----------
+    data : ndarray
+        Four dimensional (x, y, z, time) data; three dimensional data
+        gives one value per parcel
+    labels : ndarray
+        Three dimensional parcellation; voxels with labels of zero or
+        less are background
+    mask : ndarray (optional)
+        Three dimensional boolean mask; only voxels in the mask are
+        averaged
+
+    Returns
+    -------
+    label_values : ndarray
+        The labels greater than zero, in ascending order
+    means : ndarray
+        Array of shape (nlabels,) + data.shape[3:] of the parcel means,
+        in the order of label_values; nan for parcels with no voxels
+        in the mask
+    """
+    import numpy as np
+    import scipy.sparse as sparse
+
+    data = np.asarray(data)
+    labels = np.asarray(labels)
+
+    # Voxels to average and the index of their label
+    in_parcel = labels > 0
+    label_values = np.unique(labels[in_parcel])
+    if mask is not None:
+        in_parcel &= np.asarray(mask).astype('bool')
+    label_idx = np.searchsorted(label_values, labels[in_parcel])
+    nvoxs = len(label_idx)
+
+    # Sum each parcel's voxels with one sparse matrix product
+    indicator = sparse.csr_matrix((np.ones(nvoxs),
+                                   (label_idx, np.arange(nvoxs))),
+                                  shape=(len(label_values), nvoxs))
+    voxel_data = data[in_parcel].reshape(nvoxs, -1)
+    sums = indicator.dot(voxel_data)
+    counts = np.asarray(indicator.sum(axis=1)).reshape(-1, 1)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums / counts
+    if np.issubdtype(data.dtype, np.floating):
+        means = means.astype(data.dtype)
+
+    return label_values, means.reshape((len(label_values),) + data.shape[3:])
+
+
+def low_rank_svd(X, k):
+    """
+    Leading singular values and left singular vectors of a matrix.
+
+    They are computed from the eigendecomposition of the smaller of the two
+    Gram matrices (X X' or X' X), which for a timepoints by voxels matrix is
+    only timepoints by timepoints, instead of a full SVD of X.
+
+    Parameters
+    ----------
+    X : ndarray
+        Matrix of shape (n, m), e.g. timepoints by voxels
+    k : integer
+        Number of components, at most min(n, m)
+
+    Returns
+    -------
+    U : ndarray
+        Leading k left singular vectors, of shape (n, k)
+    S : ndarray
+        Leading k singular values, in decreasing order
+    """
+    import numpy as np
+
+    X = np.asarray(X, dtype='float64')
+    n, m = X.shape
+    k = min(k, n, m)
+
+    if n <= m:
+        evals, evecs = np.linalg.eigh(X.dot(X.T))
+        order = evals.argsort()[::-1][:k]
+        S = np.sqrt(np.clip(evals[order], 0, None))
+        U = evecs[:, order]
+    else:
+        evals, evecs = np.linalg.eigh(X.T.dot(X))
+        order = evals.argsort()[::-1][:k]
+        S = np.sqrt(np.clip(evals[order], 0, None))
+        U = X.dot(evecs[:, order])
+        U /= np.where(S > 0, S, 1)
+
+    return U, S
+
+
+def full_rank_qr(X):
+    """
+    QR decomposition of a matrix whose columns must be linearly independent.
+
+    The columns are taken as dependent when a diagonal element of R is
+    below the largest one times max(n, m) times the machine precision, the
+    tolerance np.linalg.matrix_rank uses for the singular values.
+
+    Parameters
+    ----------
+    X : ndarray
+        Matrix of shape (n, m), with n >= m, e.g. a design matrix
+
+    Returns
+    -------
+    Q : ndarray
+        Orthonormal basis of the columns of X, of shape (n, m)
+    R : ndarray
+        Upper triangular matrix of shape (m, m)
+
+    Raises
+    ------
+    LinAlgError
+        If the columns of X are linearly dependent
+    """
+    import numpy as np
+
+    Q, R = np.linalg.qr(X)
+
+    diag = np.abs(np.diag(R))
+    if diag.min() <= diag.max() * max(X.shape) * np.finfo(R.dtype).eps:
+        raise np.linalg.LinAlgError('Singular matrix')
+
+    return Q, R
+
 def extract_one_d(list_timeseries):
     if isinstance(list_timeseries, basestring):
         if '.1D' in list_timeseries or '.csv' in list_timeseries:
@@ -0,0 +1,64 @@
+"""
+Times how long it takes a fresh interpreter to import CPAC modules, which is
+paid by every worker process and every nipype Function node.
+
+Usage: python import_time.py [-n REPEATS] [statement ...]
+"""
+
+import argparse
+import subprocess
+import sys
+import time
+
+
+DEFAULT_STATEMENTS = ['import CPAC',
+                      'from CPAC.utils import volumize',
+                      'from CPAC.network_centrality import core',
+                      'from CPAC.cwas import calc_cwas',
+                      'import CPAC.pipeline.cpac_pipeline']
+
+
+def time_import(statement, repeats):
+    """
+    Wall time of running `statement` in a new python process
+
+    Parameters
+    ----------
+    statement : string
+        Python import statement
+    repeats : integer
+        Number of fresh processes to time
+
+    Returns
+    -------
+    times : list
+        Time in seconds of each run
+    """
+    # Init variables
+    times = []
+
+    for i in range(repeats):
+        start = time.time()
+        subprocess.check_call([sys.executable, '-c', statement])
+        times.append(time.time() - start)
+
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description='CPAC import time benchmark')
+    parser.add_argument('statements', nargs='*', default=DEFAULT_STATEMENTS)
+    parser.add_argument('-n', '--repeats', type=int, default=5)
+    args = parser.parse_args()
+
+    # Baseline cost of starting the interpreter
+    base = min(time_import('pass', args.repeats))
+    print '%-45s %8.3fs' % ('(interpreter start-up)', base)
+
+    for statement in args.statements:
+        best = min(time_import(statement, args.repeats))
+        print '%-45s %8.3fs' % (statement, best - base)
+
+
+if __name__ == '__main__':
+    main()
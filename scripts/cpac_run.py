@@ -22,6 +22,12 @@ def main():
     parser.add_argument("--cpac_install", type=str, default=None,
                         help="the build directory of a custom CPAC "
                              "installation you wish to use for this run")
+    parser.add_argument("--profile", action="store_true",
+                        help="record the runtime, peak CPU usage, peak "
+                             "memory and working directory size of every "
+                             "node (CPU time and I/O are not measured), "
+                             "and write a report of the run to the log "
+                             "directory")
 
     args = parser.parse_args()
 
@@ -42,7 +48,8 @@ def main():
         raise Exception(err)
 
     import CPAC
-    CPAC.pipeline.cpac_runner.run(args.pipeline_config, args.data_config)
+    CPAC.pipeline.cpac_runner.run(args.pipeline_config, args.data_config,
+                                  profile=args.profile)
 
 
 if __name__ == "__main__":
@@ -41,10 +41,15 @@ def configuration(parent_package='', top_path=None):
     config.get_version('CPAC/__init__.py')
     config.add_subpackage('CPAC')
 
-    # cython
+    # cython (generate the C source here so the extension is compiled at
+    # install time rather than by pyximport when CPAC is first imported)
+    from Cython.Build import cythonize
+    cythonize(['CPAC/network_centrality/thresh_and_sum.pyx'])
     config.add_extension('CPAC.network_centrality.thresh_and_sum', 
-                         sources=['CPAC/network_centrality/thresh_and_sum.pyx'], 
-                         include_dirs=[get_numpy_include_dirs()])
+                         sources=['CPAC/network_centrality/thresh_and_sum.c'], 
+                         include_dirs=[get_numpy_include_dirs()],
+                         extra_compile_args=['-fopenmp'],
+                         extra_link_args=['-fopenmp'])
 
     return config
 